@@ -0,0 +1,134 @@
+"""Check that a daily ``detect-anomalies`` run doesn't grow with the history.
+
+Learns ``--years`` of synthetic daily counts for ``--series`` borough and
+complaint type pairs, saves the baselines, and then times what a daily run
+does besides its one-day rollup query: load the state file, learn the new
+day and save it again. No database is needed::
+
+    python -m benchmarks.anomalies --years 1 --years 8 --years 30
+
+Exits with status 1 if the median daily update of any history takes longer
+than ``--budget`` milliseconds.
+
+"""
+
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import click
+import numpy
+import tabulate
+
+from data_jam import anomalies
+
+
+FIRST_DAY = datetime.date(2010, 1, 1)
+
+
+def days_of_calls(rng, keys, first, days):
+    """``(day, borough, type, calls)`` rows, one list per day.
+
+    Every series has its own Poisson rate with a weekly cycle, and quiet
+    series skip most days like the real ones do.
+
+    """
+    rates = rng.gamma(0.5, 40, size=len(keys))
+    weekly = numpy.array([1.1, 1.05, 1, 1, 1, 0.8, 0.7])
+
+    for offset in range(days):
+        day = first + datetime.timedelta(days=offset)
+        calls = rng.poisson(rates * weekly[day.weekday()])
+
+        yield [
+            (day, borough, type_, int(count))
+            for (borough, type_), count in zip(keys, calls)
+            if count
+        ]
+
+
+def learn(baselines, days, chunk_days=366):
+    """Feed ``days`` to ``baselines`` in chunks, like ``anomalies.refresh``."""
+    chunk = []
+
+    for idx, rows in enumerate(days, 1):
+        chunk.extend(rows)
+
+        if idx % chunk_days == 0:
+            baselines.update(chunk)
+            chunk = []
+
+    baselines.update(chunk)
+
+
+@click.command()
+@click.option('--years', 'histories', default=(1, 8, 30), multiple=True,
+              type=click.IntRange(min=1), help="Years of history. Can be repeated.")
+@click.option('--series', default=1500, type=click.IntRange(min=1),
+              help="Borough and complaint type pairs.")
+@click.option('--runs', default=20, type=click.IntRange(min=1),
+              help="Daily updates to time per history.")
+@click.option('--budget', default=250, type=click.IntRange(min=1),
+              help="Milliseconds a daily update may take.")
+@click.option('--seed', default=0, type=click.INT)
+def main(histories, series, runs, budget, seed):
+    keys = [
+        (borough, f'Complaint type {idx}')
+        for idx, borough in zip(
+            range(series),
+            numpy.resize(['BRONX', 'BROOKLYN', 'MANHATTAN', 'QUEENS', 'STATEN ISLAND'], series),
+        )
+    ]
+    results = []
+    failed = False
+
+    with tempfile.TemporaryDirectory() as directory:
+        for years in histories:
+            rng = numpy.random.default_rng(seed)
+            path = os.path.join(directory, f'{years}.npz')
+            days = (
+                FIRST_DAY.replace(year=FIRST_DAY.year + years) - FIRST_DAY
+            ).days
+            calls = days_of_calls(rng, keys, FIRST_DAY, days + runs)
+
+            started = time.perf_counter()
+            baselines = anomalies.Baselines()
+            learn(baselines, (next(calls) for _ in range(days)))
+            baselines.save(path)
+            rebuild = time.perf_counter() - started
+
+            timings = []
+
+            for rows in calls:
+                started = time.perf_counter()
+                baselines = anomalies.Baselines.load(path)
+                baselines.update(rows)
+                baselines.save(path)
+                timings.append(time.perf_counter() - started)
+
+            daily_ms = statistics.median(timings) * 1000
+            failed |= daily_ms > budget
+            results.append((
+                years,
+                days,
+                f"{rebuild:.1f}",
+                f"{daily_ms:.1f}",
+                f"{os.path.getsize(path) / 1024:.0f}",
+                len(baselines.flagged),
+            ))
+
+    print(tabulate.tabulate(
+        results,
+        headers=('Years', 'Days', 'Rebuild s', 'Daily ms', 'State KB', 'Flagged'),
+    ))
+
+    if failed:
+        print(f"FAIL: a daily update took longer than {budget} ms.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
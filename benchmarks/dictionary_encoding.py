@@ -0,0 +1,216 @@
+"""Size and ``GROUP BY`` speed of text vs. dictionary-encoded service requests.
+
+Builds two synthetic tables with the same rows: one with ``agency``, ``type``,
+``descriptor`` and ``borough`` as text like ``service_requests`` had before
+migration 011, and one with ``smallint`` codes into lookup tables. Value
+counts and skew roughly follow the real 311 data::
+
+    python -m benchmarks.dictionary_encoding --rows 10000000
+
+"""
+
+import statistics
+import time
+
+import click
+import tabulate
+
+import data_jam.models as models
+
+
+TEXT_TABLE = 'benchmark_service_requests_text'
+ENCODED_TABLE = 'benchmark_service_requests_encoded'
+
+# (column, distinct values, name prefix)
+COLUMNS = (
+    ('agency', 30, 'Department of '),
+    ('type', 250, 'Complaint Type - '),
+    ('descriptor', 1000, 'Descriptor of the complaint '),
+    ('borough', 6, 'BOROUGH '),
+)
+
+QUERIES = (
+    (
+        'type',
+        f"SELECT type, COUNT(*) FROM {TEXT_TABLE} GROUP BY 1",
+        f"""
+        SELECT lookup.name, counts.calls
+        FROM (
+            SELECT type_id, COUNT(*) AS calls
+            FROM {ENCODED_TABLE} GROUP BY 1
+        ) AS counts
+        JOIN {ENCODED_TABLE}_type AS lookup ON lookup.id = counts.type_id
+        """,
+    ),
+    (
+        'borough, type',
+        f"SELECT borough, type, COUNT(*) FROM {TEXT_TABLE} GROUP BY 1, 2",
+        f"""
+        SELECT boroughs.name, types.name, counts.calls
+        FROM (
+            SELECT borough_id, type_id, COUNT(*) AS calls
+            FROM {ENCODED_TABLE} GROUP BY 1, 2
+        ) AS counts
+        JOIN {ENCODED_TABLE}_borough AS boroughs
+            ON boroughs.id = counts.borough_id
+        JOIN {ENCODED_TABLE}_type AS types ON types.id = counts.type_id
+        """,
+    ),
+    (
+        'day, agency',
+        f"SELECT created::date, agency, COUNT(*) FROM {TEXT_TABLE} GROUP BY 1, 2",
+        f"""
+        SELECT counts.day, agencies.name, counts.calls
+        FROM (
+            SELECT created::date AS day, agency_id, COUNT(*) AS calls
+            FROM {ENCODED_TABLE} GROUP BY 1, 2
+        ) AS counts
+        JOIN {ENCODED_TABLE}_agency AS agencies
+            ON agencies.id = counts.agency_id
+        """,
+    ),
+)
+
+
+def drop():
+    models.DB.execute_sql(f"DROP TABLE IF EXISTS {TEXT_TABLE}, {ENCODED_TABLE}")
+
+    for column, _, _ in COLUMNS:
+        models.DB.execute_sql(f"DROP TABLE IF EXISTS {ENCODED_TABLE}_{column}")
+
+
+def build(rows):
+    """Create and fill both tables, with the indexes ``service_requests`` has."""
+    drop()
+    # Squaring a uniform random number skews the picks towards the first few
+    # values, like the real complaint types.
+    values = ', '.join(
+        f"'{prefix}' || floor(power(random(), 2) * {count})::integer AS {column}"
+        for column, count, prefix in COLUMNS
+    )
+    models.DB.execute_sql(f"""
+        CREATE TABLE {TEXT_TABLE} AS
+        SELECT id, {values},
+               timestamp '2010-01-01' + random() * interval '8 years' AS created
+        FROM generate_series(1, %s) AS id
+    """, (rows,))
+    select = ['text.id']
+    joins = []
+
+    for column, _, _ in COLUMNS:
+        lookup = f"{ENCODED_TABLE}_{column}"
+        models.DB.execute_sql(f"""
+            CREATE TABLE {lookup} (
+                id smallserial PRIMARY KEY,
+                name character varying(255) NOT NULL UNIQUE
+            )
+        """)
+        models.DB.execute_sql(
+            f"INSERT INTO {lookup} (name) "
+            f"SELECT DISTINCT {column} FROM {TEXT_TABLE} ORDER BY 1"
+        )
+        select.append(f"{lookup}.id AS {column}_id")
+        joins.append(f"JOIN {lookup} ON {lookup}.name = text.{column}")
+
+    models.DB.execute_sql(f"""
+        CREATE TABLE {ENCODED_TABLE} AS
+        SELECT {', '.join(select)}, text.created
+        FROM {TEXT_TABLE} AS text {' '.join(joins)}
+        ORDER BY text.id
+    """)
+    models.DB.execute_sql(
+        f"ALTER TABLE {TEXT_TABLE} "
+        f"ALTER COLUMN agency TYPE character varying(255), "
+        f"ALTER COLUMN type TYPE character varying(255), "
+        f"ALTER COLUMN descriptor TYPE character varying(255), "
+        f"ALTER COLUMN borough TYPE character varying(255)"
+    )
+
+    for table, suffix in ((TEXT_TABLE, ''), (ENCODED_TABLE, '_id')):
+        models.DB.execute_sql(f"ALTER TABLE {table} ADD PRIMARY KEY (id)")
+        models.DB.execute_sql(f"CREATE INDEX ON {table} (created)")
+        models.DB.execute_sql(f"CREATE INDEX ON {table} (borough{suffix})")
+        models.DB.execute_sql(f"CREATE INDEX ON {table} (type{suffix})")
+        models.DB.execute_sql(f"VACUUM ANALYZE {table}")
+
+
+def sizes(table):
+    """``(table bytes, index bytes)``, counting the lookup tables if any."""
+    tables = [table]
+
+    if table == ENCODED_TABLE:
+        tables += [f"{ENCODED_TABLE}_{column}" for column, _, _ in COLUMNS]
+
+    heap, indexes = 0, 0
+
+    for name in tables:
+        row = models.DB.execute_sql(
+            "SELECT pg_table_size(%s), pg_indexes_size(%s)",
+            (name, name),
+        ).fetchone()
+        heap += row[0]
+        indexes += row[1]
+
+    return heap, indexes
+
+
+def timed(sql, repeat):
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        models.DB.execute_sql(sql).fetchall()
+        timings.append(time.perf_counter() - started)
+
+    return statistics.median(timings)
+
+
+def megabytes(size):
+    return f"{size / 1024 / 1024:.0f}"
+
+
+@click.command()
+@click.option('--rows', default=10000000, type=click.IntRange(min=1))
+@click.option('--repeat', default=5, type=click.IntRange(min=1))
+@click.option('--keep', is_flag=True, help="Don't drop the tables afterwards.")
+def main(rows, repeat, keep):
+    print(f"Building {rows} synthetic rows...")
+    build(rows)
+
+    try:
+        text = sizes(TEXT_TABLE)
+        encoded = sizes(ENCODED_TABLE)
+        print(tabulate.tabulate(
+            [
+                ('Table (MB)', megabytes(text[0]), megabytes(encoded[0]),
+                 f"{1 - encoded[0] / text[0]:.0%}"),
+                ('Indexes (MB)', megabytes(text[1]), megabytes(encoded[1]),
+                 f"{1 - encoded[1] / text[1]:.0%}"),
+            ],
+            headers=('', 'Text', 'Encoded', 'Reduction'),
+        ))
+        print()
+
+        results = []
+
+        for name, text_sql, encoded_sql in QUERIES:
+            text_seconds = timed(text_sql, repeat)
+            encoded_seconds = timed(encoded_sql, repeat)
+            results.append((
+                f"GROUP BY {name}",
+                f"{text_seconds * 1000:.0f}",
+                f"{encoded_seconds * 1000:.0f}",
+                f"{text_seconds / encoded_seconds:.2f}x",
+            ))
+
+        print(tabulate.tabulate(
+            results,
+            headers=('Query', 'Text ms', 'Encoded ms', 'Speedup'),
+        ))
+    finally:
+        if not keep:
+            drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compare the ``insert`` and ``copy`` 311 import paths.
+
+Each mode runs in a fresh subprocess so peak RSS is measured per mode. The
+``service_requests`` table is truncated before every run, so point
+``DATABASE`` at a scratch database before running this::
+
+    python -m benchmarks.import_service_requests path/to/311.csv
+
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import click
+import tabulate
+
+
+MODES = ('insert', 'copy')
+
+
+def measure(path, mode, commit_every):
+    """Import ``path`` with ``mode`` in this process and return the stats."""
+    import data_jam.models as models
+
+    models.DB.execute_sql(
+        f'TRUNCATE {models.ServiceRequest._meta.db_table} RESTART IDENTITY'
+    )
+
+    started = time.perf_counter()
+    rows = models.ServiceRequest.import_from_csv(
+        path,
+        mode=mode,
+        commit_every=commit_every,
+    )
+    elapsed = time.perf_counter() - started
+
+    return {
+        'mode': mode,
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed else 0,
+        # ru_maxrss is reported in kilobytes on Linux.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--commit-every', default=1000000, type=click.INT)
+@click.option('--run-mode', type=click.Choice(MODES), hidden=True)
+@click.option('--yes', is_flag=True, help="Don't ask before truncating.")
+def main(path, commit_every, run_mode, yes):
+    if run_mode:
+        print(json.dumps(measure(path, run_mode, commit_every)))
+        return
+
+    if not yes:
+        click.confirm(
+            "This truncates service_requests between runs. Continue?",
+            abort=True,
+        )
+
+    results = []
+
+    for mode in MODES:
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.import_service_requests',
+            path,
+            '--commit-every', str(commit_every),
+            '--run-mode', mode,
+        ])
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+    print(tabulate.tabulate(
+        [
+            (r['mode'], r['rows'], f"{r['seconds']:.1f}",
+             f"{r['rows_per_sec']:.0f}", f"{r['peak_rss_mb']:.0f}")
+            for r in results
+        ],
+        headers=('Mode', 'Rows', 'Seconds', 'Rows/sec', 'Peak RSS (MB)'),
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Time one ``count_by_day`` per storm against one ``count_by_day_many``.
+
+Every storm in the ``storms`` table becomes a window from ``--before`` days
+before it to ``--after`` days after it::
+
+    python -m benchmarks.multi_window --before 7 --after 14
+
+"""
+
+import datetime
+import statistics
+import time
+
+import click
+import tabulate
+
+import data_jam.cache as cache
+import data_jam.models as models
+
+
+def storm_windows(before, after):
+    days = sorted({
+        day for day, in models.Storm.select(models.Storm.date).distinct().tuples()
+    })
+
+    return [
+        (
+            datetime.datetime.combine(day - datetime.timedelta(days=before), datetime.time()),
+            datetime.datetime.combine(day + datetime.timedelta(days=after), datetime.time.max),
+        )
+        for day in days
+    ]
+
+
+def timed(func, repeat):
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+
+    return statistics.median(timings), result
+
+
+@click.command()
+@click.option('--before', default=7, type=click.IntRange(min=0))
+@click.option('--after', default=14, type=click.IntRange(min=0))
+@click.option('--repeat', default=3, type=click.IntRange(min=1))
+def main(before, after, repeat):
+    periods = storm_windows(before, after)
+    cache.CACHE.enabled = False
+    print(f"Counting {len(periods)} storm windows...")
+
+    one_by_one, expected = timed(
+        lambda: {
+            period: models.ServiceRequest.count_by_day(*period)
+            for period in periods
+        },
+        repeat,
+    )
+    batched, result = timed(
+        lambda: models.ServiceRequest.count_by_day_many(periods),
+        repeat,
+    )
+
+    if result != expected:
+        raise click.ClickException("The batched counts don't match.")
+
+    print(tabulate.tabulate(
+        [
+            ('One query per window', f"{one_by_one * 1000:.0f}"),
+            ('count_by_day_many', f"{batched * 1000:.0f}"),
+        ],
+        headers=('', 'ms'),
+    ))
+    print(f"Speedup: {one_by_one / batched:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Time ``happened_between`` counts on the partitioned ``service_requests``.
+
+To get a "before" number, pass ``--build-heap``. That copies the table into
+an unpartitioned ``benchmark_service_requests_heap`` with the same ``created``
+index the table had before migration 007, and runs every window against
+both::
+
+    python -m benchmarks.partition_pruning --build-heap
+
+"""
+
+import json
+import statistics
+import time
+
+import click
+import tabulate
+
+import data_jam.models as models
+
+
+HEAP_TABLE = 'benchmark_service_requests_heap'
+
+# Storm windows from the notebooks and the storms dataset.
+WINDOWS = (
+    ('Sandy', '2012-10-22 00:00:00', '2012-11-08 23:59:59'),
+    ('Irene', '2011-08-26 00:00:00', '2011-09-05 23:59:59'),
+    ('Nemo', '2013-02-07 00:00:00', '2013-02-14 23:59:59'),
+    ('Jonas', '2016-01-21 00:00:00', '2016-01-28 23:59:59'),
+    ('Jammin plot', '2011-10-22 00:00:00', '2013-11-08 23:59:59'),
+)
+
+
+def build_heap():
+    models.DB.execute_sql(f"DROP TABLE IF EXISTS {HEAP_TABLE}")
+    models.DB.execute_sql(
+        f"CREATE TABLE {HEAP_TABLE} AS "
+        f"SELECT * FROM {models.ServiceRequest._meta.db_table}"
+    )
+    models.DB.execute_sql(
+        f"CREATE INDEX {HEAP_TABLE}_created ON {HEAP_TABLE} (created)"
+    )
+    models.DB.execute_sql(f"ANALYZE {HEAP_TABLE}")
+
+
+def scanned_relations(plan):
+    """Collect the relation names a JSON ``EXPLAIN`` plan touches."""
+    found = set()
+
+    if 'Relation Name' in plan:
+        found.add(plan['Relation Name'])
+
+    for child in plan.get('Plans', ()):
+        found |= scanned_relations(child)
+
+    return found
+
+
+def measure(table, start, end, repeat):
+    sql = f"SELECT COUNT(*) FROM {table} WHERE created >= %s AND created <= %s"
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        calls = models.DB.execute_sql(sql, (start, end)).fetchone()[0]
+        timings.append(time.perf_counter() - started)
+
+    plan = models.DB.execute_sql(
+        f"EXPLAIN (FORMAT JSON) {sql}",
+        (start, end),
+    ).fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return {
+        'calls': calls,
+        'median_ms': statistics.median(timings) * 1000,
+        'relations': len(scanned_relations(plan[0]['Plan'])),
+    }
+
+
+@click.command()
+@click.option('--build-heap', 'heap', is_flag=True,
+              help="Also time an unpartitioned copy of the table.")
+@click.option('--repeat', default=5, type=click.INT)
+def main(heap, repeat):
+    tables = [models.ServiceRequest._meta.db_table]
+
+    if heap:
+        build_heap()
+        tables.insert(0, HEAP_TABLE)
+
+    rows = []
+
+    for name, start, end in WINDOWS:
+        for table in tables:
+            result = measure(table, start, end, repeat)
+            rows.append((
+                name,
+                table,
+                result['calls'],
+                result['relations'],
+                f"{result['median_ms']:.1f}",
+            ))
+
+    print(tabulate.tabulate(
+        rows,
+        headers=('Window', 'Table', 'Calls', 'Relations scanned', 'Median ms'),
+    ))
+
+
+if __name__ == '__main__':
+    main()
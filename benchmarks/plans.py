@@ -0,0 +1,714 @@
+"""EXPLAIN every model query method, catch plan regressions, suggest indexes.
+
+``run`` calls each of the ``cases`` once while recording the SQL it sends
+(including the ``COPY (SELECT ...)`` behind the NumPy fetches), then runs
+every statement again under ``EXPLAIN (ANALYZE, BUFFERS, VERBOSE)``. It
+records the plan shape, the shared buffers touched and the time of each
+case, and compares them to the baseline file. It exits with status 1 when a
+case starts scanning a big relation sequentially, or touches ``--threshold``
+more buffers or takes that much longer than in the baseline. With no
+baseline yet, or with ``--update``, the results become the new baseline::
+
+    python -m benchmarks.plans run --throwaway
+    python -m benchmarks.plans run --no-load --update
+
+The database is seeded like ``benchmarks.suite`` does (synthetic service
+requests, ``data/storms.csv`` and ``data/weather``), plus synthetic
+``events``. Either point ``DATABASE`` at a scratch database or pass
+``--throwaway``.
+
+The plans are also read for indexes that would help: BRIN for big
+sequential range scans over a column that follows the physical row order, a
+composite index when an index scan throws most of its rows away in a
+filter, and a covering ``INCLUDE`` index when an index scan only goes to the
+heap for a few columns, like the ``latitude`` and ``longitude`` of the
+heatmaps. ``--write-migration`` writes them to a new migration.
+
+"""
+
+import collections
+import collections.abc
+import contextlib
+import datetime
+import glob
+import json
+import os
+import re
+import statistics
+import sys
+
+import click
+import tabulate
+
+from benchmarks import suite, synthetic
+
+
+ROOT = suite.ROOT
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'plans_baseline.json')
+MIGRATIONS = os.path.join(ROOT, 'migrations')
+
+# A year that starts and ends in the middle of a day, so the edges of the
+# rollup paths get counted from the raw rows.
+PARTIAL_YEAR = (datetime.datetime(2015, 1, 1, 6), datetime.datetime(2015, 12, 31, 18))
+BROOKLYN = (40.6782, -73.9442)
+BROOKLYN_BBOX = (40.65, -73.97, 40.70, -73.92)
+
+# Partitions and their indexes are named after the table, like
+# ``service_requests_2015`` and ``service_requests_2015_created_idx``.
+PARTITION = re.compile(r'_(?:\d{4}|default)(?=_|$)')
+COPY = re.compile(r'^\s*COPY \((.*)\) TO STDOUT', re.DOTALL)
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+IDENTIFIER = re.compile(r'\b([a-z_][a-z0-9_]*)\b')
+
+# Buffers a case may grow by before it counts as a regression at all.
+MIN_BUFFERS = 128
+
+Suggestion = collections.namedtuple('Suggestion', (
+    'table',
+    'method',
+    'columns',
+    'include',
+    'reason',
+))
+
+
+def cases():
+    """``(name, call)`` pairs covering every query method of the models."""
+    import data_jam.models as models
+
+    request = models.ServiceRequest
+    storm = models.Storm
+    event = models.Event
+    in_month = request.select().where(request.happened_between(*suite.MONTH))
+    events = event.select().where(event.start_time.between(*suite.MONTH))
+    storm_windows = [
+        (
+            datetime.datetime.combine(day - datetime.timedelta(days=3), datetime.time()),
+            datetime.datetime.combine(day + datetime.timedelta(days=7), datetime.time.max),
+        )
+        for day in sorted({day for day, _ in synthetic.storm_days()})
+    ]
+
+    return [
+        ('ServiceRequest.happened_between',
+         lambda: request.select().where(request.happened_between(*suite.SANDY)).count()),
+        ('ServiceRequest.count_by_day', lambda: request.count_by_day(*suite.YEAR)),
+        ('ServiceRequest.count_by_day.edges',
+         lambda: request.count_by_day(*PARTIAL_YEAR)),
+        ('ServiceRequest.count_by_day_and_borough',
+         lambda: request.count_by_day_and_borough(*PARTIAL_YEAR)),
+        ('ServiceRequest.count_by_day_and_type',
+         lambda: request.count_by_day_and_type(*PARTIAL_YEAR)),
+        ('ServiceRequest.count_by_hour', lambda: request.count_by_hour(*suite.SANDY)),
+        ('ServiceRequest.count_by_hour_and_borough',
+         lambda: request.count_by_hour_and_borough(*suite.SANDY)),
+        ('ServiceRequest.count_by_day_many',
+         lambda: request.count_by_day_many(storm_windows)),
+        ('ServiceRequest.time_to_close', lambda: request.time_to_close(*PARTIAL_YEAR)),
+        ('ServiceRequest.time_to_close_by_day',
+         lambda: request.time_to_close_by_day(*PARTIAL_YEAR)),
+        ('ServiceRequest.time_to_close_by_borough',
+         lambda: request.time_to_close_by_borough(*PARTIAL_YEAR)),
+        ('ServiceRequest.time_to_close_by_agency',
+         lambda: request.time_to_close_by_agency(*PARTIAL_YEAR)),
+        ('ServiceRequest.time_to_close_by_day_and_borough',
+         lambda: request.time_to_close_by_day_and_borough(*PARTIAL_YEAR)),
+        ('ServiceRequest.heat_grid',
+         lambda: request.heat_grid(cell_size=0.01, start=PARTIAL_YEAR[0], end=PARTIAL_YEAR[1])),
+        ('ServiceRequest.heat_grid.query',
+         lambda: request.heat_grid(in_month, cell_size=0.01)),
+        ('ServiceRequest.lat_lngs', lambda: request.lat_lngs(in_month)),
+        ('ServiceRequest.near',
+         lambda: in_month.where(request.near(*BROOKLYN, 1000)).count()),
+        ('ServiceRequest.within_bbox',
+         lambda: in_month.where(request.within_bbox(*BROOKLYN_BBOX)).count()),
+        ('ServiceRequest.count_near_events',
+         lambda: request.count_near_events(events, 500)),
+        ('Storm.in_window', lambda: storm.in_window(*suite.YEAR)),
+        ('Storm.borough',
+         lambda: storm.select().where(storm.borough == 'BROOKLYN').count()),
+        ('Event.start_time', lambda: events.count()),
+        ('Weather.between',
+         lambda: models.Weather.between(suite.YEAR[0].date(), suite.YEAR[1].date())),
+    ]
+
+
+def seed_events(count):
+    """Replace ``events`` with ``count`` deterministic events around Brooklyn."""
+    import data_jam.models as models
+    from data_jam import spatial
+
+    models.DB.execute_sql("TRUNCATE events RESTART IDENTITY")
+    models.DB.execute_sql(
+        f"""
+        INSERT INTO events (short_description, start_time, end_time, borough,
+                            latitude, longitude, cell)
+        SELECT 'Synthetic event ' || n, start_time, start_time + interval '3 hours',
+               'BROOKLYN', latitude, longitude,
+               {spatial.CELL_GRID.cell_sql()}
+        FROM (
+            SELECT n,
+                   %s::timestamp + (n * 7919 %% %s) * interval '1 day'
+                       + (n %% 12 + 8) * interval '1 hour' AS start_time,
+                   (%s + ((n * 37 %% 1000) / 1000.0 - 0.5) * 0.1)::numeric(10, 8)
+                       AS latitude,
+                   (%s + ((n * 91 %% 1000) / 1000.0 - 0.5) * 0.1)::numeric(11, 8)
+                       AS longitude
+            FROM generate_series(1, %s) AS n
+        ) AS synthetic
+        """,
+        (
+            synthetic.FIRST_DAY,
+            (synthetic.LAST_DAY - synthetic.FIRST_DAY).days,
+            BROOKLYN[0],
+            BROOKLYN[1],
+            count,
+        ),
+    )
+
+
+def seed(rows, seed_value, data_dir, events):
+    import data_jam.models as models
+
+    path = synthetic.cached(data_dir, rows, seed_value)
+
+    print(f"Loading {rows} synthetic service requests...")
+    suite.truncate_service_requests()
+    models.ServiceRequest.import_from_csv(path, mode='copy')
+    models.DB.execute_sql("TRUNCATE storms RESTART IDENTITY")
+    models.Storm.import_from_csv(os.path.join(ROOT, 'data', 'storms.csv'))
+    models.DB.execute_sql("TRUNCATE weather RESTART IDENTITY")
+    models.Weather.import_from_csv([os.path.join(ROOT, 'data', 'weather')])
+    seed_events(events)
+    models.DB.execute_sql("VACUUM ANALYZE")
+
+
+@contextlib.contextmanager
+def recorded_statements():
+    """Yield a list that fills up with the ``SELECT``\\ s sent over ``models.DB``.
+
+    Statements are recorded with their parameters filled in, and a ``COPY``
+    of a query is recorded as the query.
+
+    """
+    import psycopg2.extensions
+
+    import data_jam.models as models
+
+    statements = []
+
+    def record(sql):
+        match = COPY.match(sql)
+
+        if match:
+            sql = match.group(1)
+
+        if sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append(sql)
+
+    class RecordingCursor(psycopg2.extensions.cursor):
+
+        def execute(self, sql, params=None):
+            record(self.mogrify(sql, params).decode('utf-8'))
+            return super().execute(sql, params)
+
+        def copy_expert(self, sql, file, size=8192):
+            record(sql)
+            return super().copy_expert(sql, file, size)
+
+    connection = models.DB.get_conn()
+    connection.cursor_factory = RecordingCursor
+
+    try:
+        yield statements
+    finally:
+        connection.cursor_factory = psycopg2.extensions.cursor
+
+
+def explain(sql):
+    """The ``EXPLAIN (ANALYZE, BUFFERS, VERBOSE)`` JSON of ``sql``.
+
+    Runs in a transaction that's rolled back, in case ``sql`` writes.
+
+    """
+    import data_jam.models as models
+
+    with models.DB.atomic() as transaction:
+        with models.DB.get_conn().cursor() as cursor:
+            # No parameters, so a literal ``%`` in ``sql`` stays as it is.
+            cursor.execute(
+                f"EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) {sql}"
+            )
+            plan = cursor.fetchone()[0]
+
+        transaction.rollback()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]
+
+
+def table_of(relation):
+    return PARTITION.sub('', relation)
+
+
+def nodes(plan):
+    yield plan
+
+    for child in plan.get('Plans', ()):
+        yield from nodes(child)
+
+
+def shape(plan):
+    """Compact plan tree, with partitions folded into their table.
+
+    ``Append(Index Only Scan on service_requests x3)`` means three
+    partitions were scanned.
+
+    """
+    label = plan['Node Type']
+
+    if 'Relation Name' in plan:
+        label += f" on {table_of(plan['Relation Name'])}"
+
+    if 'Index Name' in plan:
+        label += f" using {table_of(plan['Index Name'])}"
+
+    children = []
+
+    for child in map(shape, plan.get('Plans', ())):
+        if children and children[-1][0] == child:
+            children[-1][1] += 1
+        else:
+            children.append([child, 1])
+
+    if not children:
+        return label
+
+    return label + '(' + ', '.join(
+        child if count == 1 else f"{child} x{count}"
+        for child, count in children
+    ) + ')'
+
+
+def rows_scanned(node):
+    return (
+        (node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)) *
+        node.get('Actual Loops', 1)
+    )
+
+
+def summarize(plan, seq_scan_rows):
+    """Shape, buffers, time and big sequential scans of one statement."""
+    root = plan['Plan']
+    seq_scans = collections.Counter()
+
+    for node in nodes(root):
+        if node['Node Type'] == 'Seq Scan' and rows_scanned(node) >= seq_scan_rows:
+            seq_scans[table_of(node['Relation Name'])] += rows_scanned(node)
+
+    return {
+        'shape': shape(root),
+        'buffers': root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0),
+        'ms': plan.get('Planning Time', 0) + plan.get('Execution Time', 0),
+        'seq_scans': dict(seq_scans),
+    }
+
+
+def measure(call, repeat, seq_scan_rows):
+    """Run ``call`` and EXPLAIN what it sent. Returns ``(summary, plans)``."""
+    with recorded_statements() as statements:
+        result = call()
+
+        # Some methods return lazy iterators over their query.
+        if isinstance(result, collections.abc.Iterator):
+            list(result)
+
+    summaries = []
+    plans = []
+
+    for sql in statements:
+        timings = []
+
+        for _ in range(repeat):
+            plan = explain(sql)
+            timings.append(plan.get('Planning Time', 0) + plan.get('Execution Time', 0))
+
+        summary = summarize(plan, seq_scan_rows)
+        summary['ms'] = statistics.median(timings)
+        summary['sql'] = ' '.join(sql.split())[:500]
+        summaries.append(summary)
+        plans.append(plan)
+
+    seq_scans = collections.Counter()
+
+    for summary in summaries:
+        seq_scans.update(summary['seq_scans'])
+
+    return {
+        'buffers': sum(summary['buffers'] for summary in summaries),
+        'ms': sum(summary['ms'] for summary in summaries),
+        'seq_scans': dict(seq_scans),
+        'statements': summaries,
+    }, plans
+
+
+def regressions(baseline, results, threshold, min_ms):
+    """``(problems, notes)`` from comparing ``results`` to ``baseline``."""
+    problems = []
+    notes = []
+
+    for name, result in results.items():
+        before = baseline.get(name)
+
+        if before is None:
+            notes.append(f"{name} is new.")
+            continue
+
+        for relation in sorted(set(result['seq_scans']) - set(before['seq_scans'])):
+            problems.append(
+                f"{name} now scans {relation} sequentially "
+                f"({result['seq_scans'][relation]} rows)."
+            )
+
+        if (result['buffers'] > before['buffers'] * (1 + threshold) and
+                result['buffers'] - before['buffers'] > MIN_BUFFERS):
+            problems.append(
+                f"{name} touches {result['buffers']} buffers, "
+                f"up from {before['buffers']}."
+            )
+
+        if (result['ms'] > before['ms'] * (1 + threshold) and
+                result['ms'] - before['ms'] > min_ms):
+            problems.append(
+                f"{name} takes {result['ms']:.1f} ms, up from {before['ms']:.1f} ms."
+            )
+
+        if ([statement['shape'] for statement in result['statements']] !=
+                [statement['shape'] for statement in before['statements']]):
+            notes.append(f"{name} has a different plan.")
+
+    return problems, notes
+
+
+class Catalog(object):
+    """Columns, indexes and physical ordering of tables, looked up once each."""
+
+    def __init__(self):
+        self._tables = {}
+
+    def __getitem__(self, table):
+        if table not in self._tables:
+            self._tables[table] = self._load(table)
+
+        return self._tables[table]
+
+    @staticmethod
+    def _load(table):
+        import data_jam.models as models
+
+        columns = [
+            row[0]
+            for row in models.DB.execute_sql(
+                "SELECT attname FROM pg_attribute "
+                "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped "
+                "ORDER BY attnum",
+                (table,),
+            )
+        ]
+        indexes = [
+            row[0]
+            for row in models.DB.execute_sql(
+                "SELECT indexdef FROM pg_indexes WHERE tablename = %s",
+                (table,),
+            )
+        ]
+        # Partitions have the statistics, the partitioned table doesn't.
+        correlation = dict(models.DB.execute_sql(
+            r"""
+            SELECT attname, AVG(ABS(correlation))
+            FROM pg_stats
+            WHERE tablename = %s OR tablename ~ ('^' || %s || '_(\d{4}|default)$')
+            GROUP BY attname
+            """,
+            (table, table),
+        ).fetchall())
+
+        return {'columns': columns, 'indexes': indexes, 'correlation': correlation}
+
+
+def columns_in(expression, columns):
+    """Columns of the table mentioned in a plan condition or output, in order."""
+    names = IDENTIFIER.findall(LITERAL.sub('', expression or ''))
+
+    return list(dict.fromkeys(name for name in names if name in columns))
+
+
+def compared_with_equality(column, expression):
+    return re.search(rf'\b{column}\)* = ', LITERAL.sub('', expression or '')) is not None
+
+
+def advise(plans, catalog, seq_scan_rows):
+    """``Suggestion``\\ s for the scans in ``plans``."""
+    suggestions = []
+
+    for plan in plans:
+        for node in nodes(plan['Plan']):
+            if 'Relation Name' not in node:
+                continue
+
+            table = table_of(node['Relation Name'])
+            info = catalog[table]
+            rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+            removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+            filtered = columns_in(node.get('Filter'), info['columns'])
+            condition = node.get('Index Cond') or node.get('Recheck Cond')
+            keys = columns_in(condition, info['columns'])
+
+            if node['Node Type'] == 'Seq Scan':
+                if rows_scanned(node) < seq_scan_rows or not filtered:
+                    continue
+
+                ordered = [
+                    column for column in filtered
+                    if info['correlation'].get(column, 0) >= 0.9
+                    and not compared_with_equality(column, node['Filter'])
+                ]
+
+                if ordered:
+                    suggestions.append(Suggestion(
+                        table, 'brin', tuple(ordered[:1]), (),
+                        f"range scan over {ordered[0]}, which follows the row order",
+                    ))
+                else:
+                    suggestions.append(Suggestion(
+                        table, 'btree', tuple(filtered[:3]), (),
+                        f"sequential scan filtering on {', '.join(filtered)}",
+                    ))
+            elif keys and removed > max(rows, seq_scan_rows // 10):
+                extra = [column for column in filtered if column not in keys]
+                equal = [
+                    column for column in keys + extra
+                    if compared_with_equality(column, condition)
+                    or compared_with_equality(column, node.get('Filter'))
+                ]
+                ranged = [column for column in keys + extra if column not in equal]
+                suggestions.append(Suggestion(
+                    table, 'btree', tuple((equal + ranged)[:3]), (),
+                    f"index scan on {', '.join(keys)} drops {removed} rows "
+                    f"filtering on {', '.join(extra)}",
+                ))
+            elif (keys and rows >= seq_scan_rows and
+                    node['Node Type'] in ('Index Scan', 'Bitmap Heap Scan')):
+                output = columns_in(' '.join(node.get('Output', ())), info['columns'])
+                include = [column for column in output if column not in keys]
+
+                if 0 < len(include) <= 3:
+                    suggestions.append(Suggestion(
+                        table, 'btree', tuple(keys[:2]), tuple(include),
+                        f"{rows} heap fetches for {', '.join(include)}",
+                    ))
+
+    return [
+        suggestion for suggestion in dict.fromkeys(suggestions)
+        if not exists(suggestion, catalog[suggestion.table]['indexes'])
+    ]
+
+
+def index_name(suggestion):
+    name = f"{suggestion.table}_{'_'.join(suggestion.columns)}"
+
+    if suggestion.method != 'btree':
+        name += f'_{suggestion.method}'
+
+    if suggestion.include:
+        name += '_covering'
+
+    return name
+
+
+def index_definition(suggestion):
+    definition = f"USING {suggestion.method} ({', '.join(suggestion.columns)})"
+
+    if suggestion.include:
+        definition += f" INCLUDE ({', '.join(suggestion.include)})"
+
+    return definition
+
+
+def exists(suggestion, indexes):
+    return any(indexdef.endswith(index_definition(suggestion)) for indexdef in indexes)
+
+
+def migration(suggestions):
+    """``(path, source)`` of a new migration that creates ``suggestions``."""
+    paths = sorted(glob.glob(os.path.join(MIGRATIONS, '[0-9][0-9][0-9]_*.py')))
+    number = int(os.path.basename(paths[-1])[:3]) + 1
+    name = f"{number:03d}_SuggestedIndexes.py"
+
+    with open(paths[-1], encoding='utf-8') as migration_file:
+        previous = migration_file.read()
+
+    # Same docstring and imports as every other migration.
+    header = previous[:previous.index('\n\n\ndef migrate')]
+    header = header.replace(os.path.basename(paths[-1]), name, 1)
+    creates = '\n'.join(
+        f"CREATE INDEX {index_name(suggestion)} ON {suggestion.table} "
+        f"{index_definition(suggestion)};"
+        for suggestion in suggestions
+    )
+    drops = '\n'.join(
+        f"DROP INDEX {index_name(suggestion)};" for suggestion in suggestions
+    )
+    reasons = '\n'.join(
+        f"    # {index_name(suggestion)}: {suggestion.reason}."
+        for suggestion in suggestions
+    )
+    source = f'''{header}
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    # Suggested by benchmarks.plans:
+{reasons}
+    migrator.sql("""
+{creates}
+    """)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("""
+{drops}
+    """)
+'''
+
+    return os.path.join(MIGRATIONS, name), source
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--size', default='100k', type=click.Choice(suite.SIZES))
+@click.option('--rows', type=click.IntRange(min=1), help="Overrides --size.")
+@click.option('--seed', 'seed_value', default=0, type=click.INT)
+@click.option('--events', default=5000, type=click.IntRange(min=0),
+              help="Synthetic events to seed.")
+@click.option('--no-load', is_flag=True,
+              help="Use the data that's already in the database.")
+@click.option('--repeat', default=3, type=click.IntRange(min=1),
+              help="How many times to EXPLAIN ANALYZE every statement.")
+@click.option('--baseline', default=DEFAULT_BASELINE, type=click.Path(dir_okay=False))
+@click.option('--update', is_flag=True, help="Save the results as the new baseline.")
+@click.option('--threshold', default=0.5, type=click.FloatRange(min=0),
+              help="Flag cases this much slower or heavier (0.5 = 50%).")
+@click.option('--min-ms', default=5.0, type=click.FloatRange(min=0),
+              help="Ignore slowdowns smaller than this many milliseconds.")
+@click.option('--seq-scan-rows', default=10000, type=click.IntRange(min=1),
+              help="Sequential scans of fewer rows than this are fine.")
+@click.option('--write-migration', is_flag=True,
+              help="Write the suggested indexes to a new migration.")
+@click.option('--data-dir', default=os.path.join(ROOT, 'benchmarks', 'data'),
+              type=click.Path(file_okay=False),
+              help="Where to keep the generated CSV files.")
+@click.option('--throwaway', is_flag=True,
+              help="Run against a new postgres:12 Docker container.")
+@click.option('--yes', is_flag=True, help="Don't ask before truncating.")
+def run(size, rows, seed_value, events, no_load, repeat, baseline, update,
+        threshold, min_ms, seq_scan_rows, write_migration, data_dir, throwaway,
+        yes):
+    """EXPLAIN the query methods and compare the plans to the baseline."""
+    rows = rows or suite.SIZES[size]
+
+    if throwaway and no_load:
+        raise click.UsageError("--throwaway needs to load data.")
+
+    if not throwaway and not no_load and not yes:
+        click.confirm(
+            "This truncates service_requests, storms, weather and events. Continue?",
+            abort=True,
+        )
+
+    with contextlib.ExitStack() as stack:
+        from data_jam import cache, db
+
+        if throwaway:
+            db.configure(stack.enter_context(suite.throwaway_postgres()))
+
+        import data_jam.models as models
+
+        if throwaway:
+            models.migration_router().run()
+
+        if not no_load:
+            seed(rows, seed_value, data_dir, events)
+
+        cache.CACHE.enabled = False
+        results = {}
+        plans = []
+
+        for name, call in cases():
+            print(f"Explaining {name}...")
+            results[name], case_plans = measure(call, repeat, seq_scan_rows)
+            plans.extend(case_plans)
+
+        suggestions = advise(plans, Catalog(), seq_scan_rows)
+
+    print(tabulate.tabulate(
+        [
+            (name, len(result['statements']), result['buffers'],
+             f"{result['ms']:.1f}", ', '.join(sorted(result['seq_scans'])))
+            for name, result in results.items()
+        ],
+        headers=('Case', 'Statements', 'Buffers', 'ms', 'Seq scans'),
+    ))
+
+    if suggestions:
+        print()
+        print(tabulate.tabulate(
+            [
+                (f"CREATE INDEX ON {suggestion.table} {index_definition(suggestion)}",
+                 suggestion.reason)
+                for suggestion in suggestions
+            ],
+            headers=('Suggested index', 'Because of'),
+        ))
+
+        if write_migration:
+            path, source = migration(suggestions)
+
+            with open(path, 'w', encoding='utf-8') as migration_file:
+                migration_file.write(source)
+
+            print(f"Wrote {path}.")
+
+    if update or not os.path.exists(baseline):
+        with open(baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+        print(f"Saved the plans to {baseline}.")
+        return
+
+    with open(baseline) as baseline_file:
+        problems, notes = regressions(json.load(baseline_file), results, threshold, min_ms)
+
+    print()
+
+    for note in notes:
+        print(note)
+
+    for problem in problems:
+        print(f"REGRESSED: {problem}")
+
+    if problems:
+        sys.exit(1)
+
+    print("No plan regressions.")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,125 @@
+"""Check that a cold ``import data_jam.models`` stays fast.
+
+Imports each module in a fresh interpreter under ``python -X importtime``
+and fails (exit status 1) if the median cumulative import time is over
+``--budget`` milliseconds, or if any of the ``HEAVY`` dependencies got
+imported along the way. Those are only meant to load inside the functions
+that use them::
+
+    python -m benchmarks.startup --budget 300
+
+"""
+
+import collections
+import os
+import statistics
+import subprocess
+import sys
+
+import click
+import tabulate
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('data_jam.models', 'manage')
+HEAVY = (
+    'aiohttp',
+    'bs4',
+    'dateutil',
+    'geocoder',
+    'numpy',
+    'peewee_migrate',
+    'pyarrow',
+    'requests',
+    'tabulate',
+)
+
+Timing = collections.namedtuple('Timing', ('module', 'self_us', 'cumulative_us'))
+
+
+def import_times(module):
+    """``Timing`` for every module a cold ``import module`` loads."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    timings = []
+
+    # Lines look like "import time:  self [us] | cumulative | imported package".
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+
+        try:
+            timings.append(Timing(
+                fields[2].strip(),
+                int(fields[0]),
+                int(fields[1]),
+            ))
+        except ValueError:
+            continue  # The header line.
+
+    if result.returncode:
+        raise click.ClickException(
+            f"import {module} failed:\n{result.stderr.decode('utf-8')[-2000:]}"
+        )
+
+    return timings
+
+
+@click.command()
+@click.option('--budget', default=300, type=click.IntRange(min=1),
+              help="Milliseconds a cold import may take.")
+@click.option('--runs', default=5, type=click.IntRange(min=1))
+@click.option('--top', default=10, type=click.IntRange(min=0),
+              help="How many of the slowest modules to list.")
+def main(budget, runs, top):
+    failed = False
+
+    for module in MODULES:
+        totals = []
+
+        for _ in range(runs):
+            timings = import_times(module)
+            totals.append(next(
+                timing.cumulative_us for timing in timings
+                if timing.module == module
+            ))
+
+        median_ms = statistics.median(totals) / 1000
+        heavy = sorted({
+            timing.module for timing in timings
+            if timing.module.split('.')[0] in HEAVY
+        })
+
+        print(f"import {module}: {median_ms:.0f} ms (budget {budget} ms)")
+
+        if top:
+            print(tabulate.tabulate(
+                [
+                    (timing.module, f"{timing.self_us / 1000:.1f}")
+                    for timing in sorted(timings, key=lambda t: -t.self_us)[:top]
+                ],
+                headers=('Module', 'Self ms'),
+            ))
+            print()
+
+        if median_ms > budget:
+            print(f"FAIL: import {module} is over budget.")
+            failed = True
+
+        if heavy:
+            print(f"FAIL: import {module} loaded {', '.join(heavy)}.")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
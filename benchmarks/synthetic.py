@@ -0,0 +1,260 @@
+"""Deterministic, 311-shaped CSVs for the benchmarks.
+
+The same ``rows`` and ``seed`` always produce the same file. Calls are spread
+over 2010-01-01 to 2017-09-30 (the span of ``data/weather``) with a weekly
+and a seasonal cycle and slow growth, boroughs and complaint types are skewed
+like the real data, and every storm in ``data/storms.csv`` adds a burst of
+storm-related calls in its borough that fades over the following week, so
+``impact`` and the storm windows have something to find::
+
+    python -m benchmarks.synthetic --rows 1000000 311-1m.csv
+
+"""
+
+import csv
+import datetime
+import os
+
+import click
+import numpy
+
+
+FIRST_DAY = datetime.date(2010, 1, 1)
+LAST_DAY = datetime.date(2017, 9, 30)
+CHUNK_SIZE = 1000000
+STORMS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'data', 'storms.csv',
+)
+
+HEADER = (
+    'Unique Key', 'Created Date', 'Closed Date', 'Agency', 'Complaint Type',
+    'Descriptor', 'Borough', 'Latitude', 'Longitude',
+)
+
+# (borough, share of calls, latitude, longitude, spread in degrees)
+BOROUGHS = (
+    ('BROOKLYN', 0.30, 40.6782, -73.9442, 0.035),
+    ('QUEENS', 0.23, 40.7282, -73.7949, 0.045),
+    ('MANHATTAN', 0.20, 40.7831, -73.9712, 0.025),
+    ('BRONX', 0.17, 40.8448, -73.8648, 0.025),
+    ('STATEN ISLAND', 0.05, 40.5795, -74.1502, 0.030),
+    ('Unspecified', 0.05, None, None, None),
+)
+
+# (complaint type, agency, descriptors, storm related), most common first.
+TYPES = (
+    ('HEAT/HOT WATER', 'HPD', ('ENTIRE BUILDING', 'APARTMENT ONLY'), False),
+    ('Noise - Residential', 'NYPD',
+     ('Loud Music/Party', 'Banging/Pounding', 'Loud Talking'), False),
+    ('Street Condition', 'DOT',
+     ('Pothole', 'Cave-in', 'Failed Street Repair'), True),
+    ('Blocked Driveway', 'NYPD', ('No Access', 'Partial Access'), False),
+    ('Illegal Parking', 'NYPD',
+     ('Double Parked Blocking Traffic', 'Blocked Hydrant'), False),
+    ('Street Light Condition', 'DOT',
+     ('Street Light Out', 'Lamppost Damaged'), True),
+    ('Water System', 'DEP',
+     ('Hydrant Running (WC3)', 'No Water (WNW)', 'Leak (Use Comments) (WA2)'), True),
+    ('PLUMBING', 'HPD', ('WATER-SUPPLY', 'LEAK'), False),
+    ('Sanitation Condition', 'DSNY', ('Garbage or Litter',), False),
+    ('Damaged Tree', 'DPR',
+     ('Branch Cracked and Will Fall', 'Tree Leaning/Uprooted',
+      'Entire Tree Has Fallen Down'), True),
+    ('Sewer', 'DEP',
+     ('Catch Basin Clogged/Flooding (Use Comments) (SC)',
+      'Sewer Backup (Use Comments) (SA)'), True),
+    ('Noise - Street/Sidewalk', 'NYPD', ('Loud Music/Party', 'Loud Talking'), False),
+    ('Rodent', 'DOHMH', ('Rat Sighting', 'Mouse Sighting'), False),
+    ('Derelict Vehicle', 'DSNY', ('With License Plate',), False),
+    ('Snow', 'DSNY', ('Snow Removal',), True),
+    ('Overgrown Tree/Branches', 'DPR', ('Hitting Building', 'Blocking Street'), True),
+)
+
+# Relative number of calls per hour of the day.
+HOURS = numpy.array([
+    2, 1.5, 1, 0.8, 0.7, 0.8, 1.5, 3, 5, 6, 6.5, 6.5,
+    6.5, 6, 6, 5.5, 5, 4.5, 4, 3.5, 3.5, 3.5, 3, 2.5,
+])
+
+# Storm counties, as in ``Storm.COUNTY_BOROUGH_MAPPING``.
+COUNTIES = {
+    'BRONX': 'BRONX',
+    'KINGS': 'BROOKLYN',
+    'NEW YORK': 'MANHATTAN',
+    'QUEENS': 'QUEENS',
+    'NORTHERN QUEENS': 'QUEENS',
+    'SOUTHERN QUEENS': 'QUEENS',
+    'RICHMOND': 'STATEN ISLAND',
+}
+
+
+def storm_days(path=STORMS_PATH):
+    """``(date, borough)`` for every storm in ``data/storms.csv``."""
+    days = []
+
+    with open(path, encoding='utf-8', newline='') as file_obj:
+        for row in csv.DictReader(file_obj):
+            county = row['county'].split(' (')[0].replace(' CO.', '')
+            borough = COUNTIES.get(county)
+
+            if borough:
+                day = datetime.datetime.strptime(row['date'], '%m/%d/%Y').date()
+                days.append((day, borough))
+
+    return days
+
+
+def day_weights(storms, storm_boost=1.5, storm_days_after=7):
+    """``(base, storm)`` call weights per ``(day, borough)``.
+
+    ``storm`` is the extra load storms add on top of ``base``.
+
+    """
+    days = numpy.arange(
+        numpy.datetime64(FIRST_DAY),
+        numpy.datetime64(LAST_DAY) + 1,
+    )
+    weekday = (days.astype('int64') + 3) % 7
+    weekly = numpy.where(weekday == 5, 0.8, numpy.where(weekday == 6, 0.7, 1.0))
+    day_of_year = (days - days.astype('datetime64[Y]')).astype('int64')
+    seasonal = 1 + 0.25 * numpy.cos(2 * numpy.pi * (day_of_year - 15) / 365.25)
+    growth = 1 + 0.05 * (days - days[0]).astype('int64') / 365.25
+    shares = numpy.array([share for _, share, _, _, _ in BOROUGHS])
+    base = (weekly * seasonal * growth)[:, None] * shares[None, :]
+
+    names = [name for name, _, _, _, _ in BOROUGHS]
+    storm = numpy.zeros_like(base)
+    decay = storm_boost * numpy.exp(-numpy.arange(storm_days_after) / 2)
+
+    for day, borough in set(storms):
+        offset = (numpy.datetime64(day) - days[0]).astype('int64')
+
+        if 0 <= offset < len(days):
+            span = slice(offset, min(offset + storm_days_after, len(days)))
+            column = names.index(borough)
+            storm[span, column] += base[span, column] * decay[:span.stop - span.start]
+
+    return days, base, storm
+
+
+def type_weights(storm):
+    """Zipf-like weights over ``TYPES``, or only the storm types if ``storm``."""
+    weights = 1 / (numpy.arange(len(TYPES)) + 1) ** 0.8
+
+    if storm:
+        weights *= numpy.array([related for _, _, _, related in TYPES])
+
+    return weights / weights.sum()
+
+
+def format_times(values):
+    """``MM/DD/YYYY hh:mm:ss AM`` strings, like the 311 export, or ``''``."""
+    return [
+        value.item().strftime('%m/%d/%Y %I:%M:%S %p') if not numpy.isnat(value) else ''
+        for value in values
+    ]
+
+
+def chunk(rng, size, days, base, storm, first_key):
+    """``size`` rows as CSV-ready columns."""
+    weights = numpy.concatenate([base.ravel(), storm.ravel()])
+    picks = rng.choice(len(weights), size=size, p=weights / weights.sum())
+    is_storm = picks >= base.size
+    cells = numpy.where(is_storm, picks - base.size, picks)
+    day_idx, borough_idx = numpy.divmod(cells, base.shape[1])
+
+    types = numpy.where(
+        is_storm,
+        rng.choice(len(TYPES), size=size, p=type_weights(True)),
+        rng.choice(len(TYPES), size=size, p=type_weights(False)),
+    )
+    descriptor_picks = rng.random(size)
+
+    # Lots of real calls are logged at exactly midnight.
+    seconds = (
+        rng.choice(24, size=size, p=HOURS / HOURS.sum()) * 3600 +
+        rng.integers(0, 3600, size=size)
+    )
+    seconds[rng.random(size) < 0.1] = 0
+    created = (
+        days[day_idx].astype('datetime64[s]') +
+        seconds.astype('timedelta64[s]')
+    )
+    durations = numpy.exp(rng.normal(numpy.log(2 * 86400), 1.5, size=size))
+    closed = created + durations.astype('int64').astype('timedelta64[s]')
+    closed[rng.random(size) < 0.08] = numpy.datetime64('NaT')
+
+    latitudes = numpy.full(size, numpy.nan)
+    longitudes = numpy.full(size, numpy.nan)
+
+    for idx, (_, _, latitude, longitude, spread) in enumerate(BOROUGHS):
+        mask = borough_idx == idx
+
+        if latitude is not None:
+            latitudes[mask] = rng.normal(latitude, spread, mask.sum())
+            longitudes[mask] = rng.normal(longitude, spread, mask.sum())
+
+    latitudes[rng.random(size) < 0.03] = numpy.nan
+    coordinates = [
+        ('', '') if numpy.isnan(latitude) else (f'{latitude:.8f}', f'{longitude:.8f}')
+        for latitude, longitude in zip(latitudes, longitudes)
+    ]
+
+    return zip(
+        range(first_key, first_key + size),
+        format_times(created),
+        format_times(closed),
+        (TYPES[idx][1] for idx in types),
+        (TYPES[idx][0] for idx in types),
+        (
+            TYPES[idx][2][int(pick * len(TYPES[idx][2]))]
+            for idx, pick in zip(types, descriptor_picks)
+        ),
+        (BOROUGHS[idx][0] for idx in borough_idx),
+        (latitude for latitude, _ in coordinates),
+        (longitude for _, longitude in coordinates),
+    )
+
+
+def generate(path, rows, seed=0, storms_path=STORMS_PATH, first_key=10000000):
+    """Write ``rows`` synthetic service requests to ``path``."""
+    rng = numpy.random.default_rng(seed)
+    days, base, storm = day_weights(storm_days(storms_path))
+    written = 0
+
+    with open(path, 'w', encoding='utf-8', newline='') as file_obj:
+        writer = csv.writer(file_obj)
+        writer.writerow(HEADER)
+
+        while written < rows:
+            size = min(CHUNK_SIZE, rows - written)
+            writer.writerows(chunk(rng, size, days, base, storm, first_key + written))
+            written += size
+
+    return written
+
+
+def cached(directory, rows, seed=0):
+    """Path to the file for ``rows`` and ``seed`` in ``directory``, generating it if needed."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'311-{rows}-{seed}.csv')
+
+    if not os.path.exists(path):
+        partial = f'{path}.partial'
+        generate(partial, rows, seed)
+        os.replace(partial, path)
+
+    return path
+
+
+@click.command()
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--rows', default=100000, type=click.IntRange(min=1))
+@click.option('--seed', default=0, type=click.INT)
+def main(path, rows, seed):
+    generate(path, rows, seed)
+    print(f"Wrote {rows} synthetic service requests to {path}.")
+
+
+if __name__ == '__main__':
+    main()
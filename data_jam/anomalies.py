@@ -0,0 +1,311 @@
+"""Flag days with unusually many 311 calls for a borough and complaint type.
+
+Every ``(borough, type)`` series keeps an exponentially weighted mean and
+variance of its daily calls for each day of the week, so the baseline follows
+the weekly cycle and drifts along with the seasons. A day is flagged when its
+calls are more than ``threshold`` standard deviations above the baseline for
+that weekday. Flagged days are only learned up to the threshold, so a week of
+storm calls doesn't become the new normal.
+
+The baselines are NumPy arrays saved to a small ``.npz`` file and updated
+incrementally. A run only reads the days of ``service_request_daily_counts``
+after the last one it saw, so a daily run costs the same no matter how many
+years of history are behind it. Changing the parameters, or the rollups
+ending before the saved state does (a rebuild after a truncate), starts over
+from the first day.
+
+Days are final once they've been learned, so don't run this before a day's
+calls are all imported, or pass ``through`` to stop at the day before.
+
+"""
+
+import collections
+import datetime
+import json
+import os
+
+import numpy
+
+import data_jam.models as models
+from data_jam import windows
+
+
+DEFAULT_STATE_PATH = os.environ.get(
+    'ANOMALY_STATE',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), '.anomaly_state.npz'),
+)
+
+Anomaly = collections.namedtuple('Anomaly', (
+    'day',
+    'borough',
+    'type',
+    'calls',
+    'expected',
+    'score',
+    'storms',
+    'weather',
+    'precipitation',
+))
+
+# (name, dtype) of the columns of ``Baselines.flagged`` in the state file.
+FLAGGED = (
+    ('day', 'datetime64[D]'),
+    ('series', 'int64'),
+    ('calls', 'float64'),
+    ('expected', 'float64'),
+    ('score', 'float64'),
+)
+
+
+class Baselines(object):
+    """Per-weekday EWMA baselines of every series and the days flagged so far.
+
+    ``alpha`` is the weight of a new day. Each weekday is learned on its own,
+    so the default of 0.1 remembers roughly the last ten weeks. A series
+    needs ``warmup`` days of a weekday before that weekday can be flagged,
+    and a flagged day needs at least ``min_excess`` calls over the baseline,
+    so a quiet series going from 0 to 3 calls isn't an anomaly.
+
+    ``keys`` lists the ``(borough, type)`` of every series, in the order of
+    the rows of ``mean``, ``var`` and ``seen``. ``flagged`` holds
+    ``(day, series, calls, expected, score)`` tuples.
+
+    """
+
+    def __init__(self, alpha=0.1, threshold=4.0, warmup=8, min_excess=10):
+        self.params = {
+            'alpha': alpha,
+            'threshold': threshold,
+            'warmup': warmup,
+            'min_excess': min_excess,
+        }
+        self.last_day = None
+        self.keys = []
+        self.index = {}
+        self.mean = numpy.zeros((0, 7))
+        self.var = numpy.zeros((0, 7))
+        self.seen = numpy.zeros((0, 7), dtype='int64')
+        self.flagged = []
+
+    @classmethod
+    def load(cls, path, **params):
+        """The baselines saved in ``path``, or new ones if there are none.
+
+        Saved baselines learned with different ``params`` are ignored.
+
+        """
+        baselines = cls(**params)
+
+        try:
+            data = numpy.load(path)
+        except (OSError, ValueError):
+            return baselines
+
+        with data:
+            if json.loads(str(data['params'])) != baselines.params:
+                return baselines
+
+            last_day = data['last_day']
+            baselines.last_day = None if numpy.isnat(last_day) else last_day.item()
+            baselines.keys = list(zip(data['boroughs'].tolist(), data['types'].tolist()))
+            baselines.index = {key: idx for idx, key in enumerate(baselines.keys)}
+            baselines.mean = data['mean']
+            baselines.var = data['var']
+            baselines.seen = data['seen']
+            baselines.flagged = list(zip(*[
+                data[f'flagged_{name}'].tolist() for name, _ in FLAGGED
+            ]))
+
+        return baselines
+
+    def save(self, path):
+        flagged = list(zip(*self.flagged)) or [()] * len(FLAGGED)
+        partial = f"{path}.partial"
+
+        with open(partial, 'wb') as state_file:
+            numpy.savez(
+                state_file,
+                params=numpy.array(json.dumps(self.params, sort_keys=True)),
+                last_day=numpy.datetime64(self.last_day or 'NaT', 'D'),
+                boroughs=numpy.array([borough for borough, _ in self.keys], dtype=str),
+                types=numpy.array([type_ for _, type_ in self.keys], dtype=str),
+                mean=self.mean,
+                var=self.var,
+                seen=self.seen,
+                **{
+                    f'flagged_{name}': numpy.array(column, dtype=dtype)
+                    for (name, dtype), column in zip(FLAGGED, flagged)
+                },
+            )
+
+        os.replace(partial, path)
+
+    def series(self, keys):
+        """Row indices for ``(borough, type)`` keys, adding new series as needed."""
+        new = [key for key in dict.fromkeys(keys) if key not in self.index]
+
+        if new:
+            for key in new:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+
+            self.mean = numpy.vstack([self.mean, numpy.zeros((len(new), 7))])
+            self.var = numpy.vstack([self.var, numpy.zeros((len(new), 7))])
+            self.seen = numpy.vstack([
+                self.seen,
+                numpy.zeros((len(new), 7), dtype=self.seen.dtype),
+            ])
+
+        return numpy.array([self.index[key] for key in keys], dtype=int)
+
+    def observe(self, day, calls):
+        """Score ``day`` against the baselines, then learn it.
+
+        ``calls`` has one count per series. Returns the indices of the series
+        that were flagged.
+
+        """
+        alpha = self.params['alpha']
+        threshold = self.params['threshold']
+        weekday = day.weekday()
+        mean = self.mean[:, weekday]
+        var = self.var[:, weekday]
+        seen = self.seen[:, weekday]
+
+        # Counts are at least as noisy as a Poisson process with that mean.
+        spread = numpy.sqrt(numpy.maximum(var, numpy.maximum(mean, 1)))
+        score = (calls - mean) / spread
+        flagged = numpy.flatnonzero(
+            (seen >= self.params['warmup']) &
+            (score >= threshold) &
+            (calls - mean >= self.params['min_excess'])
+        )
+        self.flagged.extend(
+            (day, int(idx), float(calls[idx]), float(mean[idx]), float(score[idx]))
+            for idx in flagged
+        )
+
+        learned = numpy.minimum(calls, mean + threshold * spread)
+        diff = learned - mean
+        new = seen == 0
+        self.mean[:, weekday] = numpy.where(new, calls, mean + alpha * diff)
+        self.var[:, weekday] = numpy.where(
+            new,
+            0,
+            (1 - alpha) * (var + alpha * diff ** 2),
+        )
+        self.seen[:, weekday] += 1
+
+        return flagged
+
+    def update(self, rows):
+        """Learn ``(day, borough, type, calls)`` rows for days after ``last_day``.
+
+        Series without a row on a day had no calls that day. Days without any
+        rows at all are skipped. Returns the number of days learned.
+
+        """
+        rows = [row for row in rows if self.last_day is None or row[0] > self.last_day]
+
+        if not rows:
+            return 0
+
+        series = self.series([(borough, type_) for _, borough, type_, _ in rows])
+        days = sorted({row[0] for row in rows})
+        offsets = {day: idx for idx, day in enumerate(days)}
+        counts = numpy.zeros((len(days), len(self.keys)))
+        counts[[offsets[row[0]] for row in rows], series] = [row[3] for row in rows]
+
+        for day, calls in zip(days, counts):
+            self.observe(day, calls)
+
+        self.last_day = days[-1]
+
+        return len(days)
+
+
+def refresh(path=DEFAULT_STATE_PATH, through=None, rebuild=False,
+            chunk_days=366, **params):
+    """Load the baselines in ``path``, learn the days since, and save them.
+
+    Only days up to ``through`` are learned, if it's given. History is read
+    ``chunk_days`` at a time, which bounds the memory used by a rebuild.
+
+    """
+    baselines = Baselines(**params) if rebuild else Baselines.load(path, **params)
+    models.RollupState.refresh()
+    table = models.DailyCallCount._meta.db_table
+    first, last = models.DB.execute_sql(
+        f"SELECT MIN(day), MAX(day) FROM {table}"
+    ).fetchone()
+
+    if first is None:
+        return baselines
+
+    if baselines.last_day and baselines.last_day > last:
+        baselines = Baselines(**params)
+
+    if through:
+        last = min(last, through)
+
+    start = baselines.last_day + windows.DAY if baselines.last_day else first
+    learned = 0
+
+    while start <= last:
+        stop = min(start + datetime.timedelta(days=chunk_days), last + windows.DAY)
+        learned += baselines.update(models.DB.execute_sql(
+            f"""
+            SELECT day, borough, type, calls FROM {table}
+            WHERE day >= %s AND day < %s
+            ORDER BY day
+            """,
+            (start, stop),
+        ).fetchall())
+        start = stop
+
+    if learned or rebuild:
+        baselines.save(path)
+
+    return baselines
+
+
+def detect(since, through=None, path=DEFAULT_STATE_PATH, rebuild=False, **params):
+    """Anomalies on or after ``since``, with the storms and weather of their day.
+
+    ``refresh``es the baselines first. ``storms`` lists the types of the
+    storms in the anomaly's borough that day, and ``weather`` the citywide
+    weather events. Sorted by day, then by score, highest first.
+
+    """
+    baselines = refresh(path, through=through, rebuild=rebuild, **params)
+    flagged = [row for row in baselines.flagged if row[0] >= since]
+
+    if not flagged:
+        return []
+
+    first = min(row[0] for row in flagged)
+    last = max(row[0] for row in flagged)
+    storms = collections.defaultdict(set)
+
+    for storm in models.Storm.in_window(first, last):
+        storms[storm['date'], storm['borough']].add(storm['type'])
+
+    weather = {row['date']: row for row in models.Weather.between(first, last)}
+    anomalies = []
+
+    for day, series, calls, expected, score in flagged:
+        borough, type_ = baselines.keys[series]
+        conditions = weather.get(day)
+        anomalies.append(Anomaly(
+            day,
+            borough,
+            type_,
+            calls,
+            expected,
+            score,
+            sorted(storms[day, borough]),
+            list(conditions['events'] or []) if conditions else [],
+            float(conditions['precipitation']) if conditions else None,
+        ))
+
+    return sorted(anomalies, key=lambda anomaly: (anomaly.day, -anomaly.score))
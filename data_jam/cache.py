@@ -0,0 +1,315 @@
+"""Result cache for the read-only model methods.
+
+Notebook cells rerun the same queries over and over, so methods decorated
+with ``cached`` keep their results around, keyed on the method and its
+canonicalised arguments (peewee queries by their SQL and parameters).
+
+Results live in an in-memory LRU that is bounded in bytes, and in a SQLite
+file of compressed pickles that survives restarts and is shared between
+processes. Keys include the database the method ran against (see
+``db.identity``), so processes using different databases can share the file.
+
+Every entry remembers the table and the date range it covers. When an
+importer writes rows, it calls ``invalidate`` with the table and the dates it
+touched, which drops every overlapping entry. Invalidations are logged in the
+same file, so the in-memory entries of other processes are dropped as well.
+
+The module-level cache is off unless ``QUERY_CACHE`` points at that file.
+Without it, a process would never hear about rows another process imported
+and would keep serving stale results. ``QUERY_CACHE=:memory:`` turns on a
+cache that's private to the process, for when nothing else writes.
+
+"""
+
+import collections
+import datetime
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import peewee
+
+from data_jam import db
+
+
+Entry = collections.namedtuple('Entry', ('value', 'size', 'table', 'first', 'last'))
+
+
+def canonical(value):
+    """A stable, hashable stand-in for a method argument."""
+    if isinstance(value, peewee.Query):
+        sql, params = value.sql()
+        return ('sql', re.sub(r'\s+', ' ', sql).strip(), canonical(params))
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(item) for item in value)
+
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical(item)) for key, item in value.items()))
+
+    return repr(value)
+
+
+def date_range(start, end):
+    """Dates an entry for the ``[start, end]`` window depends on.
+
+    Padded by a day on each side, since aware bounds can land on either side
+    of midnight once Postgres converts them.
+
+    """
+    if start is None or end is None:
+        return None, None
+
+    first = start.date() if isinstance(start, datetime.datetime) else start
+    last = end.date() if isinstance(end, datetime.datetime) else end
+
+    return first - datetime.timedelta(days=1), last + datetime.timedelta(days=1)
+
+
+def overlaps(entry_first, entry_last, first, last):
+    if None in (entry_first, entry_last, first, last):
+        return True
+
+    return entry_first <= last and first <= entry_last
+
+
+def is_array(value):
+    # Nothing can be an array before NumPy is imported, and checking this way
+    # keeps importing the cache (and the models) from pulling it in.
+    numpy = sys.modules.get('numpy')
+
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def size_of(value):
+    if is_array(value):
+        return value.nbytes
+
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class QueryCache(object):
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, path=None):
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.bytes = 0
+        self.stats = collections.Counter()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._conn = None
+        self._seen = 0
+
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    first TEXT,
+                    last TEXT,
+                    value BLOB NOT NULL,
+                    stored_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    table_name TEXT NOT NULL,
+                    first TEXT,
+                    last TEXT
+                );
+            """)
+            self._seen = self._conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM invalidations"
+            ).fetchone()[0]
+
+    def get(self, key):
+        """Return ``(True, value)`` for a hit, ``(False, None)`` for a miss."""
+        with self._lock:
+            self._sync()
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                self.stats['memory_hits'] += 1
+                return True, self._entries[key].value
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT table_name, first, last, value FROM entries "
+                    "WHERE key = ?",
+                    (key,),
+                ).fetchone()
+
+                if row:
+                    table, first, last, blob = row
+                    value = pickle.loads(zlib.decompress(blob))
+                    self._remember(key, value, table, _date(first), _date(last))
+                    self.stats['hits'] += 1
+                    self.stats['disk_hits'] += 1
+                    return True, value
+
+            self.stats['misses'] += 1
+            return False, None
+
+    def set(self, key, value, table, first=None, last=None):
+        with self._lock:
+            self._remember(key, value, table, first, last)
+
+            if self._conn is not None:
+                blob = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, table, _iso(first), _iso(last), blob, time.time()),
+                    )
+
+    def invalidate(self, table, first=None, last=None):
+        """Drop the entries for ``table`` that overlap ``[first, last]``.
+
+        Without dates, every entry for the table goes.
+
+        """
+        with self._lock:
+            self._forget(table, first, last)
+
+            if self._conn is not None:
+                with self._conn:
+                    cursor = self._conn.execute(
+                        "INSERT INTO invalidations (table_name, first, last) "
+                        "VALUES (?, ?, ?)",
+                        (table, _iso(first), _iso(last)),
+                    )
+                    self._seen = cursor.lastrowid
+                    self._delete_rows(table, first, last)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM entries")
+
+    def _remember(self, key, value, table, first, last):
+        if is_array(value):
+            # Callers get the cached array itself, so keep them from
+            # changing it under everyone else.
+            value.flags.writeable = False
+
+        size = size_of(value)
+
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key).size
+
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = Entry(value, size, table, first, last)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.stats['evictions'] += 1
+
+    def _forget(self, table, first, last):
+        for key, entry in list(self._entries.items()):
+            if entry.table == table and overlaps(entry.first, entry.last, first, last):
+                del self._entries[key]
+                self.bytes -= entry.size
+                self.stats['invalidations'] += 1
+
+    def _delete_rows(self, table, first, last):
+        if first is None or last is None:
+            self._conn.execute(
+                "DELETE FROM entries WHERE table_name = ?",
+                (table,),
+            )
+        else:
+            self._conn.execute(
+                "DELETE FROM entries WHERE table_name = ? AND ("
+                "first IS NULL OR last IS NULL OR (first <= ? AND ? <= last))",
+                (table, _iso(last), _iso(first)),
+            )
+
+    def _sync(self):
+        """Apply invalidations that other processes logged since we last looked."""
+        if self._conn is None:
+            return
+
+        rows = self._conn.execute(
+            "SELECT id, table_name, first, last FROM invalidations WHERE id > ?",
+            (self._seen,),
+        ).fetchall()
+
+        for row_id, table, first, last in rows:
+            self._forget(table, _date(first), _date(last))
+            self._seen = row_id
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def _date(value):
+    return datetime.date.fromisoformat(value) if value is not None else None
+
+
+CACHE = QueryCache(path=os.environ.get('QUERY_CACHE'))
+CACHE.enabled = CACHE._conn is not None
+
+
+def cached(table):
+    """Cache a read-only classmethod's results, tagged with ``table``.
+
+    If the method takes ``start`` and ``end`` arguments, only writes to
+    ``table`` in that date range invalidate the result. Otherwise any write
+    to the table does.
+
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            if not CACHE.enabled:
+                return func(cls, *args, **kwargs)
+
+            bound = signature.bind(cls, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())[1:]
+            # The disk tier can be shared by processes pointed at different
+            # databases, so the key says which one the result came from.
+            key = hashlib.sha256(repr((
+                db.identity(cls._meta.database),
+                f'{cls.__name__}.{func.__name__}',
+                canonical(arguments),
+            )).encode('utf-8')).hexdigest()
+            found, value = CACHE.get(key)
+
+            if not found:
+                value = func(cls, *args, **kwargs)
+                first, last = date_range(
+                    bound.arguments.get('start'),
+                    bound.arguments.get('end'),
+                )
+                CACHE.set(key, value, table, first, last)
+
+            return list(value) if isinstance(value, list) else value
+
+        return wrapper
+
+    return decorator
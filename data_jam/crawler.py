@@ -0,0 +1,229 @@
+"""Asynchronous crawler for the NYC events calendar API.
+
+Pages are fetched concurrently over one pooled ``aiohttp`` session and handed
+to a single writer thread through a bounded queue, so network latency overlaps
+with geocoding and inserts instead of adding up.
+
+aiohttp is only imported once a crawl starts or the stub app is built.
+
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+
+
+EVENTS_URL = 'http://www1.nyc.gov/calendar/api/json/search.htm'
+
+
+class CrawlError(Exception):
+    """A page failed for good, or kept failing after every retry attempt.
+
+    ``status`` is the HTTP status of the last response, if there was one.
+
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def retryable(exc):
+    """Whether a failed request is worth trying again.
+
+    Only timeouts, rate limiting and server errors are. Any other client
+    error, like the 404 past the last page, will fail the same way again.
+
+    """
+    import aiohttp
+
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+
+    return isinstance(exc, asyncio.TimeoutError)
+
+
+async def fetch_page(session, url, page, max_attempts=5, backoff=0.5,
+                     give_up=None):
+    """Fetch one page of results, retrying with exponential backoff.
+
+    ``give_up`` is called before every retry, and the page is abandoned with
+    a ``CrawlError`` if it returns true, e.g. once the crawl is past it.
+
+    """
+    import aiohttp
+
+    params = {
+        'sort': 'DATE',
+        'pageNumber': page,
+    }
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            async with session.get(url, params=params) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            status = getattr(exc, 'status', None)
+
+            if not retryable(exc):
+                raise CrawlError(f"Page {page} failed: {exc}", status) from exc
+
+            if attempt == max_attempts:
+                raise CrawlError(
+                    f"Giving up on page {page} after {attempt} attempts.",
+                    status,
+                ) from exc
+
+            if give_up is not None and give_up():
+                raise CrawlError(f"Stopped retrying page {page}.", status) from exc
+
+            delay = backoff * 2 ** (attempt - 1)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+
+async def crawl(write, start_page=1, max_pages=None, concurrency=8,
+                url=EVENTS_URL, max_attempts=5, backoff=0.5, record_to=None):
+    """Fetch every page from ``start_page`` on and pass each one to ``write``.
+
+    ``write`` is a regular blocking function that gets the decoded JSON of a
+    page. It always runs on the same background thread, one page at a time,
+    while up to ``concurrency`` requests are in flight. The crawl stops at the
+    page the API flags as the last one, before the first page that doesn't
+    exist (a 404), or after ``max_pages`` pages. If
+    ``record_to`` is a directory, every page is also saved there as
+    ``<page>.json`` for ``recorded_pages_app`` to serve later.
+
+    """
+    import aiohttp
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    end_page = start_page + max_pages if max_pages else None
+    state = {
+        'next': start_page,
+        'last': None,
+    }
+
+    def end_at(page):
+        if state['last'] is None or page < state['last']:
+            state['last'] = page
+
+    def past_the_end(page):
+        return (
+            (end_page is not None and page >= end_page) or
+            (state['last'] is not None and page > state['last'])
+        )
+
+    async def fetcher(session):
+        while not past_the_end(state['next']):
+            page = state['next']
+            state['next'] += 1
+
+            try:
+                data = await fetch_page(
+                    session,
+                    url,
+                    page,
+                    max_attempts=max_attempts,
+                    backoff=backoff,
+                    give_up=lambda: past_the_end(page),
+                )
+            except CrawlError as exc:
+                if exc.status == 404 and page > start_page:
+                    end_at(page - 1)
+
+                if past_the_end(page):
+                    return
+
+                raise
+
+            if data['pagination']['isLastPage'] or not data['items']:
+                end_at(page)
+
+            if past_the_end(page):
+                continue
+
+            if record_to:
+                path = os.path.join(record_to, f'{page}.json')
+
+                with open(path, 'w', encoding='utf-8') as file_obj:
+                    json.dump(data, file_obj)
+
+            await queue.put(data)
+
+    async def fetch_all(fetchers):
+        await asyncio.gather(*fetchers)
+        await queue.put(None)
+
+    async def writer():
+        loop = asyncio.get_running_loop()
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            while True:
+                data = await queue.get()
+
+                if data is None:
+                    break
+
+                await loop.run_in_executor(executor, write, data)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        fetchers = [
+            asyncio.ensure_future(fetcher(session))
+            for _ in range(concurrency)
+        ]
+        tasks = [
+            asyncio.ensure_future(fetch_all(fetchers)),
+            asyncio.ensure_future(writer()),
+        ]
+
+        try:
+            done, _ = await asyncio.wait(
+                tasks,
+                return_when=asyncio.FIRST_EXCEPTION,
+            )
+
+            for task in done:
+                task.result()
+        finally:
+            for task in fetchers + tasks:
+                task.cancel()
+
+
+def run(coroutine):
+    """Run ``coroutine`` to completion on a fresh event loop."""
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def recorded_pages_app(directory):
+    """Stub of the calendar API that serves pages saved by ``crawl``.
+
+    Point ``Event.import_from_site`` at it to run the importer offline.
+
+    """
+    from aiohttp import web
+
+    async def search(request):
+        page = request.query.get('pageNumber', '1')
+        path = os.path.join(directory, f'{int(page)}.json')
+
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+
+        with open(path, 'r', encoding='utf-8') as file_obj:
+            return web.json_response(json.load(file_obj))
+
+    app = web.Application()
+    app.router.add_get('/calendar/api/json/search.htm', search)
+
+    return app
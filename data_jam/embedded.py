@@ -0,0 +1,601 @@
+"""SQLite backend, for running the models without a Postgres server.
+
+Point ``DATABASE`` (or ``db.configure``) at a ``sqlite:///data_jam.db`` URL,
+run ``manage.py migrate`` to create the tables with ``create_schema``, and
+the models, the ``insert`` importers and the query methods all run in this
+process against that file.
+
+The rest of the code is written for Postgres, so ``EmbeddedDatabase`` makes
+SQLite look enough like it:
+
+* Every statement goes through ``translate``: ``%s`` placeholders become
+  ``?``, ``x::type`` casts become ``CAST``\\ s or ``DATE()``, and
+  ``TRUNCATE`` becomes ``DELETE``.
+* ``date_trunc``, and the math functions on SQLite builds without them, are
+  added as Python functions.
+* Dates and timestamps are ISO text, with midnight stored as just the date.
+  Text compares like the values it stands for that way, including a
+  ``date`` against a ``timestamp``, like Postgres compares them. Columns come
+  back as ``date`` and ``datetime`` objects by their declared type, and so
+  do computed values that look like one (see ``typed_row``).
+* Aware ``datetime``\\ s are converted to local time, which stands in for the
+  Postgres session time zone.
+* Arrays are JSON text, see ``db.ArrayField``.
+
+SQLite 3.35 or newer is needed, for ``RETURNING``. What's left needs a real
+Postgres: the ``COPY`` imports (``mode='copy'``, ``workers``,
+``on_conflict`` and checkpoints), partitions, and ``parquet.export``.
+
+The schema isn't migrated. It's meant to be rebuilt from the CSV files, so
+after a schema change delete the file and import again. ``SCHEMA`` is
+written by hand, so ``migrate`` checks it against the models with
+``schema_differences`` and fails if a migration only made it into one of
+them.
+
+"""
+
+import datetime
+import decimal
+import math
+import re
+import sqlite3
+
+import peewee
+
+from data_jam import db, spatial, windows
+
+
+# SQLITE_MAX_VARIABLE_NUMBER since SQLite 3.32: how many parameters one
+# statement can have, which bounds the rows of an ``insert_many``.
+MAX_VARIABLES = 32766
+
+PLACEHOLDER = re.compile(r'%([s%])')
+CAST = re.compile(
+    r'::(double precision|timestamp(?: without time zone)?|date|bigint|'
+    r'integer|smallint|boolean|text)\b',
+    re.IGNORECASE,
+)
+TRUNCATE = re.compile(
+    r'^\s*TRUNCATE\s+(?:TABLE\s+)?(\w+)(?:\s+RESTART IDENTITY)?\s*$',
+    re.IGNORECASE,
+)
+DATE_TEXT = re.compile(r'\d{4}-\d{2}-\d{2}$')
+TIMESTAMP_TEXT = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?$')
+
+# How each cast is spelled in SQLite. ``None`` drops the cast.
+CASTS = {
+    'date': 'DATE({})',
+    'timestamp': None,
+    'timestamp without time zone': None,
+    'boolean': None,
+    'smallint': 'CAST({} AS INTEGER)',
+    'integer': 'CAST({} AS INTEGER)',
+    'bigint': 'CAST({} AS INTEGER)',
+    'double precision': 'CAST({} AS REAL)',
+    'text': 'CAST({} AS TEXT)',
+}
+
+# Called like Postgres calls them. SQLite has these built in when it's
+# compiled with SQLITE_ENABLE_MATH_FUNCTIONS.
+MATH_FUNCTIONS = {
+    'floor': (1, math.floor),
+    'ceil': (1, math.ceil),
+    'ln': (1, math.log),
+    'radians': (1, math.radians),
+    'sin': (1, math.sin),
+    'cos': (1, math.cos),
+    'asin': (1, math.asin),
+    'sqrt': (1, math.sqrt),
+    'power': (2, math.pow),
+}
+TRUNCATE_UNITS = {'day': windows.DAY, 'hour': windows.HOUR}
+PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('foreign_keys', 'on'),
+)
+
+
+def naive(value):
+    """``value`` in local time without a time zone, if it has one."""
+    if value.tzinfo is None:
+        return value
+
+    return value.astimezone().replace(tzinfo=None)
+
+
+def adapt_datetime(value):
+    value = naive(value)
+
+    if value.time() == datetime.time.min:
+        return value.date().isoformat()
+
+    return value.isoformat(' ')
+
+
+def convert_date(value):
+    return datetime.date.fromisoformat(value[:10].decode('ascii'))
+
+
+def convert_datetime(value):
+    return datetime.datetime.fromisoformat(value.decode('ascii'))
+
+
+sqlite3.register_adapter(datetime.datetime, adapt_datetime)
+sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+sqlite3.register_adapter(decimal.Decimal, str)
+sqlite3.register_converter('date', convert_date)
+sqlite3.register_converter('datetime', convert_datetime)
+sqlite3.register_converter('timestamp', convert_datetime)
+
+
+def typed(value):
+    if type(value) is str:
+        if DATE_TEXT.match(value):
+            return datetime.date.fromisoformat(value)
+
+        if TIMESTAMP_TEXT.match(value):
+            return datetime.datetime.fromisoformat(value)
+
+    return value
+
+
+def typed_row(cursor, row):
+    """Row factory that reads computed dates and timestamps back as objects.
+
+    Columns are already converted by their declared type. This catches
+    values without one, like ``DATE(created)`` or ``MIN(day)``, which
+    psycopg2 would return as a ``date``.
+
+    """
+    return tuple(map(typed, row))
+
+
+def date_trunc(unit, value):
+    """``date_trunc`` for ``'day'`` and ``'hour'``.
+
+    Midnight is spelled out in full, unlike ``adapt_datetime`` stores it, so
+    the result still reads back as a ``datetime``. The hourly rollup is only
+    ever compared with ``>= start AND < stop``, which works either way.
+
+    """
+    if value is None:
+        return None
+
+    truncated = windows.floor(
+        datetime.datetime.fromisoformat(value),
+        TRUNCATE_UNITS[unit.lower()],
+    )
+
+    return truncated.isoformat(' ')
+
+
+def operand_start(sql, end):
+    """Index where the expression that ends at ``sql[end]`` starts.
+
+    That's a parenthesized group along with the name of the function it
+    belongs to, a quoted literal, or a run of name characters.
+
+    """
+    idx = end
+
+    if sql[idx - 1] == "'":
+        idx -= 1
+
+        while True:
+            idx = sql.rindex("'", 0, idx)
+
+            if idx == 0 or sql[idx - 1] != "'":
+                return idx
+
+            idx -= 1
+
+    if sql[idx - 1] == ')':
+        depth = 0
+
+        while True:
+            idx -= 1
+            char = sql[idx]
+
+            if char == "'":
+                idx = operand_start(sql, idx + 1)
+            elif char == ')':
+                depth += 1
+            elif char == '(':
+                depth -= 1
+
+                if not depth:
+                    break
+
+    while idx and (sql[idx - 1].isalnum() or sql[idx - 1] in '_.?'):
+        idx -= 1
+
+    return idx
+
+
+def translate(sql, params=None):
+    """Rewrite the Postgres syntax this project uses into SQLite's.
+
+    Like psycopg2, ``%s`` and ``%%`` are only placeholders when there are
+    ``params``.
+
+    """
+    if params and '%' in sql:
+        sql = PLACEHOLDER.sub(lambda match: '?' if match.group(1) == 's' else '%', sql)
+
+    if '::' in sql:
+        while True:
+            match = CAST.search(sql)
+
+            if not match:
+                break
+
+            start = operand_start(sql, match.start())
+            operand = sql[start:match.start()]
+            spelling = CASTS[match.group(1).lower()]
+            sql = (
+                sql[:start] +
+                (spelling.format(operand) if spelling else operand) +
+                sql[match.end():]
+            )
+
+    return TRUNCATE.sub(r'DELETE FROM \1', sql)
+
+
+class EmbeddedDatabase(peewee.SqliteDatabase):
+    """``SqliteDatabase`` that runs the Postgres flavored SQL of the models."""
+
+    def __init__(self, database, **kwargs):
+        kwargs.setdefault('detect_types', sqlite3.PARSE_DECLTYPES)
+        kwargs.setdefault('pragmas', list(PRAGMAS))
+        super(EmbeddedDatabase, self).__init__(database, **kwargs)
+        self._rollback_hooks = []
+
+    def on_rollback(self, hook):
+        """Call ``hook()`` after every transaction or savepoint rolls back."""
+        self._rollback_hooks.append(hook)
+
+    def _rolled_back(self):
+        for hook in self._rollback_hooks:
+            hook()
+
+    def _add_conn_hooks(self, conn):
+        super(EmbeddedDatabase, self)._add_conn_hooks(conn)
+        conn.row_factory = typed_row
+        # Replaces peewee's, which leaves off the minutes and seconds.
+        conn.create_function('date_trunc', 2, date_trunc, deterministic=True)
+
+        if not conn.execute(
+            "SELECT sqlite_compileoption_used('ENABLE_MATH_FUNCTIONS')"
+        ).fetchone()[0]:
+            for name, (arity, function) in MATH_FUNCTIONS.items():
+                conn.create_function(name, arity, function, deterministic=True)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        cursor = super(EmbeddedDatabase, self).execute_sql(
+            translate(sql, params),
+            params,
+            require_commit,
+        )
+
+        # Savepoints are rolled back with SQL rather than ``rollback``.
+        if sql.lstrip()[:8].upper() == 'ROLLBACK':
+            self._rolled_back()
+
+        return cursor
+
+    def rollback(self):
+        super(EmbeddedDatabase, self).rollback()
+        self._rolled_back()
+
+
+def parse_timestamp(value):
+    """Parse a CSV or calendar timestamp like Postgres would, for SQLite.
+
+    Takes the ``MM/DD/YYYY hh:mm:ss AM`` of the 311 and permitted events
+    exports, and ISO 8601. Returns a naive ``datetime``, or ``None`` for an
+    empty value.
+
+    """
+    if not value:
+        return None
+
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+
+    try:
+        parsed = datetime.datetime.strptime(value, '%m/%d/%Y %I:%M:%S %p')
+    except ValueError:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+    return parsed.replace(tzinfo=None)
+
+
+def fetch_array(database, sql, params, width):
+    """``columnar.fetch_sql`` for SQLite. ``NULL``\\ s come back as ``nan``."""
+    import numpy
+
+    cursor = database.get_conn().cursor()
+    # Every value is a number, so there's nothing for ``typed_row`` to do.
+    cursor.row_factory = None
+
+    try:
+        cursor.execute(translate(sql, params), params or ())
+        values = numpy.array(cursor.fetchall(), dtype=numpy.float64)
+    finally:
+        cursor.close()
+
+    return values.reshape(-1, width)
+
+
+def upsert(database, table, columns, rows, key):
+    """Insert ``rows``, overwriting the ones whose ``key`` exists if they changed.
+
+    The SQLite version of ``loaders.copy_rows`` with ``on_conflict='update'``.
+    Returns ``(rows, written)``.
+
+    """
+    rows = list(rows)
+    updates = [column for column in columns if column != key]
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({key}) DO UPDATE SET "
+        + ', '.join(f"{column} = excluded.{column}" for column in updates)
+        + f" WHERE ({', '.join(f'{table}.{column}' for column in updates)}) "
+        f"IS NOT ({', '.join(f'excluded.{column}' for column in updates)})"
+    )
+
+    with database.atomic():
+        written = database.get_conn().executemany(sql, rows).rowcount
+
+    return len(rows), written
+
+
+def cell_sql(grid, latitude='latitude', longitude='longitude'):
+    """``grid.cell_sql`` with built-in functions only, for generated columns.
+
+    ``CAST`` rounds toward zero, which is ``floor`` here since the shifted
+    coordinates are never negative.
+
+    """
+    return (
+        f"CAST(({latitude} + 90) / {grid.lat_size!r} AS INTEGER) "
+        f"* {grid.columns} "
+        f"+ CAST(({longitude} + 180) / {grid.lng_size!r} AS INTEGER)"
+    )
+
+
+LOOKUP_TABLES = (
+    'service_request_agencies',
+    'service_request_types',
+    'service_request_descriptors',
+    'service_request_boroughs',
+)
+
+# The schema the Postgres migrations end up with, minus the partitions.
+SCHEMA = ''.join(
+    f"""
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255) NOT NULL UNIQUE
+);
+"""
+    for table in LOOKUP_TABLES
+) + f"""
+CREATE TABLE IF NOT EXISTS service_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    unique_key BIGINT,
+    agency_id SMALLINT NOT NULL REFERENCES service_request_agencies (id),
+    type_id SMALLINT NOT NULL REFERENCES service_request_types (id),
+    descriptor_id SMALLINT REFERENCES service_request_descriptors (id),
+    borough_id SMALLINT REFERENCES service_request_boroughs (id),
+    latitude NUMERIC(10, 8),
+    longitude NUMERIC(11, 8),
+    created DATETIME NOT NULL,
+    closed DATETIME,
+    cell BIGINT GENERATED ALWAYS AS ({cell_sql(spatial.CELL_GRID)}) STORED,
+    duration BIGINT GENERATED ALWAYS AS (
+        CAST(round((julianday(closed) - julianday(created)) * 86400) AS INTEGER)
+    ) STORED
+);
+CREATE UNIQUE INDEX IF NOT EXISTS service_requests_unique_key_created
+    ON service_requests (unique_key, created);
+CREATE INDEX IF NOT EXISTS service_requests_created ON service_requests (created);
+CREATE INDEX IF NOT EXISTS service_requests_borough_id ON service_requests (borough_id);
+CREATE INDEX IF NOT EXISTS service_requests_cell_created
+    ON service_requests (cell, created);
+CREATE INDEX IF NOT EXISTS service_requests_duration ON service_requests (duration);
+
+CREATE TABLE IF NOT EXISTS service_request_daily_counts (
+    day DATE NOT NULL,
+    borough VARCHAR(255) NOT NULL,
+    type VARCHAR(255) NOT NULL,
+    calls INTEGER NOT NULL,
+    PRIMARY KEY (day, borough, type)
+);
+CREATE TABLE IF NOT EXISTS service_request_hourly_counts (
+    hour DATETIME NOT NULL,
+    borough VARCHAR(255) NOT NULL,
+    type VARCHAR(255) NOT NULL,
+    calls INTEGER NOT NULL,
+    PRIMARY KEY (hour, borough, type)
+);
+CREATE TABLE IF NOT EXISTS service_request_duration_sketches (
+    day DATE NOT NULL,
+    borough VARCHAR(255) NOT NULL,
+    agency VARCHAR(255) NOT NULL,
+    keys TEXT NOT NULL,
+    counts TEXT NOT NULL,
+    PRIMARY KEY (day, borough, agency)
+);
+CREATE TABLE IF NOT EXISTS service_request_rollup_state (
+    id INTEGER PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO service_request_rollup_state (id, last_id) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS service_request_dirty_days (
+    day DATE PRIMARY KEY
+);
+CREATE TRIGGER IF NOT EXISTS service_requests_dirty_on_delete
+AFTER DELETE ON service_requests
+BEGIN
+    INSERT OR IGNORE INTO service_request_dirty_days (day)
+    VALUES (DATE(old.created));
+END;
+CREATE TRIGGER IF NOT EXISTS service_requests_dirty_on_update
+AFTER UPDATE ON service_requests
+BEGIN
+    INSERT OR IGNORE INTO service_request_dirty_days (day)
+    VALUES (DATE(old.created)), (DATE(new.created));
+END;
+
+CREATE TABLE IF NOT EXISTS service_request_heat_tiles (
+    grid VARCHAR(255) NOT NULL,
+    day DATE NOT NULL,
+    cell_row INTEGER NOT NULL,
+    cell_col INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (grid, day, cell_row, cell_col)
+);
+CREATE INDEX IF NOT EXISTS service_request_heat_tiles_day
+    ON service_request_heat_tiles (day);
+CREATE TABLE IF NOT EXISTS service_request_heat_tile_days (
+    grid VARCHAR(255) NOT NULL,
+    day DATE NOT NULL,
+    PRIMARY KEY (grid, day)
+);
+CREATE INDEX IF NOT EXISTS service_request_heat_tile_days_day
+    ON service_request_heat_tile_days (day);
+
+CREATE TABLE IF NOT EXISTS storms (
+    id INTEGER PRIMARY KEY,
+    county VARCHAR(255) NOT NULL,
+    date DATE NOT NULL,
+    type VARCHAR(255) NOT NULL,
+    deaths INTEGER NOT NULL DEFAULT 0,
+    injured INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS storms_county ON storms (county);
+
+CREATE TABLE IF NOT EXISTS permitted_events (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(1000),
+    borough VARCHAR(255),
+    latitude NUMERIC(10, 8),
+    longitude NUMERIC(11, 8),
+    start_time DATETIME NOT NULL,
+    end_time DATETIME NOT NULL,
+    cell BIGINT GENERATED ALWAYS AS ({cell_sql(spatial.CELL_GRID)}) STORED
+);
+CREATE INDEX IF NOT EXISTS permitted_events_borough ON permitted_events (borough);
+CREATE INDEX IF NOT EXISTS permitted_events_cell ON permitted_events (cell);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    short_description VARCHAR(255),
+    description TEXT,
+    start_time DATETIME,
+    end_time DATETIME,
+    borough VARCHAR(255),
+    latitude NUMERIC(10, 8),
+    longitude NUMERIC(11, 8),
+    cell BIGINT GENERATED ALWAYS AS ({cell_sql(spatial.CELL_GRID)}) STORED
+);
+CREATE INDEX IF NOT EXISTS events_start_time ON events (start_time);
+CREATE INDEX IF NOT EXISTS events_borough ON events (borough);
+CREATE INDEX IF NOT EXISTS events_cell ON events (cell);
+
+CREATE TABLE IF NOT EXISTS weather (
+    id INTEGER PRIMARY KEY,
+    date DATE NOT NULL UNIQUE,
+    temp_avg NUMERIC(5, 2) NOT NULL,
+    temp_low NUMERIC(5, 2) NOT NULL,
+    temp_high NUMERIC(5, 2) NOT NULL,
+    precipitation NUMERIC(5, 2) NOT NULL DEFAULT 0,
+    humidity NUMERIC(5, 2) NOT NULL,
+    dew_point NUMERIC(5, 2) NOT NULL,
+    events TEXT NOT NULL
+);
+"""
+
+
+def create_schema(database):
+    """Create any missing tables, indexes and triggers."""
+    database.get_conn().executescript(SCHEMA)
+
+
+def schema_differences(database, models):
+    """How the tables of ``database`` differ from ``models``, as messages.
+
+    ``SCHEMA`` is kept in step with the migrations by hand, and so are the
+    models, so this catches a migration that only made it into one of them:
+    missing or extra columns, ``NOT NULL`` constraints and indexes.
+
+    """
+    cursor = database.get_conn().cursor()
+    cursor.row_factory = None
+    differences = []
+
+    def pragma(name, argument):
+        return cursor.execute(f"PRAGMA {name}({argument})").fetchall()
+
+    try:
+        for model in models:
+            table = model._meta.db_table
+            fields = {field.db_column: field for field in model._meta.sorted_fields}
+            # Generated columns are only listed by table_xinfo.
+            columns = {row[1]: row[3] for row in pragma('table_xinfo', table)}
+
+            if not columns:
+                differences.append(f"{table} is missing")
+                continue
+
+            for column in sorted(fields.keys() - columns.keys()):
+                differences.append(f"{table}.{column} is missing")
+
+            for column in sorted(columns.keys() - fields.keys()):
+                differences.append(f"{table}.{column} isn't in {model.__name__}")
+
+            for column, field in fields.items():
+                if field.primary_key or column not in columns:
+                    continue
+
+                if bool(columns[column]) == field.null:
+                    differences.append(
+                        f"{table}.{column} should "
+                        f"{'' if field.null else 'not '}be nullable"
+                    )
+
+            indexes = [
+                (tuple(row[2] for row in pragma('index_info', name)), unique)
+                for _, name, unique, *_ in pragma('index_list', table)
+            ]
+            # Array indexes are GIN indexes, which SQLite doesn't have.
+            expected = [
+                ((field.db_column,), field.unique)
+                for field in fields.values()
+                if (field.index or field.unique)
+                and not field.primary_key
+                and not isinstance(field, db.ArrayField)
+            ] + [
+                (
+                    tuple(model._meta.fields[name].db_column for name in names),
+                    unique,
+                )
+                for names, unique in model._meta.indexes
+            ]
+
+            for index_columns, unique in expected:
+                if not any(
+                    found == index_columns and (found_unique or not unique)
+                    for found, found_unique in indexes
+                ):
+                    differences.append(
+                        f"{table} has no {'unique ' if unique else ''}index on "
+                        f"({', '.join(index_columns)})"
+                    )
+    finally:
+        cursor.close()
+
+    return differences
@@ -0,0 +1,176 @@
+"""Cached, deduplicated geocoding for the importers.
+
+Both event datasets mention the same handful of places over and over again,
+so lookups go through a small SQLite cache keyed on the normalized address.
+Addresses that couldn't be found are cached too (for a shorter time), and the
+remaining misses are resolved concurrently by a pluggable backend.
+
+"""
+
+import concurrent.futures
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    'GEOCODE_CACHE',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), '.geocode_cache.sqlite'),
+)
+DAY = 24 * 60 * 60
+
+
+class GeocodeError(Exception):
+    """A lookup failed for a reason worth retrying later (quota, network)."""
+
+
+def normalize(address):
+    return re.sub(r'\s+', ' ', address).strip().lower()
+
+
+def google(address):
+    """Default backend, backed by the Google Maps geocoding API.
+
+    Backends take an address and return ``(latitude, longitude)``, ``None``
+    when the address doesn't exist, or raise ``GeocodeError``.
+
+    """
+    import geocoder
+
+    coded = geocoder.google(address)
+
+    if coded.ok:
+        longitude, latitude = (
+            coded.geojson['features'][0]['geometry']['coordinates']
+        )
+        return latitude, longitude
+
+    if coded.status == 'ZERO_RESULTS':
+        return None
+
+    raise GeocodeError(coded.status)
+
+
+class GeocodeCache(object):
+    """SQLite table of ``normalized address -> (latitude, longitude)``.
+
+    A ``NULL`` latitude marks an address the backend couldn't find. Those
+    expire after ``negative_ttl`` seconds, real results after ``ttl``.
+
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=180 * DAY,
+                 negative_ttl=7 * DAY):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocodes (
+                address TEXT PRIMARY KEY,
+                latitude REAL,
+                longitude REAL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+
+    def get_many(self, addresses):
+        """Return the fresh entries for ``addresses`` (``None`` if negative)."""
+        addresses = list(addresses)
+        now = time.time()
+        found = {}
+
+        with self._lock:
+            for idx in range(0, len(addresses), 500):
+                chunk = addresses[idx:idx + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor = self._conn.execute(
+                    f"SELECT address, latitude, longitude, fetched_at "
+                    f"FROM geocodes WHERE address IN ({placeholders})",
+                    chunk,
+                )
+
+                for address, latitude, longitude, fetched_at in cursor:
+                    if latitude is None:
+                        if now - fetched_at < self.negative_ttl:
+                            found[address] = None
+                    elif now - fetched_at < self.ttl:
+                        found[address] = (latitude, longitude)
+
+        return found
+
+    def set_many(self, results):
+        now = time.time()
+        rows = [
+            (address, *(coded or (None, None)), now)
+            for address, coded in results.items()
+        ]
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+
+class CachedGeocoder(object):
+    """Resolve batches of addresses through a cache and a backend.
+
+    Keeps running totals in ``hits`` and ``misses`` (per unique address) so
+    the importers can report how much the cache saved them.
+
+    """
+
+    def __init__(self, backend=google, cache=None, concurrency=8):
+        self.backend = backend
+        self.cache = cache or GeocodeCache()
+        self.concurrency = concurrency
+        self.requested = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def resolve(self, addresses):
+        """Geocode ``addresses``, returning ``{address: (lat, lng) or None}``."""
+        addresses = [address for address in addresses if address]
+        keys = {address: normalize(address) for address in set(addresses)}
+        unique = set(keys.values())
+        results = self.cache.get_many(unique)
+        misses = unique - set(results)
+
+        self.requested += len(addresses)
+        self.hits += len(unique) - len(misses)
+        self.misses += len(misses)
+
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            futures = {
+                pool.submit(self.backend, address): address
+                for address in misses
+            }
+            fetched = {}
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    fetched[futures[future]] = future.result()
+                except GeocodeError:
+                    self.failures += 1
+
+        self.cache.set_many(fetched)
+        results.update(fetched)
+
+        return {address: results.get(key) for address, key in keys.items()}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self):
+        return (
+            f"Geocoded {self.requested} addresses "
+            f"({self.hits + self.misses} unique): {self.hits} cache hits, "
+            f"{self.misses} misses, {self.failures} failures "
+            f"({self.hit_rate:.0%} hit rate)."
+        )
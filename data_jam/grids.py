@@ -0,0 +1,108 @@
+"""Regular latitude/longitude grids for binning points.
+
+Cells are numbered from the south-west corner of the world, so a point's cell
+is just ``floor((lat + 90) / lat_size)`` and ``floor((lng + 180) / lng_size)``,
+which is cheap to compute both in Postgres and in NumPy. A geohash precision
+maps onto the grid with the same cells as geohashes of that length.
+
+"""
+
+import math
+
+
+class Grid(object):
+
+    def __init__(self, lat_size, lng_size, key):
+        self.lat_size = lat_size
+        self.lng_size = lng_size
+        self.key = key
+
+    @classmethod
+    def from_cell_size(cls, cell_size):
+        return cls(cell_size, cell_size, f'cell:{cell_size!r}')
+
+    @classmethod
+    def from_geohash_precision(cls, precision):
+        # Geohashes interleave longitude and latitude bits, starting with
+        # longitude, five bits per character.
+        bits = 5 * precision
+        return cls(
+            180.0 / 2 ** (bits // 2),
+            360.0 / 2 ** math.ceil(bits / 2),
+            f'geohash:{precision}',
+        )
+
+    @classmethod
+    def from_options(cls, cell_size=None, geohash_precision=None):
+        if (cell_size is None) == (geohash_precision is None):
+            raise ValueError("Pass exactly one of cell_size or geohash_precision.")
+
+        if cell_size is not None:
+            return cls.from_cell_size(cell_size)
+
+        return cls.from_geohash_precision(geohash_precision)
+
+    def row_sql(self, latitude='latitude'):
+        return f"floor(({latitude} + 90) / {self.lat_size!r})::integer"
+
+    def col_sql(self, longitude='longitude'):
+        return f"floor(({longitude} + 180) / {self.lng_size!r})::integer"
+
+    @property
+    def columns(self):
+        return math.ceil(360 / self.lng_size)
+
+    def cell(self, latitude, longitude):
+        """Single integer id of the cell containing a point."""
+        return (
+            math.floor((latitude + 90) / self.lat_size) * self.columns
+            + math.floor((longitude + 180) / self.lng_size)
+        )
+
+    def cell_sql(self, latitude='latitude', longitude='longitude'):
+        return (
+            f"floor(({latitude} + 90) / {self.lat_size!r})::bigint "
+            f"* {self.columns} "
+            f"+ floor(({longitude} + 180) / {self.lng_size!r})::bigint"
+        )
+
+    def cell_ranges(self, south, west, north, east):
+        """Cover a bounding box with ``(low, high)`` ranges of cell ids.
+
+        Cells in one row are numbered consecutively, so each row of the box
+        is a single range. The box is padded by a cell on every side, which
+        makes up for float rounding differences with Postgres.
+
+        """
+        first_row = math.floor((south + 90) / self.lat_size) - 1
+        last_row = math.floor((north + 90) / self.lat_size) + 1
+        first_col = math.floor((west + 180) / self.lng_size) - 1
+        last_col = math.floor((east + 180) / self.lng_size) + 1
+
+        return [
+            (row * self.columns + first_col, row * self.columns + last_col)
+            for row in range(first_row, last_row + 1)
+        ]
+
+    def to_points(self, *parts):
+        """Merge ``(row, col, weight)`` arrays into ``(lat, lng, weight)``.
+
+        Cells that show up in more than one part have their weights summed,
+        and each cell is placed at its center.
+
+        """
+        import numpy
+
+        cells = numpy.concatenate([part.reshape(-1, 3) for part in parts])
+
+        if not len(cells):
+            return numpy.empty((0, 3))
+
+        keys, inverse = numpy.unique(cells[:, :2], axis=0, return_inverse=True)
+        weights = numpy.bincount(inverse.ravel(), weights=cells[:, 2])
+        points = numpy.empty((len(keys), 3))
+        points[:, 0] = (keys[:, 0] + 0.5) * self.lat_size - 90
+        points[:, 1] = (keys[:, 1] + 0.5) * self.lng_size - 180
+        points[:, 2] = weights
+
+        return points
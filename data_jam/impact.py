@@ -0,0 +1,350 @@
+"""How much extra 311 load storms and severe weather cause, and for how long.
+
+Everything is computed in one NumPy pass over a ``(borough, day)`` matrix of
+call counts, read from the daily rollup in a single query. For every event
+(a ``Storm`` row in its borough, or a severe ``Weather`` day citywide):
+
+* ``baseline`` is the mean daily calls over the ``baseline_days`` before it,
+* ``post`` is the total calls in the ``window`` days starting on the event,
+* ``excess`` is ``post`` minus what the baseline predicts for that window,
+* ``days_to_recover`` is the number of days until the ``smooth``-day rolling
+  mean drops back to within ``tolerance`` of the baseline (``None`` if that
+  doesn't happen within ``horizon`` days).
+
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+
+import numpy
+import peewee
+
+import data_jam.models as models
+from data_jam import db, windows
+
+
+CITYWIDE = 'CITYWIDE'
+DEFAULT_CACHE_PATH = os.environ.get(
+    'STORM_IMPACT_CACHE',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), '.storm_impact_cache.json'),
+)
+SEVERE_WEATHER = ('Snow', 'Thunderstorm')
+
+Impact = collections.namedtuple('Impact', (
+    'kind',
+    'name',
+    'borough',
+    'day',
+    'baseline',
+    'post',
+    'excess',
+    'days_to_recover',
+))
+
+
+def daily_matrix(first, last):
+    """Calls per borough and day for ``first <= day <= last``.
+
+    Returns ``(boroughs, counts)``, where ``counts[i, j]`` is the number of
+    calls in ``boroughs[i]`` on day ``first + j``. The last row is the
+    citywide total.
+
+    """
+    rows = models.ServiceRequest.count_by_day_and_borough(
+        windows.as_datetime(first),
+        windows.as_datetime(last) + windows.DAY - datetime.timedelta.resolution,
+    )
+    boroughs = sorted({borough for _, borough, _ in rows})
+    index = {borough: idx for idx, borough in enumerate(boroughs)}
+    counts = numpy.zeros((len(boroughs) + 1, (last - first).days + 1))
+
+    for day, borough, calls in rows:
+        counts[index[borough], (day - first).days] = calls
+
+    counts[-1] = counts[:-1].sum(axis=0)
+
+    return boroughs + [CITYWIDE], counts
+
+
+def measure(counts, series, offsets, baseline_days=28, window=7, horizon=60,
+            tolerance=0.1, smooth=3):
+    """Vectorized impact numbers for events on ``counts[series, offsets]``.
+
+    ``series`` and ``offsets`` are integer arrays with the row and column of
+    every event. Returns ``(baseline, post, excess, days_to_recover)``
+    arrays, with ``nan`` where there isn't enough data around the event.
+
+    """
+    length = counts.shape[1]
+    cumulative = numpy.zeros((counts.shape[0], length + 1))
+    numpy.cumsum(counts, axis=1, out=cumulative[:, 1:])
+
+    def total(low, high):
+        low = numpy.clip(low, 0, length)
+        high = numpy.clip(high, 0, length)
+        return cumulative[series, high] - cumulative[series, low]
+
+    valid = (offsets >= baseline_days) & (offsets + window <= length)
+    baseline = total(offsets - baseline_days, offsets) / baseline_days
+    post = total(offsets, offsets + window)
+    excess = post - baseline * window
+
+    # Rolling mean of the ``smooth`` days starting at each day.
+    rolling = (cumulative[:, smooth:] - cumulative[:, :-smooth]) / smooth
+
+    if rolling.shape[1] <= 0:
+        # Fewer than ``smooth`` days of data, so nothing can recover.
+        days_to_recover = numpy.full(len(offsets), numpy.nan)
+    else:
+        days = offsets[:, None] + numpy.arange(horizon + 1)
+        inside = days < rolling.shape[1]
+        recovered = inside & (
+            rolling[series[:, None], numpy.clip(days, 0, rolling.shape[1] - 1)]
+            <= baseline[:, None] * (1 + tolerance)
+        )
+        days_to_recover = numpy.where(
+            valid & recovered.any(axis=1),
+            recovered.argmax(axis=1),
+            numpy.nan,
+        )
+
+    mask = numpy.where(valid, 1.0, numpy.nan)
+
+    return baseline * mask, post * mask, excess * mask, days_to_recover
+
+
+def severe_weather():
+    """Condition for ``Weather`` rows with any of the ``SEVERE_WEATHER`` events."""
+    if not db.embedded():
+        return models.Weather.events.contains_any(*SEVERE_WEATHER)
+
+    # The events are a JSON list there, see ``db.ArrayField``.
+    return peewee.Clause(
+        peewee.SQL('EXISTS (SELECT 1 FROM json_each('),
+        models.Weather.events,
+        peewee.SQL(
+            ') WHERE value IN (%s))' % ', '.join('?' for _ in SEVERE_WEATHER),
+            *SEVERE_WEATHER
+        ),
+    )
+
+
+def events(first, last, precipitation=1.0):
+    """``(kind, name, borough, day)`` for every storm and severe weather day."""
+    storms = (
+        models.Storm
+        .select(
+            models.Storm.type,
+            models.Storm.borough.alias('borough'),
+            models.Storm.date,
+        )
+        .where(models.Storm.date.between(first, last))
+        .order_by(models.Storm.date, models.Storm.id)
+        .tuples()
+    )
+    weather = (
+        models.Weather
+        .select(
+            models.Weather.events,
+            models.Weather.precipitation,
+            models.Weather.date,
+        )
+        .where(
+            models.Weather.date.between(first, last),
+            (models.Weather.precipitation >= precipitation) |
+            severe_weather(),
+        )
+        .order_by(models.Weather.date)
+        .tuples()
+    )
+    found = [
+        ('storm', storm_type, borough, day)
+        for storm_type, borough, day in storms
+        if borough
+    ]
+    found += [
+        (
+            'weather',
+            f"{', '.join(weather_events) or 'Rain'} ({rain} in)",
+            CITYWIDE,
+            day,
+        )
+        for weather_events, rain, day in weather
+    ]
+
+    return found
+
+
+def analyze(baseline_days=28, window=7, horizon=60, tolerance=0.1, smooth=3,
+            precipitation=1.0, cache_path=None):
+    """Measure the impact of every storm and severe weather day.
+
+    With ``cache_path``, results are saved to that JSON file and reused for
+    as long as the parameters and the underlying data stay the same (see
+    ``fingerprint``).
+
+    """
+    params = {
+        'baseline_days': baseline_days,
+        'window': window,
+        'horizon': horizon,
+        'tolerance': tolerance,
+        'smooth': smooth,
+        'precipitation': precipitation,
+    }
+    key = None
+
+    if cache_path:
+        data = fingerprint()
+
+        if data is not None:
+            key = [params, data]
+            cached = _load(cache_path, key)
+
+            if cached is not None:
+                return cached
+
+    bounds = models.DB.execute_sql(
+        "SELECT MIN(created)::date, MAX(created)::date FROM service_requests"
+    ).fetchone()
+    impacts = []
+
+    if bounds[0] is not None:
+        first, last = bounds
+        found = events(first, last, precipitation)
+        boroughs, counts = daily_matrix(first, last)
+        index = {borough: idx for idx, borough in enumerate(boroughs)}
+        found = [event for event in found if event[2] in index]
+        series = numpy.array([index[event[2]] for event in found], dtype=int)
+        offsets = numpy.array(
+            [(event[3] - first).days for event in found],
+            dtype=int,
+        )
+        columns = measure(
+            counts,
+            series,
+            offsets,
+            baseline_days=baseline_days,
+            window=window,
+            horizon=horizon,
+            tolerance=tolerance,
+            smooth=smooth,
+        )
+
+        for event, values in zip(found, zip(*columns)):
+            impacts.append(Impact(*event, *[
+                None if numpy.isnan(value) else float(value)
+                for value in values
+            ]))
+
+    if key is not None:
+        _save(cache_path, key, impacts)
+
+    return impacts
+
+
+def by_borough(impacts):
+    """``(borough, events, mean excess, mean days to recover)`` rows."""
+    groups = collections.defaultdict(list)
+
+    for impact in impacts:
+        groups[impact.borough].append(impact)
+
+    rows = []
+
+    for borough, group in sorted(groups.items()):
+        excess = [impact.excess for impact in group if impact.excess is not None]
+        recovery = [
+            impact.days_to_recover
+            for impact in group
+            if impact.days_to_recover is not None
+        ]
+        rows.append((
+            borough,
+            len(group),
+            numpy.mean(excess) if excess else None,
+            numpy.mean(recovery) if recovery else None,
+        ))
+
+    return rows
+
+
+def fingerprint():
+    """Hash of the data the analysis reads, to key the cache on.
+
+    It covers the rows themselves rather than counts and ids, so a weather
+    file that's imported again with corrections, or an update that moves
+    calls to another day or borough, changes it too. ``None`` while the
+    rollups are behind, since the counts then partly come from the raw rows.
+
+    """
+    if not models.RollupState.in_sync():
+        return None
+
+    digest = hashlib.md5()
+    queries = (
+        models.DailyCallCount
+        .select(
+            models.DailyCallCount.day,
+            models.DailyCallCount.borough,
+            peewee.fn.SUM(models.DailyCallCount.calls),
+        )
+        .group_by(models.DailyCallCount.day, models.DailyCallCount.borough)
+        .order_by(models.DailyCallCount.day, models.DailyCallCount.borough),
+        models.Storm
+        .select(
+            models.Storm.id,
+            models.Storm.date,
+            models.Storm.type,
+            models.Storm.county,
+        )
+        .order_by(models.Storm.id),
+        models.Weather
+        .select(
+            models.Weather.date,
+            models.Weather.precipitation,
+            models.Weather.events,
+        )
+        .order_by(models.Weather.date),
+    )
+
+    for query in queries:
+        for row in query.tuples():
+            digest.update(repr(row).encode())
+
+        # Keeps the rows of one table from running into the next.
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def _load(path, key):
+    try:
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get('key') != key:
+        return None
+
+    return [
+        Impact(*row[:3], datetime.date.fromisoformat(row[3]), *row[4:])
+        for row in cached['impacts']
+    ]
+
+
+def _save(path, key, impacts):
+    rows = [
+        list(impact[:3]) + [impact.day.isoformat()] + list(impact[4:])
+        for impact in impacts
+    ]
+    partial = f"{path}.partial"
+
+    with open(partial, 'w') as cache_file:
+        json.dump({'key': key, 'impacts': rows}, cache_file)
+
+    os.replace(partial, path)
@@ -0,0 +1,692 @@
+"""Bulk loading helpers for the big CSV datasets.
+
+The 311 dump is way too big to push through ``insert_many`` comfortably, so
+these helpers stream rows straight into PostgreSQL's ``COPY FROM STDIN``
+instead of building a Python dict per row.
+
+"""
+
+import collections
+import concurrent.futures
+import csv
+import glob
+import io
+import itertools
+import json
+import multiprocessing
+import operator
+import os
+import re
+import time
+
+import psycopg2
+
+from data_jam import metrics, sources
+from data_jam.lookups import Encoder
+
+
+_QUOTE_OR_NEWLINE = re.compile(b'["\\n]')
+
+# (database column, CSV header) pairs for the 311 Service Requests export.
+# The ``_id`` columns are dictionary-encoded, see ``data_jam.lookups``.
+SERVICE_REQUEST_COLUMNS = (
+    ('unique_key', 'Unique Key'),
+    ('agency_id', 'Agency'),
+    ('type_id', 'Complaint Type'),
+    ('descriptor_id', 'Descriptor'),
+    ('borough_id', 'Borough'),
+    ('latitude', 'Latitude'),
+    ('longitude', 'Longitude'),
+    ('created', 'Created Date'),
+    ('closed', 'Closed Date'),
+)
+
+# (database column, CSV header) pairs for the yearly files in data/weather.
+WEATHER_COLUMNS = (
+    ('date', 'Date'),
+    ('temp_avg', 'T_avg'),
+    ('temp_low', 'T_low'),
+    ('temp_high', 'T_high'),
+    ('precipitation', 'R_sum'),
+    ('humidity', 'H_high'),
+    ('dew_point', 'DP_high'),
+    ('events', 'event'),
+)
+
+
+def projector(header, columns):
+    """Return a function that picks ``columns`` out of a raw CSV row.
+
+    ``header`` is the first row of the CSV file and ``columns`` is a sequence
+    of ``(db_column, csv_header)`` pairs. The returned callable turns a list
+    from ``csv.reader`` into a tuple ordered like ``columns``.
+
+    """
+    indices = [header.index(csv_header) for _, csv_header in columns]
+
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda row: (row[index],)
+
+    return operator.itemgetter(*indices)
+
+
+class CopyStream(object):
+    """File-like object that feeds rows to ``cursor.copy_expert``.
+
+    psycopg2 pulls data out of this with ``read(size)``, and each call
+    serializes only as many rows as it needs to fill the request. Empty
+    strings are written unquoted, which ``COPY`` reads as ``NULL``.
+
+    ``wall`` and ``cpu`` add up the time spent in ``read``, which is where
+    the lazy ``rows`` pipeline (parsing, projecting, encoding) runs.
+
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        started_cpu = time.process_time()
+        buf = self._buffer
+
+        while size < 0 or buf.tell() < size:
+            row = next(self.rows, None)
+
+            if row is None:
+                break
+
+            self._writer.writerow(row)
+            self.count += 1
+
+        data = buf.getvalue()
+
+        if size < 0 or len(data) <= size:
+            chunk, rest = data, ''
+        else:
+            chunk, rest = data[:size], data[size:]
+
+        buf.seek(0)
+        buf.truncate()
+        buf.write(rest)
+        self.wall += time.perf_counter() - started
+        self.cpu += time.process_time() - started_cpu
+
+        return chunk
+
+
+def merge_sql(table, staging, columns, key, on_conflict):
+    """Build the statement that moves a batch from ``staging`` into ``table``.
+
+    ``key`` is the column (or tuple of columns) of a unique index on
+    ``table``. ``on_conflict='skip'`` leaves rows whose key already exists
+    alone. ``on_conflict='update'`` overwrites them, but only when something
+    actually changed, so re-importing an unchanged file doesn't rewrite every
+    row. Rows without a full key can't be deduplicated and are dropped.
+
+    """
+    keys = (key,) if isinstance(key, str) else tuple(key)
+    key_list = ', '.join(keys)
+    names = ', '.join(columns)
+    sql = (
+        f"INSERT INTO {table} ({names}) "
+        f"SELECT DISTINCT ON ({key_list}) {names} FROM {staging} "
+        f"WHERE {' AND '.join(f'{column} IS NOT NULL' for column in keys)} "
+        f"ORDER BY {key_list}, ctid DESC "
+        f"ON CONFLICT ({key_list}) DO "
+    )
+
+    if on_conflict == 'skip':
+        return sql + "NOTHING"
+
+    updates = [column for column in columns if column not in keys]
+    current = ', '.join(f"{table}.{column}" for column in updates)
+    excluded = ', '.join(f"EXCLUDED.{column}" for column in updates)
+
+    return (
+        sql +
+        "UPDATE SET " +
+        ', '.join(f"{column} = EXCLUDED.{column}" for column in updates) +
+        f" WHERE ({current}) IS DISTINCT FROM ({excluded})"
+    )
+
+
+def copy_rows(connection, table, columns, rows, commit_every=None,
+              on_commit=None, on_conflict=None, key=None):
+    """``COPY`` ``rows`` into ``table``, committing every ``commit_every`` rows.
+
+    Each batch runs in its own transaction, so a bad row near the end of a
+    huge file only throws away the current batch. ``on_commit`` is called with
+    the running total and the number of rows actually written after every
+    commit. Returns the number of rows read.
+
+    With ``on_conflict`` set to ``'skip'`` or ``'update'``, batches are copied
+    into a temporary staging table first and then merged on ``key`` (see
+    ``merge_sql``), which makes re-running an import idempotent.
+
+    Every batch is recorded as ``parse`` (pulling the rows), ``copy`` and
+    ``commit`` (or ``merge``) stages, see ``data_jam.metrics``.
+
+    """
+    target = table
+    merge = None
+
+    if on_conflict:
+        target = f"{table}_staging"
+        merge = merge_sql(table, target, columns, key, on_conflict)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {target} "
+                f"ON COMMIT DELETE ROWS AS "
+                f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+            )
+
+        connection.commit()
+
+    sql = f"COPY {target} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    rows = iter(rows)
+    total = 0
+    written = 0
+
+    while True:
+        if commit_every:
+            batch = itertools.islice(rows, commit_every)
+        else:
+            batch = rows
+
+        stream = CopyStream(batch)
+        started = time.perf_counter()
+        started_cpu = time.process_time()
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream)
+            copied = time.perf_counter()
+            copied_cpu = time.process_time()
+
+            if merge:
+                cursor.execute(merge)
+                written += cursor.rowcount
+            else:
+                written += stream.count
+
+        connection.commit()
+
+        if not stream.count:
+            break
+
+        metrics.add('parse', stream.wall, stream.cpu, stream.count)
+        metrics.add(
+            'copy',
+            copied - started - stream.wall,
+            copied_cpu - started_cpu - stream.cpu,
+            stream.count,
+        )
+        metrics.add(
+            'merge' if merge else 'commit',
+            time.perf_counter() - copied,
+            time.process_time() - copied_cpu,
+            stream.count,
+        )
+
+        total += stream.count
+
+        if on_commit:
+            on_commit(total, written)
+
+        if not commit_every:
+            break
+
+    return total
+
+
+class OffsetReader(object):
+    """Iterate the lines of a binary file as text, keeping track of the offset.
+
+    ``csv.reader`` only pulls as many lines as it needs for the next record,
+    so after it yields a row, ``offset`` is the byte position right after that
+    record. That makes it safe to record in a checkpoint and ``seek`` back to.
+
+    """
+
+    def __init__(self, file_obj, encoding='utf-8'):
+        self.file_obj = file_obj
+        self.encoding = encoding
+        self.offset = file_obj.tell()
+
+    def seek(self, offset):
+        self.file_obj.seek(offset)
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.file_obj.readline()
+
+        if not line:
+            raise StopIteration
+
+        self.offset += len(line)
+
+        return line.decode(self.encoding)
+
+
+class Checkpoint(object):
+    """Progress of a resumable import, saved to a small JSON file.
+
+    A checkpoint only applies to the exact file it was written for. If the
+    source path, size or modification time changed, it starts from scratch.
+
+    """
+
+    def __init__(self, path, source):
+        stat = os.stat(source)
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.fingerprint = [stat.st_size, int(stat.st_mtime)]
+        self.offset = 0
+        self.rows = 0
+        self.last_key = None
+        self.complete = False
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file_obj:
+                data = json.load(file_obj)
+
+            if (data.get('source') == self.source and
+                    data.get('fingerprint') == self.fingerprint):
+                self.offset = data['offset']
+                self.rows = data['rows']
+                self.last_key = data['last_key']
+                self.complete = data['complete']
+
+        self._pending_key = self.last_key
+
+    def track(self, rows, key_index):
+        """Pass ``rows`` through, remembering the key of the latest one."""
+        for row in rows:
+            self._pending_key = row[key_index]
+            yield row
+
+    def save(self, offset, rows, complete=False):
+        self.offset = offset
+        self.rows = rows
+        self.last_key = self._pending_key
+        self.complete = complete
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, 'w', encoding='utf-8') as file_obj:
+            json.dump({
+                'source': self.source,
+                'fingerprint': self.fingerprint,
+                'offset': self.offset,
+                'rows': self.rows,
+                'last_key': self.last_key,
+                'complete': self.complete,
+            }, file_obj)
+
+        os.replace(tmp_path, self.path)
+
+
+def record_boundaries(path, count, block_size=16 * 1024 * 1024):
+    """Return byte offsets that split ``path`` into roughly ``count`` pieces.
+
+    Every offset is the start of a CSV record, never a newline inside a
+    quoted field. We keep a running count of double quotes while scanning the
+    file, and only a newline seen with an even number of quotes before it
+    ends a record. Escaped quotes (``""``) come in pairs, so they don't
+    change the parity. The first offset is the end of the header row.
+
+    """
+    size = os.path.getsize(path)
+    targets = [size * i // count for i in range(count)]
+    boundaries = []
+    quotes = 0
+    offset = 0
+
+    with open(path, 'rb') as file_obj:
+        while targets:
+            block = file_obj.read(block_size)
+
+            if not block:
+                break
+
+            pos = 0
+
+            while targets and targets[0] < offset + len(block):
+                target = max(targets[0] - offset, pos)
+                quotes += block.count(b'"', pos, target)
+                pos = target
+
+                for match in _QUOTE_OR_NEWLINE.finditer(block, pos):
+                    pos = match.end()
+
+                    if match.group() == b'"':
+                        quotes += 1
+                    elif quotes % 2 == 0:
+                        boundaries.append(offset + pos)
+                        del targets[0]
+                        break
+                else:
+                    pos = len(block)
+                    break
+
+            quotes += block.count(b'"', pos)
+            offset += len(block)
+
+    return boundaries
+
+
+class ByteRange(io.RawIOBase):
+    """Read-only view of the ``[start, end)`` bytes of an open binary file."""
+
+    def __init__(self, file_obj, start, end):
+        file_obj.seek(start)
+        self._file = file_obj
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+
+        if size <= 0:
+            return 0
+
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+
+        return len(data)
+
+
+def _copy_range(task):
+    """Worker for ``parallel_copy``. Loads one byte range over its own connection."""
+    (path, start, end, header, table, columns, connect_kwargs,
+     commit_every, on_conflict, key, lookups) = task
+    started = time.perf_counter()
+    names = [column for column, _ in columns]
+    connection = psycopg2.connect(**connect_kwargs)
+    encoder = Encoder(connect_kwargs, names, lookups) if lookups else None
+
+    try:
+        with metrics.recording('shard', report=False) as recorder, \
+                open(path, 'rb') as raw:
+            text = io.TextIOWrapper(
+                io.BufferedReader(ByteRange(raw, start, end), 1024 * 1024),
+                encoding='utf-8',
+                newline='',
+            )
+            reader = csv.reader(text, strict=True)
+            project = projector(header, columns)
+
+            def checked(row):
+                if len(row) != len(header):
+                    raise ValueError(
+                        f"Record near byte {start} of {path} has {len(row)} "
+                        f"fields, expected {len(header)}."
+                    )
+
+                return project(row)
+
+            rows = map(checked, reader)
+
+            if encoder:
+                rows = map(encoder, rows)
+
+            rows = copy_rows(
+                connection,
+                table,
+                names,
+                rows,
+                commit_every=commit_every,
+                on_conflict=on_conflict,
+                key=key,
+            )
+    finally:
+        connection.close()
+
+        if encoder:
+            encoder.close()
+
+    return rows, end - start, time.perf_counter() - started, recorder.stages
+
+
+def parallel_copy(path, table, columns, connect_kwargs, workers,
+                  commit_every=None, on_conflict=None, key=None,
+                  shards_per_worker=4, lookups=None):
+    """``COPY`` a CSV file into ``table`` using a pool of worker processes.
+
+    The file is cut into ``workers * shards_per_worker`` record-aligned byte
+    ranges (see ``record_boundaries``). Each worker parses and projects its
+    ranges and streams them into ``COPY`` over its own connection, built from
+    ``connect_kwargs``. ``path`` has to be an uncompressed file, since the
+    workers seek into it. ``on_conflict`` and ``key`` work like they do for
+    ``copy_rows``. ``lookups`` lists the dictionary-encoded columns, which
+    every worker resolves through its own ``lookups.Encoder``. Returns the
+    total number of rows read.
+
+    """
+    boundaries = record_boundaries(path, workers * shards_per_worker)
+
+    with open(path, 'r', encoding='utf-8', newline='') as file_obj:
+        header = next(csv.reader(file_obj))
+
+    size = os.path.getsize(path)
+    edges = boundaries + [size]
+    tasks = [
+        (path, start, end, header, table, columns, connect_kwargs,
+         commit_every, on_conflict, key, lookups)
+        for start, end in zip(edges, edges[1:])
+        if start < end
+    ]
+    started = time.perf_counter()
+    total = 0
+    copied = edges[0]
+
+    with multiprocessing.Pool(workers) as pool:
+        for rows, length, seconds, stages in pool.imap_unordered(_copy_range, tasks):
+            total += rows
+            copied += length
+            # Stage times are summed over the workers, like CPU time.
+            metrics.current().merge(stages)
+            metrics.progress(
+                f"Copied {total} rows! "
+                f"(shard of {rows} rows took {seconds:.1f}s)",
+                rows=total,
+                shard_rows=rows,
+                shard_seconds=round(seconds, 3),
+                bytes_read=copied,
+                bytes_total=size,
+                bytes_start=edges[0],
+            )
+
+    elapsed = time.perf_counter() - started
+    metrics.progress(
+        f"Copied {total} rows with {workers} workers in {elapsed:.1f}s "
+        f"({total / elapsed if elapsed else 0:.0f} rows/sec).",
+        rows=total,
+        workers=workers,
+    )
+
+    return total
+
+
+def expand_paths(patterns, extension='.csv'):
+    """Sorted files for a mix of file paths, directories and glob patterns.
+
+    Directories contribute the files directly inside them that end in
+    ``extension``, compressed or not (``.csv.gz`` and so on).
+
+    """
+    paths = set()
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for suffix in ('',) + sources.SUFFIXES:
+                paths.update(glob.glob(
+                    os.path.join(glob.escape(pattern), f'*{extension}{suffix}')
+                ))
+        elif glob.has_magic(pattern):
+            paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+        else:
+            paths.add(pattern)
+
+    return sorted(paths)
+
+
+def unique_names(header):
+    """Rename repeated headers to ``name_1``, ``name_2``, ... so none get lost."""
+    seen = collections.Counter()
+    names = []
+
+    for name in header:
+        names.append(f'{name}_{seen[name]}' if seen[name] else name)
+        seen[name] += 1
+
+    return names
+
+
+def array_literal(values):
+    """Postgres array literal for a list of strings, for ``COPY``."""
+    quoted = (
+        '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for value in values
+    )
+
+    return '{' + ','.join(quoted) + '}'
+
+
+def read_weather_csv(path):
+    """Parse one weather file into ``{column: array}`` with pyarrow.
+
+    The files repeat the ``Date`` header at the end of every row. Both copies
+    are read and rows where they disagree are dropped, as are rows without a
+    valid date or with missing readings. A blank ``R_sum`` means no rain.
+    ``event`` holds things like ``"Fog\t,Rain"``, or a lone tab for a day
+    without events, so it's split on commas and stripped of whitespace.
+    Returns the columns and the number of rows dropped.
+
+    ``path`` can be compressed, see ``data_jam.sources``.
+
+    """
+    import numpy
+    import pyarrow
+    import pyarrow.compute as compute
+    import pyarrow.csv
+
+    headers = dict(WEATHER_COLUMNS)
+    numbers = [
+        headers[column] for column, _ in WEATHER_COLUMNS
+        if column not in ('date', 'events')
+    ]
+
+    with sources.open_source(path) as source:
+        names = unique_names(next(csv.reader([source.binary.readline().decode('utf-8')])))
+        dates = [name for name in names if name.split('_')[0] == headers['date']]
+        missing = set(numbers + [headers['date'], headers['events']]) - set(names)
+
+        if missing:
+            raise ValueError(f"{path} has no {', '.join(sorted(missing))} column.")
+
+        try:
+            table = pyarrow.csv.read_csv(
+                source.binary,
+                read_options=pyarrow.csv.ReadOptions(column_names=names),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    include_columns=dates + numbers + [headers['events']],
+                    column_types=dict(
+                        {name: pyarrow.string() for name in dates + [headers['events']]},
+                        **{name: pyarrow.float64() for name in numbers}
+                    ),
+                ),
+            )
+        except pyarrow.ArrowInvalid as error:
+            raise ValueError(f"Can't parse {path}: {error}") from None
+
+    parsed = [
+        compute.strptime(
+            compute.utf8_trim_whitespace(table[name]),
+            format='%Y-%m-%d',
+            unit='s',
+            error_is_null=True,
+        ).cast(pyarrow.date32()).to_numpy(zero_copy_only=False).astype('datetime64[D]')
+        for name in dates
+    ]
+    columns = {'date': parsed[0]}
+    valid = ~numpy.isnat(parsed[0])
+
+    for other in parsed[1:]:
+        valid &= parsed[0] == other
+
+    for column, header in WEATHER_COLUMNS:
+        if header in numbers:
+            values = table[header].to_numpy(zero_copy_only=False).astype('float64')
+
+            if column == 'precipitation':
+                values = numpy.nan_to_num(values, nan=0.0)
+
+            columns[column] = values
+            valid &= ~numpy.isnan(values)
+
+    events = compute.split_pattern_regex(
+        compute.utf8_trim_whitespace(table[headers['events']].fill_null('')),
+        pattern=r'\s*,\s*',
+    )
+    columns['events'] = numpy.empty(len(events), dtype=object)
+
+    for idx, day in enumerate(events.to_pylist()):
+        columns['events'][idx] = [event for event in day if event]
+
+    return {column: values[valid] for column, values in columns.items()}, int((~valid).sum())
+
+
+def read_weather(paths, workers=4):
+    """Parse weather files in parallel and merge them into one set of columns.
+
+    Files are read on a thread pool (pyarrow releases the GIL while it
+    parses). Every date is kept once, sorted. When the same date shows up in
+    more than one file, the row from the file that sorts last wins.
+
+    """
+    import numpy
+
+    with metrics.stage('parse') as span, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(read_weather_csv, paths))
+        span.rows = sum(len(columns['date']) for columns, _ in results)
+
+    skipped = sum(dropped for _, dropped in results)
+    merged = {
+        column: numpy.concatenate([columns[column] for columns, _ in results])
+        for column, _ in WEATHER_COLUMNS
+    } if results else {column: numpy.array([]) for column, _ in WEATHER_COLUMNS}
+
+    # ``unique`` returns the first occurrence, so look at the rows backwards
+    # to keep the last one.
+    backwards = merged['date'][::-1]
+    _, first = numpy.unique(backwards, return_index=True)
+    keep = len(backwards) - 1 - first
+    duplicates = len(backwards) - len(keep)
+
+    if skipped:
+        metrics.progress(
+            f"Skipped {skipped} weather rows with bad dates or missing readings.",
+            skipped=skipped,
+        )
+
+    if duplicates:
+        metrics.progress(
+            f"Dropped {duplicates} weather rows for dates seen in another file.",
+            duplicates=duplicates,
+        )
+
+    return {column: values[keep] for column, values in merged.items()}
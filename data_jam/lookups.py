@@ -0,0 +1,288 @@
+"""Dictionary encoding for the repetitive text columns of ``service_requests``.
+
+Agency, complaint type, descriptor and borough only take a few hundred
+distinct values between them, so the table stores ``smallint`` codes that
+point into small lookup tables instead (see migration 011). Codes are
+resolved through an in-process cache. The importers add names that haven't
+been seen yet to the lookup table on the spot, while query parameters are
+only looked up, so filtering on a name nobody has used matches nothing
+instead of adding it.
+
+Blank names are stored as ``NULL``, except in the ``NOT NULL`` agency and
+type columns, where they're stored as ``UNSPECIFIED``.
+
+The caches talk to Postgres over their own autocommit connection. A new name
+is committed right away, so it's visible to the ``COPY`` that references it
+(and to other import workers), and it isn't lost when a batch rolls back.
+On SQLite, which only has one writer, they use the peewee database itself,
+and new names are committed along with the rows that reference them. The
+caches forget their codes whenever a transaction rolls back there, since the
+names may have been rolled back with it.
+
+"""
+
+import os
+import threading
+
+import peewee
+import psycopg2
+
+from data_jam import db
+
+
+# (service_requests column, lookup table) pairs.
+SERVICE_REQUEST_LOOKUPS = (
+    ('agency_id', 'service_request_agencies'),
+    ('type_id', 'service_request_types'),
+    ('descriptor_id', 'service_request_descriptors'),
+    ('borough_id', 'service_request_boroughs'),
+)
+# The columns that can't be NULL, so blank names get a name of their own.
+REQUIRED_LOOKUPS = ('agency_id', 'type_id')
+UNSPECIFIED = 'Unspecified'
+
+# Code for a name that isn't in the table. Real codes start at 1.
+MISSING = -1
+
+
+class LookupCache(object):
+    """``name <-> code`` for one lookup table.
+
+    ``connection`` is a psycopg2 connection or a peewee database. Blank names
+    are looked up as ``blank``, or are ``None`` if that's ``None``.
+
+    """
+
+    def __init__(self, table, connection, blank=None):
+        self.table = table
+        self.connection = connection
+        self.blank = blank
+        self.codes = {}
+        self.names = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _fetch(self, sql, params=None):
+        if isinstance(self.connection, peewee.Database):
+            return self.connection.execute_sql(sql, params).fetchall()
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+            return cursor.fetchall()
+
+    def load(self):
+        with self._lock:
+            for code, name in self._fetch(f"SELECT id, name FROM {self.table}"):
+                self.codes[name] = code
+                self.names[code] = name
+
+    def code(self, name):
+        """Code for ``name``, adding it to the table if it's new."""
+        name = name or self.blank
+
+        if name is None:
+            return None
+
+        try:
+            return self.codes[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            # Another process may add the same name at the same time, in
+            # which case our insert does nothing and we read theirs.
+            rows = self._fetch(
+                f"INSERT INTO {self.table} (name) VALUES (%s) "
+                f"ON CONFLICT (name) DO NOTHING RETURNING id",
+                (name,),
+            )
+
+            if not rows:
+                rows = self._fetch(
+                    f"SELECT id FROM {self.table} WHERE name = %s",
+                    (name,),
+                )
+
+            code = rows[0][0]
+            self.codes[name] = code
+            self.names[code] = name
+
+        return code
+
+    def find(self, name):
+        """Code for ``name``, or ``MISSING`` if it isn't in the table.
+
+        Unlike ``code``, this never writes, so it's safe for query parameters
+        and read-only roles.
+
+        """
+        name = name or self.blank
+
+        if name is None:
+            return None
+
+        try:
+            return self.codes[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            # Someone else may have added it since the cache was loaded.
+            rows = self._fetch(
+                f"SELECT id FROM {self.table} WHERE name = %s",
+                (name,),
+            )
+
+            if not rows:
+                return MISSING
+
+            code = rows[0][0]
+            self.codes[name] = code
+            self.names[code] = name
+
+        return code
+
+    def forget(self):
+        """Drop the cached codes, they're looked up again on first use."""
+        with self._lock:
+            self.codes.clear()
+            self.names.clear()
+
+    def name(self, code):
+        if code is None:
+            return None
+
+        if code not in self.names:
+            self.load()
+
+        return self.names[code]
+
+
+def connect(connect_kwargs):
+    connection = psycopg2.connect(**connect_kwargs)
+    connection.autocommit = True
+
+    return connection
+
+
+class Encoder(object):
+    """Replace names with codes in rows headed for ``COPY``.
+
+    ``columns`` are the database columns of the rows, in order. Columns that
+    appear in ``lookups`` get encoded, the rest pass through. Blanks in
+    ``required`` columns are encoded as ``UNSPECIFIED``.
+
+    """
+
+    def __init__(self, connect_kwargs, columns, lookups=SERVICE_REQUEST_LOOKUPS,
+                 required=REQUIRED_LOOKUPS):
+        self.connection = connect(connect_kwargs)
+        tables = dict(lookups)
+        self.caches = [
+            (
+                idx,
+                LookupCache(
+                    tables[column],
+                    self.connection,
+                    blank=UNSPECIFIED if column in required else None,
+                ),
+            )
+            for idx, column in enumerate(columns)
+            if column in tables
+        ]
+
+    def __call__(self, row):
+        row = list(row)
+
+        for idx, cache in self.caches:
+            row[idx] = cache.code(row[idx])
+
+        return row
+
+    def close(self):
+        self.connection.close()
+
+
+_connections = {}
+_caches = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(database, table, blank=None):
+    """Process-wide cache for ``table``, connected like peewee ``database``."""
+    with _shared_lock:
+        if table not in _caches:
+            if db.embedded(database):
+                if database not in _connections:
+                    connection = getattr(database, 'obj', database)
+                    connection.on_rollback(
+                        lambda: _forget_codes(connection)
+                    )
+                    _connections[database] = connection
+            elif database not in _connections:
+                _connections[database] = connect(
+                    dict(database.connect_kwargs, database=database.database)
+                )
+
+            _caches[table] = LookupCache(table, _connections[database], blank)
+
+        return _caches[table]
+
+
+def _forget_codes(connection):
+    for cache in list(_caches.values()):
+        if cache.connection is connection:
+            cache.forget()
+
+
+def _after_fork_in_child():
+    # The inherited connections belong to the parent. Keep them referenced so
+    # they're never closed from here, and connect again on first use.
+    _inherited.append((dict(_connections), dict(_caches)))
+    _connections.clear()
+    _caches.clear()
+
+
+_inherited = []
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LookupField(peewee.SmallIntegerField):
+    """A dictionary-encoded text column.
+
+    The column holds a code, but the field reads and writes names, so
+    ``ServiceRequest.agency == 'NYPD'`` and ``request.agency`` work just like
+    they did when the column was text. Names are only looked up here, and a
+    name that isn't in the lookup table becomes ``MISSING``. Rows with new
+    names have to be written with codes from ``cache.code``, like the
+    importers do.
+
+    """
+
+    def __init__(self, table, *args, **kwargs):
+        self.table = table
+        super(LookupField, self).__init__(*args, **kwargs)
+
+    def clone_base(self, **kwargs):
+        return super(LookupField, self).clone_base(table=self.table, **kwargs)
+
+    @property
+    def cache(self):
+        return shared_cache(
+            self.model_class._meta.database,
+            self.table,
+            blank=None if self.null else UNSPECIFIED,
+        )
+
+    def db_value(self, value):
+        if value is None or isinstance(value, int):
+            return value
+
+        return self.cache.find(value)
+
+    def python_value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+
+        return self.cache.name(value)
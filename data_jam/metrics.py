@@ -0,0 +1,346 @@
+"""Timings and progress reporting for the importers.
+
+Importers wrap each step of their pipeline in ``stage('parse')``,
+``stage('insert')`` and so on, and report progress with ``progress``
+instead of ``print``. Every stage collects its wall and CPU time, rows, and
+a histogram of how long each call took (one call is usually one batch), so a
+slow load shows where the time went.
+
+Nothing is recorded unless a ``recording`` is active, which is what the
+``--progress``, ``--metrics-file`` and ``--profile`` options of the import
+commands set up. With ``json_lines``, progress is printed as one JSON object
+per line, followed by a summary object at the end.
+
+Progress that passes ``bytes_read`` and ``bytes_total`` (see
+``data_jam.sources``) also gets the percentage done and an ETA, which is what
+makes sense of a multi-gigabyte load when the row count isn't known upfront.
+
+"""
+
+import bisect
+import collections
+import contextlib
+import datetime
+import json
+import resource
+import sys
+import time
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.rows = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+    def add(self, wall, cpu, rows=0):
+        self.calls += 1
+        self.rows += rows
+        self.wall += wall
+        self.cpu += cpu
+        self.counts[bisect.bisect_left(BUCKETS, wall)] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.rows += other.rows
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'rows': self.rows,
+            'wall_seconds': round(self.wall, 6),
+            'cpu_seconds': round(self.cpu, 6),
+            'rows_per_second': round(self.rows / self.wall, 1) if self.wall else None,
+        }
+
+
+class Span(object):
+    """Yielded by ``stage``; set ``rows`` when it's only known at the end."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+def peak_rss():
+    """``(this process, finished child processes)`` peak resident size in bytes."""
+    # ``ru_maxrss`` is in kilobytes on Linux but in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+
+        size /= 1024
+
+    return f"{size:.1f} TB"
+
+
+def byte_progress(elapsed, bytes_read, bytes_total=None, bytes_start=0):
+    """Rate, percentage and ETA fields for ``bytes_read`` of ``bytes_total``.
+
+    ``bytes_start`` is where this run started reading, for a resumed import.
+
+    """
+    rate = (bytes_read - bytes_start) / elapsed if elapsed else 0
+    fields = {'bytes_per_second': round(rate, 1)}
+
+    if bytes_total:
+        fields['percent'] = round(100 * bytes_read / bytes_total, 1)
+        fields['eta_seconds'] = (
+            round(max(bytes_total - bytes_read, 0) / rate, 1) if rate else None
+        )
+
+    return fields
+
+
+def describe_bytes(fields):
+    """Human-readable version of the byte fields of a progress line."""
+    read = format_bytes(fields['bytes_read'])
+
+    if not fields.get('bytes_total'):
+        return f"{read} read, {format_bytes(fields['bytes_per_second'])}/s"
+
+    eta = fields['eta_seconds']
+
+    return (
+        f"{read} of {format_bytes(fields['bytes_total'])}, "
+        f"{fields['percent']:.1f}%, ETA "
+        f"{datetime.timedelta(seconds=round(eta)) if eta is not None else 'unknown'}"
+    )
+
+
+class Recorder(object):
+
+    def __init__(self, name, json_lines=False, stream=None):
+        self.name = name
+        self.json_lines = json_lines
+        self.stream = stream
+        self.stages = collections.OrderedDict()
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        span = Span(rows)
+        started = time.perf_counter()
+        started_cpu = time.process_time()
+
+        try:
+            yield span
+        finally:
+            self.add(
+                name,
+                time.perf_counter() - started,
+                time.process_time() - started_cpu,
+                span.rows,
+            )
+
+    def add(self, name, wall, cpu, rows=0):
+        """Record a stage call that was timed elsewhere."""
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+
+        self.stages[name].add(wall, cpu, rows)
+
+    def merge(self, stages):
+        """Fold in the ``stages`` of a worker process's recorder."""
+        for name, stage in stages.items():
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+
+            self.stages[name].merge(stage)
+
+    def progress(self, message, **fields):
+        elapsed = time.perf_counter() - self.started
+
+        if fields.get('bytes_read') is not None:
+            fields.update(byte_progress(
+                elapsed,
+                fields['bytes_read'],
+                fields.get('bytes_total'),
+                fields.pop('bytes_start', 0),
+            ))
+
+        if not self.json_lines:
+            if fields.get('bytes_read') is not None:
+                message = f"{message} [{describe_bytes(fields)}]"
+
+            print(message, file=self.stream)
+            return
+
+        line = {
+            'event': 'progress',
+            'import': self.name,
+            'message': message,
+            'elapsed_seconds': round(elapsed, 3),
+            'peak_rss_bytes': peak_rss()[0],
+        }
+        line.update(fields)
+
+        if 'rows' in fields and elapsed:
+            line['rows_per_second'] = round(fields['rows'] / elapsed, 1)
+
+        print(json.dumps(line, default=str), file=self.stream, flush=True)
+
+    def summary(self):
+        rss, children_rss = peak_rss()
+
+        return {
+            'event': 'summary',
+            'import': self.name,
+            'wall_seconds': round(time.perf_counter() - self.started, 6),
+            'cpu_seconds': round(time.process_time() - self.started_cpu, 6),
+            'peak_rss_bytes': rss,
+            'peak_child_rss_bytes': children_rss,
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+        }
+
+    def report(self):
+        import tabulate
+
+        summary = self.summary()
+
+        if self.json_lines:
+            print(json.dumps(summary), file=self.stream, flush=True)
+            return
+
+        if not self.stages:
+            return
+
+        print(tabulate.tabulate(
+            [
+                (name, stage['calls'], stage['rows'], stage['wall_seconds'],
+                 stage['cpu_seconds'], stage['rows_per_second'])
+                for name, stage in summary['stages'].items()
+            ],
+            headers=('Stage', 'Calls', 'Rows', 'Wall s', 'CPU s', 'Rows/s'),
+            floatfmt='.2f',
+        ), file=self.stream)
+        print(
+            f"Took {summary['wall_seconds']:.1f}s "
+            f"({summary['cpu_seconds']:.1f}s CPU), peak RSS "
+            f"{summary['peak_rss_bytes'] / 1024 / 1024:.0f} MB.",
+            file=self.stream,
+        )
+
+    def prometheus(self):
+        """The metrics in Prometheus' text exposition format."""
+        summary = self.summary()
+        label = f'import="{self.name}"'
+        lines = [
+            '# TYPE data_jam_import_seconds gauge',
+            f'data_jam_import_seconds{{{label}}} {summary["wall_seconds"]}',
+            '# TYPE data_jam_import_cpu_seconds gauge',
+            f'data_jam_import_cpu_seconds{{{label}}} {summary["cpu_seconds"]}',
+            '# TYPE data_jam_import_peak_rss_bytes gauge',
+            f'data_jam_import_peak_rss_bytes{{{label},process="self"}} '
+            f'{summary["peak_rss_bytes"]}',
+            f'data_jam_import_peak_rss_bytes{{{label},process="children"}} '
+            f'{summary["peak_child_rss_bytes"]}',
+            '# TYPE data_jam_import_rows_total counter',
+        ]
+        lines += [
+            f'data_jam_import_rows_total{{{label},stage="{name}"}} {stage.rows}'
+            for name, stage in self.stages.items()
+        ]
+        lines.append('# TYPE data_jam_import_stage_cpu_seconds_total counter')
+        lines += [
+            f'data_jam_import_stage_cpu_seconds_total{{{label},stage="{name}"}} '
+            f'{stage.cpu}'
+            for name, stage in self.stages.items()
+        ]
+        lines.append('# TYPE data_jam_import_stage_seconds histogram')
+
+        for name, stage in self.stages.items():
+            labels = f'{label},stage="{name}"'
+            cumulative = 0
+
+            for bound, count in zip(BUCKETS + ('+Inf',), stage.counts):
+                cumulative += count
+                lines.append(
+                    f'data_jam_import_stage_seconds_bucket{{{labels},le="{bound}"}} '
+                    f'{cumulative}'
+                )
+
+            lines.append(f'data_jam_import_stage_seconds_sum{{{labels}}} {stage.wall}')
+            lines.append(f'data_jam_import_stage_seconds_count{{{labels}}} {stage.calls}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Used when nothing is being recorded. Stages still get timed, which is cheap
+# at one call per batch, but nothing is reported.
+_current = Recorder(None)
+
+
+def current():
+    return _current
+
+
+@contextlib.contextmanager
+def recording(name, json_lines=False, prometheus_path=None, profile_path=None,
+              report=True):
+    """Record the stages of an import and report on them when it's done.
+
+    ``prometheus_path`` gets the metrics in Prometheus' text format, and
+    ``profile_path`` the ``cProfile`` stats of the whole run (read them with
+    ``pstats`` or snakeviz).
+
+    """
+    global _current
+
+    previous = _current
+    _current = recorder = Recorder(name, json_lines)
+    profiler = None
+
+    if profile_path:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield recorder
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+        _current = previous
+
+        if report:
+            recorder.report()
+
+        if prometheus_path:
+            with open(prometheus_path, 'w') as file_obj:
+                file_obj.write(recorder.prometheus())
+
+
+def stage(name, rows=0):
+    return _current.stage(name, rows)
+
+
+def add(name, wall, cpu, rows=0):
+    _current.add(name, wall, cpu, rows)
+
+
+def progress(message, **fields):
+    _current.progress(message, **fields)
@@ -1,33 +1,108 @@
-"""Module that defines helper models for this data jam."""
+"""Module that defines helper models for this data jam.
 
+Importing this is kept cheap, since every ``manage.py`` call, notebook kernel
+and import worker does it: ``DB`` only connects on first use, and the heavy
+dependencies (NumPy, bs4, dateutil, aiohttp, peewee_migrate) are imported by
+the functions that need them.
+
+"""
+
+import collections
 import csv
+import datetime
 import decimal
-import os
+import functools
+import itertools
+import math
+import operator
 
-from dateutil.parser import parse as date_parse
-
-import bs4
-import geocoder
-import numpy
 import peewee
-import requests
 
-from playhouse.postgres_ext import ArrayField
-from playhouse.db_url import connect
 from playhouse.hybrid import hybrid_property, hybrid_method
 from playhouse.shortcuts import case
-from peewee_migrate import Router
 
+from data_jam import (
+    cache,
+    columnar,
+    db,
+    geocoding,
+    grids,
+    loaders,
+    lookups,
+    metrics,
+    sketches,
+    sources,
+    spatial,
+    windows,
+)
 
-DB = connect(os.environ['DATABASE'])
-MIGRATION_ROUTER = Router(DB)
 
+DB = db.DB
+ArrayField = db.ArrayField
 
-class ServiceRequest(peewee.Model):
-    agency = peewee.CharField(null=False)
-    type = peewee.CharField(null=False)
-    descriptor = peewee.CharField(null=True)
-    borough = peewee.CharField(null=True, index=True)
+
+def migration_router():
+    from peewee_migrate import Router
+
+    if db.embedded():
+        raise RuntimeError(
+            "SQLite databases have no migrations, see data_jam.embedded."
+        )
+
+    return Router(DB)
+
+
+def migrate():
+    """Bring the tables of ``DB`` up to date."""
+    if db.embedded():
+        from data_jam import embedded
+
+        embedded.create_schema(DB)
+        differences = embedded.schema_differences(DB, TABLE_MODELS)
+
+        if differences:
+            raise RuntimeError(
+                "The SQLite schema doesn't match the models: "
+                + '; '.join(differences)
+            )
+    else:
+        migration_router().run()
+
+
+def _timestamp_parser():
+    """Convert CSV timestamps for ``DB``, which only Postgres parses itself."""
+    if db.embedded():
+        from data_jam import embedded
+
+        return embedded.parse_timestamp
+
+    return lambda value: value
+
+
+class ServiceRequest(spatial.LocatedMixin, peewee.Model):
+    unique_key = peewee.BigIntegerField(null=True)
+    # Dictionary-encoded, see ``data_jam.lookups``.
+    agency = lookups.LookupField(
+        'service_request_agencies',
+        db_column='agency_id',
+        null=False,
+    )
+    type = lookups.LookupField(
+        'service_request_types',
+        db_column='type_id',
+        null=False,
+    )
+    descriptor = lookups.LookupField(
+        'service_request_descriptors',
+        db_column='descriptor_id',
+        null=True,
+    )
+    borough = lookups.LookupField(
+        'service_request_boroughs',
+        db_column='borough_id',
+        null=True,
+        index=True,
+    )
     latitude = peewee.DecimalField(
         max_digits=10,
         decimal_places=8,
@@ -40,69 +115,1157 @@ class ServiceRequest(peewee.Model):
     )
     created = peewee.DateTimeField(null=False, index=True)
     closed = peewee.DateTimeField(null=True)
+    # Generated by Postgres from the coordinates (see ``spatial``).
+    cell = peewee.BigIntegerField(null=True)
+    # Generated by Postgres: seconds from ``created`` to ``closed``.
+    duration = peewee.BigIntegerField(null=True, index=True)
+
+    # The table is partitioned by year on ``created`` (migration 007), so
+    # every unique index has to include it.
+    UNIQUE_KEY = ('unique_key', 'created')
 
     class Meta:
         db_table = 'service_requests'
         database = DB
+        indexes = (
+            (('unique_key', 'created'), True),
+            (('cell', 'created'), False),
+        )
 
     @classmethod
-    @DB.atomic()
-    def import_from_csv(cls, file_obj):
-        chunk_size = 10000
-        reader = csv.DictReader(file_obj)
-        rows = []
+    def import_from_csv(cls, source, mode='insert', commit_every=1000000,
+                        workers=1, on_conflict='error', checkpoint=None):
+        """Import a 311 Service Requests CSV export.
 
-        for idx, row in enumerate(reader):
-            rows.append({
-                'agency': row['Agency'],
-                'type': row['Complaint Type'],
-                'descriptor': row['Descriptor'],
-                'borough': row['Borough'],
-                'latitude': row['Latitude'],
-                'longitude': row['Longitude'],
-                'created': row['Created Date'],
-                'closed': row['Closed Date'] or None,
-            })
+        ``source`` is a ``sources.Source`` or a path, and the file can be
+        gzip, bzip2, xz or Zstandard compressed.
 
-            if idx > 0 and idx % chunk_size == 0:
-                cls.insert_many(rows).execute()
-                rows = []
-                print(f"Inserted {idx} service requests!")
+        ``mode='insert'`` builds dicts and runs ``insert_many`` inside one big
+        transaction. ``mode='copy'`` streams the CSV into ``COPY FROM STDIN``
+        and commits every ``commit_every`` rows, which is a whole lot faster
+        on the full dump.
 
-        if rows:
-            cls.insert_many(rows).execute()
+        With ``workers > 1`` the file is split into byte ranges that are
+        copied by that many processes at once. This always uses ``COPY`` and
+        needs an uncompressed file on disk.
+
+        ``on_conflict`` decides what happens to rows whose 311 Unique Key is
+        already in the table: ``'error'`` fails the batch, ``'skip'`` keeps
+        the existing row and ``'update'`` overwrites it if it changed.
+        ``checkpoint`` is a path to a JSON file where the copy path records
+        how far it got, so an interrupted import picks up where it stopped.
+        Both of these need ``COPY``, and so they're Postgres only, like
+        ``workers``.
+
+        The rollup tables are refreshed for the affected days afterwards.
+
+        """
+        if on_conflict == 'error':
+            on_conflict = None
+
+        if db.embedded() and (workers > 1 or mode == 'copy'):
+            raise ValueError("SQLite databases can only be imported with INSERTs.")
+
+        with sources.reading(source) as source:
+            if workers > 1:
+                if not source.path or source.compression:
+                    raise ValueError(
+                        "Parallel imports need an uncompressed file on disk."
+                    )
+
+                count = loaders.parallel_copy(
+                    source.path,
+                    cls._meta.db_table,
+                    loaders.SERVICE_REQUEST_COLUMNS,
+                    db.connect_kwargs(),
+                    workers,
+                    commit_every=commit_every,
+                    on_conflict=on_conflict,
+                    key=cls.UNIQUE_KEY,
+                    lookups=lookups.SERVICE_REQUEST_LOOKUPS,
+                )
+            elif mode == 'copy':
+                count = cls._copy_from_csv(
+                    source,
+                    commit_every,
+                    on_conflict,
+                    checkpoint,
+                )
+            else:
+                count = cls._insert_from_csv(source)
+
+        with metrics.stage('partition') as span:
+            span.rows = moved = cls.create_missing_partitions()
+
+        if moved:
+            metrics.progress(
+                f"Moved {moved} service requests into new partitions!",
+                moved=moved,
+            )
+
+        with metrics.stage('rollup'):
+            days = RollupState.refresh()
+
+        metrics.progress(
+            f"Refreshed the rollups for {len(days)} days!",
+            days=len(days),
+        )
+
+        return count
+
+    @classmethod
+    def create_missing_partitions(cls):
+        """Give rows that landed in the default partition a yearly partition.
+
+        Returns the number of rows moved. See migration 007. SQLite tables
+        aren't partitioned, so there's nothing to do there.
+
+        """
+        if db.embedded():
+            return 0
+
+        with DB.atomic():
+            return DB.execute_sql(
+                "SELECT service_requests_drain_default()"
+            ).fetchone()[0]
+
+    @classmethod
+    def _copy_from_csv(cls, source, commit_every, on_conflict=None,
+                       checkpoint=None):
+        columns = [column for column, _ in loaders.SERVICE_REQUEST_COLUMNS]
+
+        if checkpoint:
+            if not source.path:
+                raise ValueError("Checkpoints need a file on disk.")
+
+            checkpoint = loaders.Checkpoint(checkpoint, source.path)
+
+            if checkpoint.complete:
+                metrics.progress(f"{source.name} was already imported, skipping it.")
+                return 0
+
+            # Offsets into the decompressed data, for a compressed file.
+            lines = loaders.OffsetReader(source.binary)
+        else:
+            lines = source.text
+
+        reader = csv.reader(lines)
+        project = loaders.projector(
+            next(reader),
+            loaders.SERVICE_REQUEST_COLUMNS,
+        )
+        rows = map(project, reader)
+        base = 0
+
+        if checkpoint:
+            if checkpoint.offset:
+                lines.seek(checkpoint.offset)
+                source.mark()
+                base = checkpoint.rows
+                metrics.progress(
+                    f"Resuming after {base} rows "
+                    f"(key {checkpoint.last_key}, byte {checkpoint.offset}).",
+                    rows=base,
+                    offset=checkpoint.offset,
+                )
+
+            rows = checkpoint.track(rows, columns.index('unique_key'))
+
+        encoder = lookups.Encoder(
+            db.connect_kwargs(),
+            columns,
+        )
+
+        def on_commit(total, written):
+            if checkpoint:
+                checkpoint.save(lines.offset, base + total)
+
+            metrics.progress(
+                f"Copied {base + total} service requests! "
+                f"({written} new or changed)",
+                rows=base + total,
+                written=written,
+                **source.progress(),
+            )
+
+        try:
+            total = loaders.copy_rows(
+                DB.get_conn(),
+                cls._meta.db_table,
+                columns,
+                map(encoder, rows),
+                commit_every=commit_every,
+                on_commit=on_commit,
+                on_conflict=on_conflict,
+                key=cls.UNIQUE_KEY,
+            )
+        finally:
+            encoder.close()
+
+        if checkpoint:
+            checkpoint.save(lines.offset, base + total, complete=True)
+
+        return total
+
+    @classmethod
+    def _insert_from_csv(cls, source):
+        timestamp = _timestamp_parser()
+        # The fields only look names up, so new names get added here.
+        agency, type_, descriptor, borough = (
+            field.cache
+            for field in (cls.agency, cls.type, cls.descriptor, cls.borough)
+        )
+
+        with DB.atomic():
+            chunk_size = 10000
+            count = 0
+            reader = csv.DictReader(source.text)
+
+            if db.embedded():
+                from data_jam import embedded
+
+                # Every chunk is one statement, and SQLite only takes so many
+                # parameters in one.
+                chunk_size = embedded.MAX_VARIABLES // 9
+
+            while True:
+                with metrics.stage('parse') as span:
+                    rows = [
+                        {
+                            'unique_key': row['Unique Key'] or None,
+                            'agency': agency.code(row['Agency']),
+                            'type': type_.code(row['Complaint Type']),
+                            'descriptor': descriptor.code(row['Descriptor']),
+                            'borough': borough.code(row['Borough']),
+                            'latitude': row['Latitude'] or None,
+                            'longitude': row['Longitude'] or None,
+                            'created': timestamp(row['Created Date']),
+                            'closed': timestamp(row['Closed Date'] or None),
+                        }
+                        for row in itertools.islice(reader, chunk_size)
+                    ]
+                    span.rows = len(rows)
+
+                if not rows:
+                    break
+
+                with metrics.stage('insert', rows=len(rows)):
+                    cls.insert_many(rows).execute()
+
+                count += len(rows)
+                metrics.progress(
+                    f"Inserted {count} service requests!",
+                    rows=count,
+                    **source.progress(),
+                )
+
+            return count
 
     @hybrid_method
     def happened_between(self, start, end):
         return (self.created >= start) & (self.created <= end)
 
     @classmethod
+    @cache.cached('service_requests')
     def count_by_day(cls, start, end):
+        """Return ``(date, calls)`` tuples for every day in the window.
+
+        Whole days are answered from the ``DailyCallCount`` rollup when it's
+        up to date, and only the partial days at the edges of the window are
+        counted from the raw table.
+
+        """
+        return cls._count_by(DailyCallCount, start, end)
+
+    @classmethod
+    @cache.cached('service_requests')
+    def count_by_day_and_borough(cls, start, end):
+        return cls._count_by(DailyCallCount, start, end, 'borough')
+
+    @classmethod
+    @cache.cached('service_requests')
+    def count_by_day_and_type(cls, start, end):
+        return cls._count_by(DailyCallCount, start, end, 'type')
+
+    @classmethod
+    @cache.cached('service_requests')
+    def count_by_hour(cls, start, end):
+        return cls._count_by(HourlyCallCount, start, end)
+
+    @classmethod
+    @cache.cached('service_requests')
+    def count_by_hour_and_borough(cls, start, end):
+        return cls._count_by(HourlyCallCount, start, end, 'borough')
+
+    @classmethod
+    def count_by_day_many(cls, periods):
+        """``count_by_day`` for many ``(start, end)`` windows in one query.
+
+        Returns ``{(start, end): [(date, calls), ...]}``. Every window is
+        split like ``count_by_day`` does, and the pieces are sent as
+        ``VALUES`` lists tagged with the window they belong to, so comparing
+        hundreds of storms costs one round trip instead of one per storm.
+
+        """
+        return cls._count_by_many(DailyCallCount, periods)
+
+    @classmethod
+    def count_by_hour_many(cls, periods):
+        return cls._count_by_many(HourlyCallCount, periods)
+
+    @classmethod
+    def _count_by_many(cls, rollup, periods):
+        periods = list(dict.fromkeys(tuple(period) for period in periods))
+
+        if not periods:
+            return {}
+
+        bounds = cls._naive_bounds(*[value for period in periods for value in period])
+        in_sync = RollupState.in_sync()
+        whole = []
+        edges = []
+
+        for idx in range(len(periods)):
+            start, end = bounds[2 * idx], bounds[2 * idx + 1]
+
+            if in_sync:
+                first, stop, pieces = windows.split_window(start, end, rollup.STEP)
+            else:
+                first, stop, pieces = None, None, [(start, end, True)]
+
+            if first is not None:
+                whole.append((idx, first, stop))
+
+            edges.extend((idx,) + piece for piece in pieces)
+
+        table = rollup._meta.db_table
+        bucket = rollup.bucket_field().db_column
+        ctes = []
+        selects = []
+        params = []
+
+        if whole:
+            rows = ', '.join(
+                ['(%s::integer, %s::timestamp, %s::timestamp)'] * len(whole)
+            )
+            ctes.append(f"whole (id, first, stop) AS (VALUES {rows})")
+            selects.append(f"""
+                SELECT whole.id, counts.{bucket} AS bucket, counts.calls
+                FROM whole
+                JOIN {table} AS counts
+                    ON counts.{bucket} >= whole.first
+                    AND counts.{bucket} < whole.stop
+            """)
+            params.extend(value for row in whole for value in row)
+
+        if edges:
+            rows = ', '.join(
+                ['(%s::integer, %s::timestamp, %s::timestamp, %s::boolean)'] * len(edges)
+            )
+            ctes.append(f"edges (id, low, high, inclusive) AS (VALUES {rows})")
+            selects.append(f"""
+                SELECT edges.id, {rollup.BUCKET_SQL} AS bucket, COUNT(*) AS calls
+                FROM edges
+                JOIN service_requests
+                    ON created >= edges.low
+                    AND created <= edges.high
+                    AND (edges.inclusive OR created < edges.high)
+                GROUP BY 1, 2
+            """)
+            params.extend(value for row in edges for value in row)
+
+        cursor = DB.execute_sql(
+            f"""
+            WITH {', '.join(ctes)}
+            SELECT id, bucket, SUM(calls)::bigint
+            FROM ({' UNION ALL '.join(selects)}) AS pieces
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            """,
+            params,
+        )
+        result = {period: [] for period in periods}
+
+        for idx, day, calls in cursor:
+            result[periods[idx]].append((day, calls))
+
+        return result
+
+    @classmethod
+    def _count_by(cls, rollup, start, end, *dimensions):
+        start, end = cls._naive_bounds(start, end)
+
+        if RollupState.in_sync():
+            first, stop, edges = windows.split_window(start, end, rollup.STEP)
+        else:
+            first, stop, edges = None, None, [(start, end, True)]
+
+        counts = collections.Counter()
+
+        if first is not None:
+            for row in rollup.totals(first, stop, dimensions):
+                counts[row[:-1]] += row[-1]
+
+        if edges:
+            for row in cls._raw_counts(rollup, edges, dimensions):
+                counts[row[:-1]] += row[-1]
+
+        return sorted(key + (calls,) for key, calls in counts.items())
+
+    @classmethod
+    @cache.cached('service_requests')
+    def time_to_close(cls, start, end, percentiles=(50, 90, 99)):
+        """Percentiles of the seconds it took to close requests in the window.
+
+        Returns one value per percentile, accurate to within 1% (see
+        ``sketches``). Whole days are merged from the ``DurationSketch``
+        rollup, and only the partial days at the edges are read raw.
+
+        """
+        rows = cls._time_to_close_by(start, end, percentiles)
+        return list(rows[0]) if rows else [None] * len(percentiles)
+
+    @classmethod
+    @cache.cached('service_requests')
+    def time_to_close_by_day(cls, start, end, percentiles=(50, 90, 99)):
+        """Return ``(date, p50, p90, p99)`` tuples for every day in the window."""
+        return cls._time_to_close_by(start, end, percentiles, 'day')
+
+    @classmethod
+    @cache.cached('service_requests')
+    def time_to_close_by_borough(cls, start, end, percentiles=(50, 90, 99)):
+        return cls._time_to_close_by(start, end, percentiles, 'borough')
+
+    @classmethod
+    @cache.cached('service_requests')
+    def time_to_close_by_agency(cls, start, end, percentiles=(50, 90, 99)):
+        return cls._time_to_close_by(start, end, percentiles, 'agency')
+
+    @classmethod
+    @cache.cached('service_requests')
+    def time_to_close_by_day_and_borough(cls, start, end,
+                                         percentiles=(50, 90, 99)):
+        return cls._time_to_close_by(start, end, percentiles, 'day', 'borough')
+
+    @classmethod
+    def _time_to_close_by(cls, start, end, percentiles, *dimensions):
+        start, end = cls._naive_bounds(start, end)
+
+        if RollupState.in_sync():
+            first, stop, edges = windows.split_window(start, end, windows.DAY)
+        else:
+            first, stop, edges = None, None, [(start, end, True)]
+
+        buckets = collections.defaultdict(list)
+
+        if first is not None:
+            for row in DurationSketch.buckets(first, stop, dimensions):
+                buckets[row[:-2]].append(row[-2:])
+
+        if edges:
+            columns = [
+                ROLLUP_DIMENSIONS[dimension](cls) for dimension in dimensions
+            ]
+            query = (
+                cls
+                .select(*(columns + [
+                    peewee.SQL(sketches.key_sql('duration')),
+                    peewee.fn.COUNT(peewee.SQL('*')),
+                ]))
+                .where(cls._in_edges(edges), cls.duration >= 0)
+                .group_by(*[
+                    peewee.SQL(str(idx + 1))
+                    for idx in range(len(columns) + 1)
+                ])
+                .tuples()
+            )
+
+            for row in map(_unspecified, query):
+                buckets[row[:-2]].append(row[-2:])
+
+        return sorted(
+            key + tuple(sketches.quantiles(
+                [bucket for bucket, _ in rows],
+                [calls for _, calls in rows],
+                percentiles,
+            ))
+            for key, rows in buckets.items()
+        )
+
+    @classmethod
+    def _in_edges(cls, edges):
+        """Expression matching rows inside any of the ``split_window`` edges."""
+        return functools.reduce(operator.or_, [
+            (cls.created >= low) &
+            ((cls.created <= high) if inclusive else (cls.created < high))
+            for low, high, inclusive in edges
+        ])
+
+    @classmethod
+    def _raw_counts(cls, rollup, edges, dimensions):
+        where = cls._in_edges(edges)
+        columns = [rollup.bucket(cls.created)] + [
+            ROLLUP_DIMENSIONS[dimension](cls) for dimension in dimensions
+        ]
+
         query = (
             cls
+            .select(*(columns + [peewee.fn.COUNT(cls.id)]))
+            .where(where)
+            .group_by(*[peewee.SQL(str(idx + 1)) for idx in range(len(columns))])
+            .tuples()
+        )
+
+        return map(_unspecified, query)
+
+    @classmethod
+    @cache.cached('service_requests')
+    def heat_grid(cls, query=None, cell_size=None, geohash_precision=None,
+                  start=None, end=None):
+        """Bin points into a weighted grid for heatmaps.
+
+        Pass either ``cell_size`` (in degrees) or ``geohash_precision``.
+        Returns an ``(n, 3)`` array of ``(lat, lng, weight)`` rows, one per
+        non-empty cell, so the size depends on the map area rather than the
+        number of calls.
+
+        With only ``start`` and ``end``, whole days come from the cached
+        per-day ``HeatTile`` table, as long as the rollups are up to date.
+        With a ``query`` (filtered the same way as for ``lat_lngs``) the
+        binning always runs live in Postgres.
+
+        """
+        grid = grids.Grid.from_options(cell_size, geohash_precision)
+
+        if (query is None and start is not None and end is not None
+                and RollupState.in_sync()):
+            start, end = cls._naive_bounds(start, end)
+            first, stop, edges = windows.split_window(start, end, windows.DAY)
+            parts = []
+
+            if first is not None:
+                parts.append(HeatTile.totals(grid, first.date(), stop.date()))
+
+            if edges:
+                parts.append(cls._bin(grid, cls.select().where(cls._in_edges(edges))))
+
+            return grid.to_points(*parts)
+
+        if query is None:
+            query = cls.select()
+
+        if start is not None:
+            query = query.where(cls.created >= start)
+
+        if end is not None:
+            query = query.where(cls.created <= end)
+
+        return grid.to_points(cls._bin(grid, query))
+
+    @classmethod
+    def _bin(cls, grid, query):
+        # Bin over a subquery so the caller's ORDER BY and LIMIT pick the
+        # points, like they do for ``lat_lngs``.
+        sql, params = (
+            query
+            .select(cls.latitude, cls.longitude)
+            .where(cls.latitude != None, cls.longitude != None)
+            .sql()
+        )
+
+        return columnar.fetch_sql(
+            DB,
+            f"SELECT {grid.row_sql()}::double precision, "
+            f"{grid.col_sql()}::double precision, "
+            f"COUNT(*)::double precision "
+            f"FROM ({sql}) AS points GROUP BY 1, 2",
+            params,
+            3,
+        )
+
+    @classmethod
+    def count_near_events(cls, events, radius, before=None, after=None):
+        """Count the calls within ``radius`` metres of each event.
+
+        ``events`` is a query on ``PermittedEvent`` or ``Event``. A call
+        counts for an event if it was created between the event's start and
+        end, widened by the ``before`` and ``after`` timedeltas. Every event
+        is expanded into the cells around it and joined against the index on
+        ``(cell, created)``, so thousands of events take a single query.
+
+        Returns ``{event id: calls}`` for the events that have a location.
+
+        """
+        if db.embedded():
+            return cls._count_near_each_event(events, radius, before, after)
+
+        model = events.model_class
+        sql, params = (
+            events
             .select(
-                peewee.fn.DATE(cls.created).alias('date'),
-                peewee.fn.COUNT(cls.id).alias('calls'),
+                model.id,
+                model.latitude,
+                model.longitude,
+                model.start_time,
+                model.end_time,
             )
-            .where(cls.happened_between(start, end))
+            .where(model.latitude != None, model.longitude != None)
+            .sql()
         )
-        query = (
-            query
-            .group_by(query.c.date)
-            .order_by(query.c.date.asc())
+        grid = spatial.CELL_GRID
+        lat_metres = math.radians(grid.lat_size) * spatial.EARTH_RADIUS
+        lng_metres = math.radians(grid.lng_size) * spatial.EARTH_RADIUS
+        lat_steps = math.ceil(radius / lat_metres)
+        distance = spatial.distance_sql(
+            'probes.latitude',
+            'probes.longitude',
+            'calls.latitude',
+            'calls.longitude',
+        )
+
+        cursor = DB.execute_sql(
+            f"""
+            WITH events AS ({sql}),
+            probes AS (
+                SELECT
+                    events.*,
+                    {grid.cell_sql('events.latitude', 'events.longitude')}
+                        + lat_steps.step * {grid.columns}
+                        + lng_steps.step AS cell
+                FROM events
+                CROSS JOIN generate_series(-%s, %s) AS lat_steps (step)
+                CROSS JOIN LATERAL generate_series(
+                    -ceil(%s / (%s * cos(radians(events.latitude))))::integer - 1,
+                    ceil(%s / (%s * cos(radians(events.latitude))))::integer + 1
+                ) AS lng_steps (step)
+            )
+            SELECT probes.id, COUNT(calls.id)
+            FROM probes
+            LEFT JOIN {cls._meta.db_table} AS calls
+                ON calls.cell = probes.cell
+                AND calls.created >= probes.start_time - %s
+                AND calls.created <= probes.end_time + %s
+                AND {distance} <= %s
+            GROUP BY probes.id
+            """,
+            list(params) + [
+                lat_steps,
+                lat_steps,
+                radius,
+                lng_metres,
+                radius,
+                lng_metres,
+                before or datetime.timedelta(),
+                after or datetime.timedelta(),
+                radius,
+            ],
         )
 
-        return query.tuples()
+        return dict(cursor.fetchall())
 
     @classmethod
+    def _count_near_each_event(cls, events, radius, before=None, after=None):
+        """``count_near_events`` with one ``near`` query per event.
+
+        SQLite has no ``LATERAL`` or ``generate_series`` to expand the events
+        into cells with.
+
+        """
+        model = events.model_class
+        before = before or datetime.timedelta()
+        after = after or datetime.timedelta()
+        counts = {}
+
+        events = (
+            events
+            .select(
+                model.id,
+                model.latitude,
+                model.longitude,
+                model.start_time,
+                model.end_time,
+            )
+            .where(model.latitude != None, model.longitude != None)
+        )
+
+        for event in events:
+            if event.start_time is None or event.end_time is None:
+                counts[event.id] = 0
+                continue
+
+            counts[event.id] = (
+                cls
+                .select()
+                .where(
+                    cls.near(float(event.latitude), float(event.longitude), radius),
+                    cls.created >= event.start_time - before,
+                    cls.created <= event.end_time + after,
+                )
+                .count()
+            )
+
+        return counts
+
+    @staticmethod
+    def _naive_bounds(*values):
+        """Convert window bounds to naive datetimes like Postgres compares them.
+
+        ``created`` is a ``timestamp without time zone``, so an aware bound
+        gets converted with the session time zone. Let the database do that
+        conversion so the rollup path and the raw path agree. SQLite has no
+        session time zone, so it's the local one there (see ``embedded``).
+
+        """
+        values = [windows.as_datetime(value) for value in values]
+
+        if any(value.tzinfo for value in values):
+            if db.embedded():
+                from data_jam import embedded
+
+                values = [embedded.naive(value) for value in values]
+            else:
+                placeholders = ', '.join(['%s::timestamp'] * len(values))
+                values = list(
+                    DB.execute_sql(f"SELECT {placeholders}", values).fetchone()
+                )
+
+        return values
+
+    @classmethod
+    @cache.cached('service_requests')
     def lat_lngs(cls, query=None):
+        """Return an ``(n, 2)`` float array of latitude/longitude pairs."""
         query = (
             (query or cls.select())
-            .select(cls.latitude, cls.longitude)
             .where(cls.latitude != None, cls.longitude != None)
         )
 
-        return numpy.asarray(query.tuples(), dtype=float)
+        return columnar.fetch_columns(query, cls.latitude, cls.longitude)
+
+
+# The lookup fields group by code and come back as names; see ``_unspecified``
+# for requests without a borough.
+ROLLUP_DIMENSIONS = {
+    'borough': lambda model: model.borough,
+    'type': lambda model: model.type,
+    'agency': lambda model: model.agency,
+    'day': lambda model: peewee.fn.DATE(model.created),
+}
+
+
+def _unspecified(row):
+    """Name missing boroughs ``'Unspecified'``, like the rollup tables do."""
+    return tuple('Unspecified' if value is None else value for value in row)
+
+
+class RollupState(peewee.Model):
+    """Bookkeeping for the service request rollup tables.
+
+    ``last_id`` is the highest ``ServiceRequest.id`` that has been rolled up.
+    Updates and deletes of older rows are caught by a trigger that records
+    their days in ``service_request_dirty_days`` (see migration 006).
+
+    Ids are handed out when a row is inserted but only show up when it's
+    committed, so an import that commits after a later one could end up
+    below the watermark. ``refresh`` locks out writers to rule that out.
+
+    """
+    last_id = peewee.BigIntegerField(null=False, default=0)
+
+    class Meta:
+        db_table = 'service_request_rollup_state'
+        database = DB
+
+    @classmethod
+    def in_sync(cls):
+        """True if the rollups reflect every row in ``service_requests``."""
+        cursor = DB.execute_sql("""
+            SELECT
+                (SELECT COALESCE(MAX(id), 0) FROM service_requests) <= last_id
+                AND NOT EXISTS (SELECT 1 FROM service_request_dirty_days)
+            FROM service_request_rollup_state
+        """)
+        row = cursor.fetchone()
+
+        return bool(row and row[0])
+
+    @classmethod
+    def refresh(cls, rebuild=False):
+        """Bring the rollups up to date with ``service_requests``.
+
+        Only the days touched by rows added since the last refresh, plus the
+        days flagged dirty by updates and deletes, are recomputed. Returns the
+        set of days that were refreshed.
+
+        """
+        with DB.atomic():
+            if rebuild:
+                for model in ROLLUP_MODELS:
+                    DB.execute_sql(f"TRUNCATE {model._meta.db_table}")
+
+                cls.update(last_id=0).execute()
+
+            if not db.embedded():
+                # Waits for the imports in flight to commit, and holds new
+                # ones off until the watermark is stored, so every id they
+                # get is above it. SQLite only has one writer anyway.
+                DB.execute_sql(
+                    "LOCK TABLE service_requests IN SHARE ROW EXCLUSIVE MODE"
+                )
+
+            state = cls.get()
+            max_id = DB.execute_sql(
+                "SELECT COALESCE(MAX(id), 0) FROM service_requests"
+            ).fetchone()[0]
+            days = {
+                row[0]
+                for row in DB.execute_sql(
+                    "SELECT DISTINCT created::date FROM service_requests "
+                    "WHERE id > %s AND id <= %s",
+                    (state.last_id, max_id),
+                )
+            }
+            days.update(
+                row[0]
+                for row in DB.execute_sql(
+                    "DELETE FROM service_request_dirty_days RETURNING day"
+                )
+            )
+
+            for first, last in windows.runs(days):
+                for model in ROLLUP_MODELS:
+                    model.refresh_range(first, last + windows.DAY)
+
+                HeatTile.invalidate(first, last + windows.DAY)
+
+            cls.update(last_id=max_id).execute()
+
+        if rebuild:
+            cache.CACHE.invalidate('service_requests')
+
+        for first, last in windows.runs(days):
+            cache.CACHE.invalidate('service_requests', first, last)
+
+        return days
+
+
+class CallCount(peewee.Model):
+    """Base class for the pre-aggregated service request counts.
+
+    Subclasses add their bucket column and say how to compute it from
+    ``ServiceRequest.created``, both as a peewee expression (``bucket``) and
+    as SQL for the refresh (``BUCKET_SQL``).
+
+    """
+    borough = peewee.CharField(null=False)
+    type = peewee.CharField(null=False)
+    calls = peewee.IntegerField(null=False)
+
+    class Meta:
+        database = DB
+
+    @classmethod
+    def totals(cls, first, stop, dimensions):
+        bucket = cls.bucket_field()
+        columns = [bucket] + [getattr(cls, dimension) for dimension in dimensions]
+
+        return (
+            cls
+            .select(*(columns + [peewee.fn.SUM(cls.calls)]))
+            .where(bucket >= first, bucket < stop)
+            .group_by(*columns)
+            .tuples()
+        )
+
+    @classmethod
+    def refresh_range(cls, start, stop):
+        """Recompute the buckets for ``start <= created < stop``."""
+        table = cls._meta.db_table
+        bucket = cls.bucket_field().db_column
+        DB.execute_sql(
+            f"DELETE FROM {table} WHERE {bucket} >= %s AND {bucket} < %s",
+            (start, stop),
+        )
+        DB.execute_sql(
+            f"""
+            INSERT INTO {table} ({bucket}, borough, type, calls)
+            SELECT counts.bucket, COALESCE(boroughs.name, 'Unspecified'),
+                   types.name, SUM(counts.calls)
+            FROM (
+                SELECT {cls.BUCKET_SQL} AS bucket, borough_id, type_id,
+                       COUNT(*) AS calls
+                FROM service_requests
+                WHERE created >= %s AND created < %s
+                GROUP BY 1, 2, 3
+            ) AS counts
+            LEFT JOIN service_request_boroughs AS boroughs
+                ON boroughs.id = counts.borough_id
+            JOIN service_request_types AS types ON types.id = counts.type_id
+            GROUP BY 1, 2, 3
+            """,
+            (start, stop),
+        )
+
+
+class DailyCallCount(CallCount):
+    """Service request counts per day, borough and complaint type."""
+    day = peewee.DateField(null=False)
+
+    STEP = windows.DAY
+    BUCKET_SQL = 'created::date'
+
+    class Meta:
+        db_table = 'service_request_daily_counts'
+        database = DB
+        primary_key = peewee.CompositeKey('day', 'borough', 'type')
+
+    @classmethod
+    def bucket(cls, created):
+        return peewee.fn.DATE(created)
+
+    @classmethod
+    def bucket_field(cls):
+        return cls.day
+
+
+class HourlyCallCount(CallCount):
+    """Service request counts per hour, borough and complaint type."""
+    hour = peewee.DateTimeField(null=False)
+
+    STEP = windows.HOUR
+    BUCKET_SQL = "date_trunc('hour', created)"
+
+    class Meta:
+        db_table = 'service_request_hourly_counts'
+        database = DB
+        primary_key = peewee.CompositeKey('hour', 'borough', 'type')
+
+    @classmethod
+    def bucket(cls, created):
+        return peewee.fn.date_trunc('hour', created)
+
+    @classmethod
+    def bucket_field(cls):
+        return cls.hour
+
+
+class DurationSketch(peewee.Model):
+    """Sketches of the time to close per day, borough and agency.
+
+    ``keys`` and ``counts`` are the non-empty buckets of a sketch, see
+    ``data_jam.sketches``. Requests that aren't closed yet (or were closed
+    before they were created) are left out.
+
+    """
+    day = peewee.DateField(null=False)
+    borough = peewee.CharField(null=False)
+    agency = peewee.CharField(null=False)
+    keys = ArrayField(field_class=peewee.IntegerField)
+    counts = ArrayField(field_class=peewee.IntegerField)
+
+    class Meta:
+        db_table = 'service_request_duration_sketches'
+        database = DB
+        primary_key = peewee.CompositeKey('day', 'borough', 'agency')
+
+    @classmethod
+    def buckets(cls, first, stop, dimensions):
+        """Merged ``(*dimensions, key, count)`` rows for ``first <= day < stop``."""
+        columns = [f'sketch.{dimension}' for dimension in dimensions]
+
+        if db.embedded():
+            # The arrays are JSON there, and element n of one goes with
+            # element n of the other.
+            key, calls = 'keys.value', 'counts.value'
+            unnest = (
+                "json_each(sketch.keys) AS keys "
+                "JOIN json_each(sketch.counts) AS counts ON counts.key = keys.key"
+            )
+        else:
+            key, calls = 'bucket.key', 'bucket.calls'
+            unnest = "unnest(sketch.keys, sketch.counts) AS bucket (key, calls)"
+
+        group_by = ', '.join(columns + [key])
+
+        return DB.execute_sql(
+            f"""
+            SELECT {group_by}, SUM({calls})
+            FROM {cls._meta.db_table} AS sketch, {unnest}
+            WHERE sketch.day >= %s AND sketch.day < %s
+            GROUP BY {group_by}
+            """,
+            (first, stop),
+        ).fetchall()
+
+    @classmethod
+    def refresh_range(cls, start, stop):
+        """Recompute the sketches for ``start <= created < stop``."""
+        table = cls._meta.db_table
+
+        if db.embedded():
+            # json_group_array only takes an ORDER BY since SQLite 3.44, so
+            # feed it sorted rows. Both arrays see the same rows either way.
+            aggregate = "json_group_array(key), json_group_array(calls)"
+            order_by = "ORDER BY 1, 2, 3, 4"
+        else:
+            aggregate = "array_agg(key ORDER BY key), array_agg(calls ORDER BY key)"
+            order_by = ""
+
+        DB.execute_sql(
+            f"DELETE FROM {table} WHERE day >= %s AND day < %s",
+            (start, stop),
+        )
+        DB.execute_sql(
+            f"""
+            INSERT INTO {table} (day, borough, agency, keys, counts)
+            SELECT day, borough, agency, {aggregate}
+            FROM (
+                SELECT buckets.day,
+                       COALESCE(boroughs.name, 'Unspecified') AS borough,
+                       agencies.name AS agency,
+                       buckets.key,
+                       SUM(buckets.calls) AS calls
+                FROM (
+                    SELECT created::date AS day, borough_id, agency_id,
+                           {sketches.key_sql('duration')} AS key,
+                           COUNT(*) AS calls
+                    FROM service_requests
+                    WHERE created >= %s AND created < %s AND duration >= 0
+                    GROUP BY 1, 2, 3, 4
+                ) AS buckets
+                LEFT JOIN service_request_boroughs AS boroughs
+                    ON boroughs.id = buckets.borough_id
+                JOIN service_request_agencies AS agencies
+                    ON agencies.id = buckets.agency_id
+                GROUP BY 1, 2, 3, 4
+                {order_by}
+            ) AS named
+            GROUP BY 1, 2, 3
+            """,
+            (start, stop),
+        )
+
+
+ROLLUP_MODELS = (DailyCallCount, HourlyCallCount, DurationSketch)
+
+
+class HeatTile(peewee.Model):
+    """Per-day heatmap cell weights, cached for each grid that was asked for.
+
+    ``HeatTileDay`` records which days have been computed for a grid, since a
+    day without any located calls has no tiles at all.
+
+    """
+    grid = peewee.CharField(null=False)
+    day = peewee.DateField(null=False)
+    cell_row = peewee.IntegerField(null=False)
+    cell_col = peewee.IntegerField(null=False)
+    weight = peewee.IntegerField(null=False)
+
+    class Meta:
+        db_table = 'service_request_heat_tiles'
+        database = DB
+        primary_key = peewee.CompositeKey('grid', 'day', 'cell_row', 'cell_col')
+
+    @classmethod
+    def totals(cls, grid, first, stop):
+        """``(cell_row, cell_col, weight)`` summed over ``first <= day < stop``."""
+        cls.ensure(grid, first, stop)
+        query = (
+            cls
+            .select()
+            .where(cls.grid == grid.key, cls.day >= first, cls.day < stop)
+            .group_by(cls.cell_row, cls.cell_col)
+        )
+
+        return columnar.fetch_columns(
+            query,
+            cls.cell_row,
+            cls.cell_col,
+            peewee.fn.SUM(cls.weight),
+        )
+
+    @classmethod
+    def ensure(cls, grid, first, stop):
+        """Compute the tiles for any day in ``[first, stop)`` that has none.
+
+        Two readers can fill in the same day at once, in which case the second
+        one's rows are dropped as duplicates.
+
+        """
+        done = {
+            row[0]
+            for row in (
+                HeatTileDay
+                .select(HeatTileDay.day)
+                .where(
+                    HeatTileDay.grid == grid.key,
+                    HeatTileDay.day >= first,
+                    HeatTileDay.day < stop,
+                )
+                .tuples()
+            )
+        }
+        missing = [
+            day
+            for day in (
+                first + datetime.timedelta(days=offset)
+                for offset in range((stop - first).days)
+            )
+            if day not in done
+        ]
+
+        with DB.atomic():
+            for run_first, run_last in windows.runs(missing):
+                run_stop = run_last + windows.DAY
+                DB.execute_sql(
+                    f"""
+                    INSERT INTO service_request_heat_tiles
+                        (grid, day, cell_row, cell_col, weight)
+                    SELECT %s, created::date, {grid.row_sql()},
+                           {grid.col_sql()}, COUNT(*)
+                    FROM service_requests
+                    WHERE created >= %s AND created < %s
+                      AND latitude IS NOT NULL AND longitude IS NOT NULL
+                    GROUP BY 2, 3, 4
+                    ON CONFLICT DO NOTHING
+                    """,
+                    (grid.key, run_first, run_stop),
+                )
+                days = [
+                    run_first + datetime.timedelta(days=offset)
+                    for offset in range((run_stop - run_first).days)
+                ]
+                DB.execute_sql(
+                    "INSERT INTO service_request_heat_tile_days (grid, day) "
+                    f"VALUES {', '.join(['(%s, %s)'] * len(days))} "
+                    "ON CONFLICT DO NOTHING",
+                    [value for day in days for value in (grid.key, day)],
+                )
+
+    @classmethod
+    def invalidate(cls, start, stop):
+        """Forget the tiles of every grid for ``start <= day < stop``."""
+        DB.execute_sql(
+            "DELETE FROM service_request_heat_tiles "
+            "WHERE day >= %s AND day < %s",
+            (start, stop),
+        )
+        DB.execute_sql(
+            "DELETE FROM service_request_heat_tile_days "
+            "WHERE day >= %s AND day < %s",
+            (start, stop),
+        )
+
+
+class HeatTileDay(peewee.Model):
+    grid = peewee.CharField(null=False)
+    day = peewee.DateField(null=False)
+
+    class Meta:
+        db_table = 'service_request_heat_tile_days'
+        database = DB
+        primary_key = peewee.CompositeKey('grid', 'day')
 
 
 class Storm(peewee.Model):
@@ -139,24 +1302,52 @@ class Storm(peewee.Model):
         database = DB
 
     @classmethod
-    @DB.atomic()
-    def import_from_csv(cls, file_obj):
-        reader = csv.DictReader(file_obj)
-        rows = []
+    @cache.cached('storms')
+    def in_window(cls, start, end):
+        """Storms between ``start`` and ``end`` as dicts, ordered by date."""
+        return list(
+            cls
+            .select(
+                cls.id,
+                cls.date,
+                cls.type,
+                cls.county,
+                cls.borough.alias('borough'),
+                cls.deaths,
+                cls.injured,
+            )
+            .where(cls.date >= start, cls.date <= end)
+            .order_by(cls.date, cls.id)
+            .dicts()
+        )
 
-        for row in reader:
-            rows.append({
-                'county': row['county'],
-                'date': date_parse(row['date']).date(),
-                'type': row['type'],
-                'deaths': row['dth'],
-                'injured': row['inj'],
-            })
+    @classmethod
+    def import_from_csv(cls, source):
+        """Import ``data/storms.csv``, a ``sources.Source`` or a path."""
+        from dateutil.parser import parse as date_parse
 
-        cls.insert_many(rows).execute()
+        with metrics.stage('parse') as span, sources.reading(source) as source:
+            rows = [
+                {
+                    'county': row['county'],
+                    'date': date_parse(row['date']).date(),
+                    'type': row['type'],
+                    'deaths': row['dth'],
+                    'injured': row['inj'],
+                }
+                for row in csv.DictReader(source.text)
+            ]
+            span.rows = len(rows)
 
+        with metrics.stage('insert', rows=len(rows)), DB.atomic():
+            cls.insert_many(rows).execute()
+
+        if rows:
+            dates = [row['date'] for row in rows]
+            cache.CACHE.invalidate('storms', min(dates), max(dates))
 
-class PermittedEvent(peewee.Model):
+
+class PermittedEvent(spatial.LocatedMixin, peewee.Model):
     name = peewee.CharField(max_length=1000, null=True)
     borough = peewee.CharField(null=True, index=True)
     latitude = peewee.DecimalField(
@@ -171,40 +1362,57 @@ class PermittedEvent(peewee.Model):
     )
     start_time = peewee.DateTimeField(null=False)
     end_time = peewee.DateTimeField(null=False)
+    cell = peewee.BigIntegerField(null=True, index=True)
 
     class Meta:
         db_table = 'permitted_events'
         database = DB
 
     @classmethod
-    @DB.atomic()
-    def import_from_csv(cls, file_obj):
-        reader = csv.DictReader(file_obj)
+    def import_from_csv(cls, source, geocoder=None):
+        """Import the permitted events CSV, a ``sources.Source`` or a path."""
+        geocoder = geocoder or geocoding.CachedGeocoder()
+
+        with metrics.stage('parse') as span, sources.reading(source) as source:
+            reader = list(csv.DictReader(source.text))
+            span.rows = len(reader)
+
+        with metrics.stage('geocode', rows=len(reader)):
+            locations = geocoder.resolve(row['Event Location'] for row in reader)
+
+        timestamp = _timestamp_parser()
         rows = []
 
         for row in reader:
-            coded = geocoder.google(row['Event Location'])
+            coded = locations.get(row['Event Location'])
 
-            if coded.ok:
-                longitude, latitude = (
-                    coded.geojson['features'][0]['geometry']['coordinates']
-                )
+            if coded:
+                latitude, longitude = coded
             else:
                 continue
 
             rows.append({
                 'name': row['Event Name'],
-                'start_time': row['Start Date/Time'],
-                'end_time': row['End Date/Time'],
+                'start_time': timestamp(row['Start Date/Time']),
+                'end_time': timestamp(row['End Date/Time']),
                 'borough': row['Event Borough'].upper(),
                 'latitude': latitude,
                 'longitude': longitude,
             })
 
-        cls.insert_many(rows).execute()
+        with metrics.stage('insert', rows=len(rows)), DB.atomic():
+            cls.insert_many(rows).execute()
+
+        metrics.progress(
+            geocoder.summary(),
+            geocoded=geocoder.requested,
+            cache_hits=geocoder.hits,
+            cache_misses=geocoder.misses,
+            failures=geocoder.failures,
+        )
 
 
-class Event(peewee.Model):
+class Event(spatial.LocatedMixin, peewee.Model):
     short_description = peewee.CharField(null=True)
     description = peewee.TextField(null=True)
     start_time = peewee.DateTimeField(index=True, null=True)
@@ -220,6 +1428,7 @@ class Event(peewee.Model):
         decimal_places=8,
         null=True,
     )
+    cell = peewee.BigIntegerField(null=True, index=True)
 
     NORMALIZED_BOURUGHS = {
         'qn': 'QUEENS',
@@ -235,71 +1444,113 @@ class Event(peewee.Model):
         database = DB
 
     @classmethod
-    def import_from_site(cls, start_page=1):
-        url = 'http://www1.nyc.gov/calendar/api/json/search.htm'
-        params = {
-            'sort': 'DATE',
-            'pageNumber': start_page,
-        }
-        is_last_page = False
+    def import_from_site(cls, start_page=1, concurrency=8, max_pages=None,
+                         url=None, record_to=None, geocoder=None):
+        """Crawl the NYC events calendar and import every event on it.
 
-        while not is_last_page:
-            resp = requests.get(url, params=params)
+        Up to ``concurrency`` pages are downloaded at once, with failed
+        requests retried using exponential backoff. ``url`` defaults to
+        ``crawler.EVENTS_URL``, and can point at a
+        ``crawler.recorded_pages_app`` stub to run this offline.
 
-            try:
-                resp.raise_for_status()
-            except requests.exceptions.HTTPError:
-                continue
+        """
+        from data_jam import crawler
+
+        geocoder = geocoder or geocoding.CachedGeocoder()
+        progress = {'pages': 0, 'events': 0}
+        timestamp = _timestamp_parser()
 
-            data = resp.json()
-            rows = []
+        def write(data):
+            with metrics.stage('geocode', rows=len(data['items'])):
+                locations = geocoder.resolve(
+                    item['address']
+                    for item in data['items']
+                    if not item.get('geometry')
+                )
+
+            with metrics.stage('parse') as span:
+                rows = [
+                    dict(
+                        row,
+                        start_time=timestamp(row['start_time']),
+                        end_time=timestamp(row['end_time']),
+                    )
+                    for item in data['items']
+                    for row in cls._rows_from_item(item, locations)
+                ]
+                span.rows = len(rows)
 
-            with DB.atomic():
-                for item in data['items']:
-                    geo = item.get('geometry')
+            with metrics.stage('insert', rows=len(rows)), DB.atomic():
+                if rows:
+                    cls.insert_many(rows).execute()
 
-                    if not geo:
-                        coded = geocoder.google(item['address'])
+            progress['pages'] += 1
+            progress['events'] += len(rows)
+            metrics.progress(
+                f"Imported {progress['events']} Events from "
+                f"{progress['pages']} pages!",
+                rows=progress['events'],
+                pages=progress['pages'],
+            )
 
-                        if not coded.ok:
-                            continue
+        crawler.run(crawler.crawl(
+            write,
+            start_page=start_page,
+            max_pages=max_pages,
+            concurrency=concurrency,
+            url=url or crawler.EVENTS_URL,
+            record_to=record_to,
+        ))
+        metrics.progress(
+            geocoder.summary(),
+            geocoded=geocoder.requested,
+            cache_hits=geocoder.hits,
+            cache_misses=geocoder.misses,
+            failures=geocoder.failures,
+        )
 
-                        longitude, latitude = (
-                            coded.geojson['features'][0]['geometry']['coordinates']
-                        )
+        return progress['events']
 
-                    else:
-                        longitude = geo[0]['lng']
-                        latitude = geo[0]['lat']
+    @classmethod
+    def _rows_from_item(cls, item, locations):
+        geo = item.get('geometry')
 
-                    soup = bs4.BeautifulSoup(item.get('desc', ''), 'html5lib')
+        if not geo:
+            coded = locations.get(item['address'])
 
-                    for borough in item['boroughs']:
-                        try:
-                            rows.append({
-                                'short_description': item['shortDesc'],
-                                'description': soup.get_text(),
-                                'start_time': item.get('startDate'),
-                                'end_time': item.get('endDate'),
-                                'borough': cls.NORMALIZED_BOURUGHS[borough.lower()],
-                                'latitude': decimal.Decimal(latitude),
-                                'longitude': decimal.Decimal(longitude),
-                            })
-                        except:
-                            continue
+            if not coded:
+                return []
 
-                cls.insert_many(rows).execute()
-                rows = []
-                params['pageNumber'] += 1
-                progress = data['pagination']['currentPage'] * 10
-                print(f"Imported {progress} Events!")
+            latitude, longitude = coded
 
+        else:
+            longitude = geo[0]['lng']
+            latitude = geo[0]['lat']
 
-            is_last_page = data['pagination']['isLastPage']
+        import bs4
+
+        soup = bs4.BeautifulSoup(item.get('desc', ''), 'html5lib')
+        rows = []
+
+        for borough in item['boroughs']:
+            try:
+                rows.append({
+                    'short_description': item['shortDesc'],
+                    'description': soup.get_text(),
+                    'start_time': item.get('startDate'),
+                    'end_time': item.get('endDate'),
+                    'borough': cls.NORMALIZED_BOURUGHS[borough.lower()],
+                    'latitude': decimal.Decimal(latitude),
+                    'longitude': decimal.Decimal(longitude),
+                })
+            except:
+                continue
+
+        return rows
 
 
 class Weather(peewee.Model):
-    date = peewee.DateField(null=False, index=True)
+    date = peewee.DateField(null=False, unique=True)
     temp_avg = peewee.DecimalField(
         max_digits=5,
         decimal_places=2,
@@ -338,26 +1589,90 @@ class Weather(peewee.Model):
         database = DB
 
     @classmethod
-    @DB.atomic()
-    def import_from_csv(cls, file_obj):
-        reader = csv.DictReader(file_obj)
-        rows = []
+    @cache.cached('weather')
+    def between(cls, start, end):
+        """Weather days between ``start`` and ``end`` as dicts."""
+        return list(
+            cls
+            .select()
+            .where(cls.date >= start, cls.date <= end)
+            .order_by(cls.date)
+            .dicts()
+        )
 
-        for row in reader:
-            events = [event.strip() for event in row['event'].split(',')]
+    @classmethod
+    def import_from_csv(cls, paths, workers=4):
+        """Load weather CSV files, replacing the days that are already there.
 
-            if events == ['']:
-                events = []
+        ``paths`` can mix files, directories and glob patterns. The files are
+        parsed in parallel and merged (see ``loaders.read_weather``), then
+        upserted on ``date``, so loading the same files twice changes nothing.
+        Returns the number of days read.
+
+        """
+        columns = loaders.read_weather(loaders.expand_paths(paths), workers)
+        names = [column for column, _ in loaders.WEATHER_COLUMNS]
+
+        if db.embedded():
+            from data_jam import embedded
+
+            total, changed = embedded.upsert(
+                DB,
+                cls._meta.db_table,
+                names,
+                zip(
+                    columns['date'].astype(str),
+                    *[columns[name].tolist() for name in names[1:-1]],
+                    map(cls.events.db_value, columns['events']),
+                ),
+                key='date',
+            )
+        else:
+            rows = zip(
+                columns['date'].astype(str),
+                *[columns[name] for name in names[1:-1]],
+                map(loaders.array_literal, columns['events']),
+            )
+            written = [0]
+
+            def on_commit(total, changed):
+                written[0] = changed
+
+            total = loaders.copy_rows(
+                DB.get_conn(),
+                cls._meta.db_table,
+                names,
+                rows,
+                on_commit=on_commit,
+                on_conflict='update',
+                key='date',
+            )
+            changed = written[0]
+
+        metrics.progress(
+            f"Read {total} days of weather! ({changed} new or changed)",
+            rows=total,
+            written=changed,
+        )
+
+        if total:
+            dates = columns['date']
+            cache.CACHE.invalidate('weather', dates[0].item(), dates[-1].item())
+
+        return total
 
-            rows.append({
-                'date': row['Date'],
-                'temp_avg': row['T_avg'],
-                'temp_low': row['T_low'],
-                'temp_high': row['T_high'],
-                'precipitation': row['R_sum'],
-                'humidity': row['H_high'],
-                'dew_point': row['DP_high'],
-                'events': events,
-            })
 
-        cls.insert_many(rows).execute()
+# Every model with a table of its own.
+TABLE_MODELS = (
+    ServiceRequest,
+    RollupState,
+    DailyCallCount,
+    HourlyCallCount,
+    DurationSketch,
+    HeatTile,
+    HeatTileDay,
+    Storm,
+    PermittedEvent,
+    Event,
+    Weather,
+)
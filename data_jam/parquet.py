@@ -0,0 +1,370 @@
+"""Export the tables to Parquet and query them without a database.
+
+``export`` streams every table out of Postgres through a server-side cursor
+and writes it as Arrow record batches into a Hive-partitioned dataset (one
+directory per ``year=``/``month=``), so memory use doesn't depend on the size
+of the table. ``ParquetStore`` then answers the common notebook questions
+from those files, only reading the columns and partitions it needs.
+
+pyarrow and NumPy are only imported when one of these is used.
+
+"""
+
+import collections
+import os
+import shutil
+
+from data_jam import db, windows
+
+
+BATCH_SIZE = 100000
+
+Export = collections.namedtuple('Export', ('table', 'date_column', 'fields'))
+
+# (column, Arrow type) pairs. ``year`` and ``month`` are added to all of them.
+EXPORTS = (
+    Export('service_requests', 'created', (
+        ('id', 'int64'),
+        ('unique_key', 'int64'),
+        ('agency', 'string'),
+        ('type', 'string'),
+        ('descriptor', 'string'),
+        ('borough', 'string'),
+        ('latitude', 'float64'),
+        ('longitude', 'float64'),
+        ('created', 'timestamp'),
+        ('closed', 'timestamp'),
+        ('duration', 'int64'),
+    )),
+    Export('storms', 'date', (
+        ('id', 'int64'),
+        ('county', 'string'),
+        ('borough', 'string'),
+        ('date', 'date'),
+        ('type', 'string'),
+        ('deaths', 'int64'),
+        ('injured', 'int64'),
+    )),
+    Export('weather', 'date', (
+        ('id', 'int64'),
+        ('date', 'date'),
+        ('temp_avg', 'float64'),
+        ('temp_low', 'float64'),
+        ('temp_high', 'float64'),
+        ('precipitation', 'float64'),
+        ('humidity', 'float64'),
+        ('dew_point', 'float64'),
+        ('events', 'list<string>'),
+    )),
+    Export('permitted_events', 'start_time', (
+        ('id', 'int64'),
+        ('name', 'string'),
+        ('borough', 'string'),
+        ('latitude', 'float64'),
+        ('longitude', 'float64'),
+        ('start_time', 'timestamp'),
+        ('end_time', 'timestamp'),
+    )),
+    Export('events', 'start_time', (
+        ('id', 'int64'),
+        ('short_description', 'string'),
+        ('description', 'string'),
+        ('borough', 'string'),
+        ('latitude', 'float64'),
+        ('longitude', 'float64'),
+        ('start_time', 'timestamp'),
+        ('end_time', 'timestamp'),
+    )),
+)
+TABLES = tuple(export.table for export in EXPORTS)
+
+
+def arrow_type(name):
+    import pyarrow
+
+    if name == 'list<string>':
+        return pyarrow.list_(pyarrow.string())
+
+    if name == 'timestamp':
+        return pyarrow.timestamp('us')
+
+    if name == 'date':
+        return pyarrow.date32()
+
+    return getattr(pyarrow, name)()
+
+
+def arrow_schema(export):
+    import pyarrow
+
+    return pyarrow.schema(
+        [(name, arrow_type(kind)) for name, kind in export.fields] +
+        [('year', pyarrow.int16()), ('month', pyarrow.int8())]
+    )
+
+
+def select_sql(export):
+    """``(sql, params)`` for an export, with codes and hybrids as plain values."""
+    import data_jam.models as models
+    from data_jam import lookups
+
+    table = export.table
+    expressions = {
+        name: f"{table}.{name}::double precision" if kind == 'float64'
+        else f"{table}.{name}"
+        for name, kind in export.fields
+    }
+    joins = []
+    params = []
+
+    if table == 'service_requests':
+        for column, lookup in lookups.SERVICE_REQUEST_LOOKUPS:
+            name = column[:-len('_id')]
+            expressions[name] = f"{name}_lookup.name"
+            joins.append(
+                f"LEFT JOIN {lookup} AS {name}_lookup "
+                f"ON {name}_lookup.id = {table}.{column}"
+            )
+    elif table == 'storms':
+        mapping = models.Storm.COUNTY_BOROUGH_MAPPING
+        expressions['borough'] = (
+            "CASE storms.county " +
+            ' '.join('WHEN %s THEN %s' for _ in mapping) +
+            " END"
+        )
+        params = [value for pair in mapping for value in pair]
+
+    date_column = f"{table}.{export.date_column}"
+    columns = [
+        f"{expressions[name]} AS {name}" for name, _ in export.fields
+    ] + [
+        f"date_part('year', {date_column})::smallint AS year",
+        f"date_part('month', {date_column})::smallint AS month",
+    ]
+
+    return (
+        f"SELECT {', '.join(columns)} FROM {table} {' '.join(joins)}",
+        params,
+    )
+
+
+def record_batches(export, schema, batch_size=BATCH_SIZE):
+    """Stream a table out of Postgres as Arrow record batches."""
+    import pyarrow
+
+    import data_jam.models as models
+
+    with models.DB.atomic():
+        cursor = models.DB.get_conn().cursor(name=f'export_{export.table}')
+        cursor.itersize = batch_size
+        cursor.execute(*select_sql(export))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+
+            if not rows:
+                break
+
+            yield pyarrow.RecordBatch.from_arrays(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(zip(*rows), schema)
+                ],
+                schema=schema,
+            )
+
+        cursor.close()
+
+
+def export(root, tables=TABLES, batch_size=BATCH_SIZE):
+    """Write ``tables`` to ``root/<table>/year=YYYY/month=M/*.parquet``.
+
+    A table's directory is replaced as a whole, once its export is
+    complete, so no partition of an earlier export is left behind. Returns
+    ``{table: rows}``. Only Postgres has the server-side cursors this reads
+    with.
+
+    """
+    if db.embedded():
+        raise ValueError("Exporting to Parquet needs a Postgres database.")
+
+    import pyarrow
+    import pyarrow.dataset
+
+    written = {}
+
+    for spec in EXPORTS:
+        if spec.table not in tables:
+            continue
+
+        schema = arrow_schema(spec)
+        counted = [0]
+        target = os.path.join(root, spec.table)
+        partial = f"{target}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        # Made up front, since an empty table writes no files at all.
+        os.makedirs(partial)
+
+        def batches():
+            for batch in record_batches(spec, schema, batch_size):
+                counted[0] += batch.num_rows
+                yield batch
+
+        pyarrow.dataset.write_dataset(
+            batches(),
+            partial,
+            schema=schema,
+            format='parquet',
+            partitioning=pyarrow.dataset.partitioning(
+                pyarrow.schema([
+                    ('year', pyarrow.int16()),
+                    ('month', pyarrow.int8()),
+                ]),
+                flavor='hive',
+            ),
+        )
+
+        if os.path.exists(target):
+            old = f"{target}.old"
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(target, old)
+            os.replace(partial, target)
+            shutil.rmtree(old)
+        else:
+            os.replace(partial, target)
+
+        written[spec.table] = counted[0]
+
+    return written
+
+
+def naive(value):
+    """Turn a bound into a naive datetime, the way Postgres compares them.
+
+    Dates become midnight, and aware datetimes are converted to local time,
+    which matches Postgres as long as its time zone is this machine's.
+
+    """
+    if value is None:
+        return None
+
+    value = windows.as_datetime(value)
+
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+
+    return value
+
+
+class ParquetStore(object):
+    """Read-only versions of the model queries, over an ``export`` directory.
+
+    Filters are pushed down into the scan: whole ``year``/``month``
+    directories are skipped, and Parquet row group statistics rule out the
+    rest of what they can.
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._datasets = {}
+
+    def dataset(self, table):
+        import pyarrow.dataset
+
+        if table not in self._datasets:
+            self._datasets[table] = pyarrow.dataset.dataset(
+                os.path.join(self.root, table),
+                format='parquet',
+                partitioning='hive',
+            )
+
+        return self._datasets[table]
+
+    def window(self, column, start=None, end=None, **where):
+        """Filter for ``start <= column <= end`` and ``name == value`` pairs."""
+        from pyarrow.dataset import field
+
+        expression = None
+
+        def both(condition):
+            return condition if expression is None else expression & condition
+
+        if start is not None:
+            expression = both(
+                (field('year') > start.year) |
+                ((field('year') == start.year) & (field('month') >= start.month))
+            )
+            expression = both(field(column) >= start)
+
+        if end is not None:
+            expression = both(
+                (field('year') < end.year) |
+                ((field('year') == end.year) & (field('month') <= end.month))
+            )
+            expression = both(field(column) <= end)
+
+        for name, value in where.items():
+            expression = both(field(name) == value)
+
+        return expression
+
+    def count_between(self, start, end, **where):
+        """Like ``ServiceRequest.happened_between(start, end)`` and ``count()``."""
+        return self.dataset('service_requests').count_rows(
+            filter=self.window('created', naive(start), naive(end), **where),
+        )
+
+    def count_by_day(self, start, end, **where):
+        """Return ``(date, calls)`` tuples, like ``ServiceRequest.count_by_day``."""
+        import numpy
+
+        table = self.dataset('service_requests').to_table(
+            columns=['created'],
+            filter=self.window('created', naive(start), naive(end), **where),
+        )
+        days, calls = numpy.unique(
+            table['created'].to_numpy().astype('datetime64[D]'),
+            return_counts=True,
+        )
+
+        return [
+            (day.item(), int(count))
+            for day, count in zip(days, calls)
+        ]
+
+    def lat_lngs(self, start=None, end=None, limit=None, **where):
+        """``(n, 2)`` array of coordinates, like ``ServiceRequest.lat_lngs``.
+
+        ``where`` takes column equalities, e.g. ``borough='BROOKLYN'``.
+
+        """
+        import numpy
+        from pyarrow.dataset import field
+
+        dataset = self.dataset('service_requests')
+        expression = field('latitude').is_valid() & field('longitude').is_valid()
+        window = self.window('created', naive(start), naive(end), **where)
+
+        if window is not None:
+            expression = expression & window
+
+        columns = ['latitude', 'longitude']
+
+        if limit is None:
+            table = dataset.to_table(columns=columns, filter=expression)
+        else:
+            table = dataset.head(limit, columns=columns, filter=expression)
+
+        return numpy.column_stack([
+            table['latitude'].to_numpy(),
+            table['longitude'].to_numpy(),
+        ])
+
+    def storms(self, start=None, end=None, **where):
+        """Storm rows as dicts, ordered by date."""
+        table = self.dataset('storms').to_table(
+            filter=self.window('date', start, end, **where),
+        )
+
+        return sorted(table.to_pylist(), key=lambda row: (row['date'], row['id']))
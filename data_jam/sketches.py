@@ -0,0 +1,59 @@
+"""Mergeable percentile sketches for durations, in the style of DDSketch.
+
+A value ``x >= 1`` goes into bucket ``ceil(log(x) / log(GAMMA))``, and ``0``
+into ``ZERO_KEY``. Every bucket spans values within ``RELATIVE_ACCURACY`` of
+its midpoint, so any percentile read back from the bucket counts is that
+close to the exact one. Merging sketches is just adding up the counts of
+equal keys, which Postgres can do with an ``unnest`` and a ``GROUP BY``.
+
+"""
+
+import math
+
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+ZERO_KEY = -1
+
+
+def key_sql(column):
+    """SQL for the bucket of a non-negative integer ``column``."""
+    return (
+        f"CASE WHEN {column} = 0 THEN {ZERO_KEY} "
+        f"ELSE ceil(ln({column}) / {math.log(GAMMA)!r})::integer END"
+    )
+
+
+def values(keys):
+    """Representative value of each bucket in ``keys``."""
+    import numpy
+
+    keys = numpy.asarray(keys, dtype=numpy.float64)
+
+    return numpy.where(
+        keys == ZERO_KEY,
+        0.0,
+        2 * GAMMA ** keys / (GAMMA + 1),
+    )
+
+
+def quantiles(keys, counts, percentiles):
+    """Estimate ``percentiles`` (0-100) from merged bucket counts.
+
+    ``keys`` don't need to be sorted or unique. Returns a list with one value
+    per percentile, or ``None``s for an empty sketch.
+
+    """
+    import numpy
+
+    keys, inverse = numpy.unique(numpy.asarray(keys), return_inverse=True)
+    counts = numpy.bincount(inverse.ravel(), weights=counts)
+
+    if not counts.sum():
+        return [None] * len(percentiles)
+
+    cumulative = numpy.cumsum(counts)
+    ranks = numpy.asarray(percentiles) / 100 * (cumulative[-1] - 1)
+    found = numpy.searchsorted(cumulative, ranks, side='right')
+
+    return [float(value) for value in values(keys[found])]
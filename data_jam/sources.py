@@ -0,0 +1,261 @@
+"""Open the files the importers read, compressed or not, or stdin.
+
+The big exports are kept compressed, so ``open_source`` sniffs the first
+bytes of its input for a gzip, bzip2, xz or Zstandard header and decodes it
+as a stream, pulling the compressed file in large blocks. Nothing has to be
+decompressed to disk first, and ``-`` reads a pipe::
+
+    zcat 311.csv.gz | python manage.py import_service_request_data -
+
+Plain files on disk are memory-mapped instead, so reading them doesn't copy
+every block through an extra read buffer.
+
+``Source.offset`` is how far into the file itself (the compressed bytes, for
+a compressed one) the reader got, which is what the byte progress and ETA of
+the importers are based on. The decompressors are only imported when they're
+needed, and Zstandard needs the ``zstandard`` package.
+
+"""
+
+import contextlib
+import io
+import mmap
+import os
+import stat
+import sys
+
+
+BUFFER_SIZE = 1024 * 1024
+
+# (compression, first bytes of a file that uses it)
+MAGIC = (
+    ('gzip', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+)
+
+# File name suffixes of the compressions in ``MAGIC``.
+SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+
+
+def detect(head):
+    """The compression ``head``, the first bytes of a file, belongs to, or ``None``."""
+    for compression, magic in MAGIC:
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def decompressor(compression, file_obj, buffer_size=BUFFER_SIZE):
+    """Binary file object that decompresses ``file_obj`` as it's read."""
+    if compression == 'gzip':
+        import gzip
+
+        return gzip.GzipFile(fileobj=file_obj, mode='rb')
+
+    if compression == 'bz2':
+        import bz2
+
+        return bz2.BZ2File(file_obj, mode='rb')
+
+    if compression == 'xz':
+        import lzma
+
+        return lzma.LZMAFile(file_obj, mode='rb')
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Reading Zstandard files needs the zstandard package."
+            ) from None
+
+        return zstandard.ZstdDecompressor().stream_reader(
+            file_obj,
+            read_size=buffer_size,
+            closefd=False,
+        )
+
+    raise ValueError(f"Unknown compression {compression!r}.")
+
+
+class CountingReader(io.RawIOBase):
+    """Raw reader that counts the bytes it pulls out of ``file_obj``."""
+
+    def __init__(self, file_obj):
+        self._file = file_obj
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.count = self._file.seek(offset, whence)
+        return self.count
+
+    def readinto(self, buffer):
+        size = self._file.readinto(buffer)
+        self.count += size or 0
+
+        return size
+
+
+class MappedReader(io.BufferedIOBase):
+    """Buffered reader interface to a read-only ``mmap``.
+
+    Reads come straight out of the mapping, and ``readline`` is a scan for
+    the newline in it rather than a loop over a read buffer.
+
+    """
+
+    def __init__(self, mapping):
+        self._map = mapping
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._map.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def read(self, size=-1):
+        return self._map.read(None if size is None or size < 0 else size)
+
+    read1 = read
+
+    def readinto(self, buffer):
+        data = self._map.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            return self._map.readline()
+
+        return super().readline(size)
+
+
+class Source(object):
+    """An input opened by ``open_source``.
+
+    ``binary`` reads the decompressed bytes and ``text`` decodes them as
+    UTF-8 for ``csv``; use one or the other. ``path`` is ``None`` for stdin,
+    ``compression`` is one of the names in ``MAGIC`` or ``None``, and
+    ``size`` is the size of the file, or ``None`` for a pipe.
+
+    """
+
+    def __init__(self, name, path, binary, compression, size, position, stack):
+        self.name = name
+        self.path = path
+        self.binary = binary
+        self.text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        self.compression = compression
+        self.size = size
+        self.start = 0
+        self._position = position
+        self._stack = stack
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def offset(self):
+        """Bytes of the file read so far."""
+        return self._position()
+
+    @property
+    def mapped(self):
+        return isinstance(self.binary, MappedReader)
+
+    def mark(self):
+        """Count progress from here on, e.g. after skipping to a checkpoint."""
+        self.start = self.offset
+
+    def progress(self):
+        """Byte fields for ``metrics.progress``."""
+        return {
+            'bytes_read': self.offset,
+            'bytes_total': self.size,
+            'bytes_start': self.start,
+        }
+
+    def close(self):
+        # The decoders would close the files under them, and stdin isn't ours.
+        self.text.detach()
+        self._stack.close()
+
+
+def open_source(path, buffer_size=BUFFER_SIZE):
+    """Open ``path``, or stdin if it's ``-``, as a ``Source``."""
+    stack = contextlib.ExitStack()
+
+    try:
+        if path == '-':
+            raw = stack.enter_context(
+                open(sys.stdin.fileno(), 'rb', buffering=0, closefd=False)
+            )
+            name, path = '<stdin>', None
+        else:
+            raw = stack.enter_context(open(path, 'rb', buffering=0))
+            name = path
+
+        info = os.fstat(raw.fileno())
+        size = info.st_size if stat.S_ISREG(info.st_mode) else None
+        counter = CountingReader(raw)
+        buffered = io.BufferedReader(counter, buffer_size)
+        compression = detect(buffered.peek(max(len(magic) for _, magic in MAGIC)))
+
+        if compression:
+            stream = decompressor(compression, buffered, buffer_size)
+            stack.callback(stream.close)
+            binary = io.BufferedReader(stream, buffer_size)
+
+            def position():
+                return counter.count
+        elif path and size:
+            mapping = stack.enter_context(
+                mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+            binary = MappedReader(mapping)
+            position = mapping.tell
+        else:
+            binary = buffered
+
+            def position():
+                return counter.count
+
+        return Source(name, path, binary, compression, size, position, stack)
+    except BaseException:
+        stack.close()
+        raise
+
+
+@contextlib.contextmanager
+def reading(source):
+    """Yield ``source`` if it's a ``Source``, or open it as a path and close it after."""
+    if isinstance(source, Source):
+        yield source
+        return
+
+    with open_source(source) as opened:
+        yield opened
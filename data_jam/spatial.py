@@ -0,0 +1,138 @@
+"""Radius and bounding box lookups on the indexed ``cell`` columns.
+
+``ServiceRequest``, ``PermittedEvent`` and ``Event`` all have a ``cell``
+column generated by Postgres from their latitude and longitude (see migration
+009) on ``CELL_GRID``. A lookup first narrows the rows down to the cells
+around the point with an index scan, and only then checks the exact
+coordinates.
+
+"""
+
+import functools
+import math
+import operator
+
+import peewee
+
+from playhouse.hybrid import hybrid_method
+
+from data_jam import grids
+
+
+EARTH_RADIUS = 6371008.8
+
+# About 550m north to south, and 420m east to west in New York.
+CELL_GRID = grids.Grid.from_cell_size(0.005)
+
+# Past this many rows of cells the index doesn't narrow anything down.
+MAX_CELL_ROWS = 200
+
+
+def bbox_around(latitude, longitude, radius):
+    """``(south, west, north, east)`` of a circle of ``radius`` metres."""
+    lat_delta = math.degrees(radius / EARTH_RADIUS)
+    lng_delta = lat_delta / max(math.cos(math.radians(latitude)), 1e-6)
+
+    return (
+        latitude - lat_delta,
+        longitude - lng_delta,
+        latitude + lat_delta,
+        longitude + lng_delta,
+    )
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """Great circle distance in metres."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def distance_sql(lat1, lng1, lat2, lng2):
+    """SQL version of ``distance``; arguments are SQL expressions."""
+    return (
+        f"2 * {EARTH_RADIUS!r} * asin(sqrt("
+        f"power(sin(radians({lat2} - {lat1}) / 2), 2) "
+        f"+ cos(radians({lat1})) * cos(radians({lat2})) "
+        f"* power(sin(radians({lng2} - {lng1}) / 2), 2)))"
+    )
+
+
+def distance_expression(latitude, longitude, lat, lng):
+    """Peewee expression for the distance from a pair of columns to a point."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2 = peewee.fn.RADIANS(latitude)
+    lng2 = peewee.fn.RADIANS(longitude)
+
+    return 2 * EARTH_RADIUS * peewee.fn.ASIN(peewee.fn.SQRT(
+        peewee.fn.POWER(peewee.fn.SIN((lat2 - lat1) / 2), 2)
+        + math.cos(lat1) * peewee.fn.COS(lat2)
+        * peewee.fn.POWER(peewee.fn.SIN((lng2 - lng1) / 2), 2)
+    ))
+
+
+def cell_expression(cell, south, west, north, east):
+    """Peewee expression matching the cells that cover a bounding box."""
+    ranges = CELL_GRID.cell_ranges(south, west, north, east)
+
+    if len(ranges) > MAX_CELL_ROWS:
+        return None
+
+    return functools.reduce(operator.or_, [
+        cell.between(low, high) for low, high in ranges
+    ])
+
+
+class LocatedMixin(object):
+    """``near`` and ``within_bbox`` for models with latitude/longitude.
+
+    Both work on instances as well as in queries, where they go through the
+    index on ``cell``::
+
+        ServiceRequest.select().where(ServiceRequest.near(40.75, -73.99, 250))
+
+    """
+
+    @hybrid_method
+    def within_bbox(self, south, west, north, east):
+        if self.latitude is None or self.longitude is None:
+            return False
+
+        return (
+            south <= float(self.latitude) <= north and
+            west <= float(self.longitude) <= east
+        )
+
+    @within_bbox.expression
+    def within_bbox(cls, south, west, north, east):
+        where = (
+            cls.latitude.between(south, north) &
+            cls.longitude.between(west, east)
+        )
+        cells = cell_expression(cls.cell, south, west, north, east)
+
+        return where if cells is None else cells & where
+
+    @hybrid_method
+    def near(self, latitude, longitude, radius):
+        """Within ``radius`` metres of the point."""
+        if self.latitude is None or self.longitude is None:
+            return False
+
+        return distance(
+            latitude,
+            longitude,
+            float(self.latitude),
+            float(self.longitude),
+        ) <= radius
+
+    @near.expression
+    def near(cls, latitude, longitude, radius):
+        return cls.within_bbox(*bbox_around(latitude, longitude, radius)) & (
+            distance_expression(cls.latitude, cls.longitude, latitude, longitude)
+            <= radius
+        )
@@ -0,0 +1,69 @@
+"""Helpers for cutting time windows into whole rollup buckets."""
+
+import datetime
+
+
+DAY = datetime.timedelta(days=1)
+HOUR = datetime.timedelta(hours=1)
+
+
+def as_datetime(value):
+    """Turn a ``date`` into midnight of that day, like Postgres does."""
+    if isinstance(value, datetime.datetime):
+        return value
+
+    return datetime.datetime.combine(value, datetime.time())
+
+
+def floor(value, step):
+    if step == DAY:
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if step == HOUR:
+        return value.replace(minute=0, second=0, microsecond=0)
+
+    raise ValueError(f"Unsupported bucket size {step}.")
+
+
+def split_window(start, end, step):
+    """Split the inclusive window ``[start, end]`` on ``step`` boundaries.
+
+    Returns ``(first, stop, edges)``: the whole buckets that fit inside the
+    window are ``[first, stop)``, and ``edges`` lists the leftover partial
+    buckets as ``(low, high, inclusive)`` tuples that have to be counted
+    from the raw rows. ``first`` and ``stop`` are ``None`` if no whole bucket
+    fits.
+
+    """
+    first = floor(start, step)
+
+    if first < start:
+        first += step
+
+    stop = floor(end + datetime.timedelta(microseconds=1), step)
+
+    if first >= stop:
+        return None, None, [(start, end, True)]
+
+    edges = []
+
+    if start < first:
+        edges.append((start, first, False))
+
+    if stop <= end:
+        edges.append((stop, end, True))
+
+    return first, stop, edges
+
+
+def runs(days):
+    """Group dates into ``(first, last)`` runs of consecutive days."""
+    result = []
+
+    for day in sorted(days):
+        if result and result[-1][1] + DAY == day:
+            result[-1] = (result[-1][0], day)
+        else:
+            result.append((day, day))
+
+    return result
@@ -1,8 +1,11 @@
 """Helper CLI commands for this project."""
 
+import functools
+
 import click
 
 import data_jam.models as models
+from data_jam import crawler, db, metrics, parquet, sources
 
 
 @click.group()
@@ -10,39 +13,279 @@ def cli():
     pass
 
 
+class SourceType(click.ParamType):
+    """A CSV file, plain or compressed, or ``-`` for stdin.
+
+    Opens it as a ``data_jam.sources.Source``, which is closed again when the
+    command is done.
+
+    """
+    name = 'source'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, sources.Source):
+            return value
+
+        try:
+            source = sources.open_source(value)
+        except (OSError, ImportError) as error:
+            self.fail(f"Can't open {value}: {error}", param, ctx)
+
+        if ctx is not None:
+            ctx.call_on_close(source.close)
+
+        return source
+
+
+SOURCE = SourceType()
+
+
+def instrumented(command):
+    """Add the ``--progress``, ``--metrics-file`` and ``--profile`` options.
+
+    The command runs inside a ``metrics.recording``, which prints a table of
+    how long each stage of the import took when it's done.
+
+    """
+    @click.option(
+        '--progress',
+        default='text',
+        type=click.Choice(['text', 'json']),
+        help="Print progress as text or as one JSON object per line.",
+    )
+    @click.option(
+        '--metrics-file',
+        type=click.Path(dir_okay=False),
+        help="Write Prometheus-format metrics to this file when done.",
+    )
+    @click.option(
+        '--profile',
+        type=click.Path(dir_okay=False),
+        help="Run under cProfile and save the stats to this file.",
+    )
+    @functools.wraps(command)
+    def wrapper(progress, metrics_file, profile, **kwargs):
+        with metrics.recording(
+            command.__name__,
+            json_lines=progress == 'json',
+            prometheus_path=metrics_file,
+            profile_path=profile,
+        ):
+            return command(**kwargs)
+
+    return wrapper
+
+
 @cli.command()
 def migrate():
-    models.MIGRATION_ROUTER.run()
+    """Migrate the database, or create the tables of a SQLite one."""
+    models.migrate()
 
 
 @cli.command()
 @click.argument('name')
 def rollback(name):
-    models.MIGRATION_ROUTER.rollback(name)
+    models.migration_router().rollback(name)
 
 
 @cli.command()
 @click.argument('name')
 def create_migration(name):
-    models.MIGRATION_ROUTER.create(name)
+    models.migration_router().create(name)
 
 
 @cli.command()
-@click.argument('path', type=click.File('r', encoding='utf-8'))
-def import_service_request_data(path):
+@instrumented
+@click.argument('path', type=SOURCE)
+@click.option(
+    '--mode',
+    default='insert',
+    type=click.Choice(['insert', 'copy']),
+    help="Use batched INSERTs or stream the file through COPY FROM STDIN.",
+)
+@click.option(
+    '--commit-every',
+    default=1000000,
+    type=click.INT,
+    help="Rows per transaction in copy mode.",
+)
+@click.option(
+    '--workers',
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes to copy the file with.",
+)
+@click.option(
+    '--on-conflict',
+    default='error',
+    type=click.Choice(['error', 'skip', 'update']),
+    help="What to do with rows whose Unique Key is already imported.",
+)
+@click.option(
+    '--checkpoint',
+    type=click.Path(dir_okay=False),
+    help="JSON file to record progress in, so the import can be resumed.",
+)
+def import_service_request_data(path, mode, commit_every, workers,
+                                on_conflict, checkpoint):
     """Import NYC 311 Service Requests CSV into the database.
 
     This data can be found at the following link. It is a huge dataset.
 
     https://data.cityofnewyork.us/Social-Services/311-Service-Requests-from-2010-to-Present/erm2-nwe9
 
+    PATH can be gzip, bzip2, xz or Zstandard compressed, or ``-`` to read
+    stdin, and progress is reported in bytes of the file with an ETA.
+
+    Reruns with ``--on-conflict=skip`` only add requests that aren't in the
+    table yet, and ``--on-conflict=update`` also refreshes changed ones, so a
+    daily delta file can be loaded on top of the existing data.
+
+    """
+    if (workers > 1 or checkpoint) and not path.path:
+        raise click.UsageError(
+            "--workers and --checkpoint need a path to a file on disk."
+        )
+
+    if workers > 1 and path.compression:
+        raise click.UsageError("--workers needs an uncompressed file.")
+
+    if workers > 1 and checkpoint:
+        raise click.UsageError("--checkpoint only works with a single worker.")
+
+    if workers == 1 and mode != 'copy' and (checkpoint or on_conflict != 'error'):
+        raise click.UsageError(
+            "--checkpoint and --on-conflict need --mode=copy."
+        )
+
+    if (workers > 1 or mode == 'copy') and db.embedded():
+        raise click.UsageError(
+            "--mode=copy and --workers need a Postgres database."
+        )
+
+    models.ServiceRequest.import_from_csv(
+        path,
+        mode=mode,
+        commit_every=commit_every,
+        workers=workers,
+        on_conflict=on_conflict,
+        checkpoint=checkpoint,
+    )
+    metrics.progress("Successfully imported the 311 data!")
+
+
+@cli.command()
+@click.option('--rebuild', is_flag=True, help="Recompute every day from scratch.")
+def refresh_rollups(rebuild):
+    """Bring the service request rollup tables up to date."""
+    days = models.RollupState.refresh(rebuild=rebuild)
+    print(f"Refreshed the rollups for {len(days)} days!")
+
+
+@cli.command('storm-impact')
+@click.option('--baseline-days', default=28, type=click.IntRange(min=1),
+              help="Days before an event to average for the baseline.")
+@click.option('--window', default=7, type=click.IntRange(min=1),
+              help="Days after the start of an event to count excess calls in.")
+@click.option('--horizon', default=60, type=click.IntRange(min=0),
+              help="Give up on recovery after this many days.")
+@click.option('--tolerance', default=0.1, type=click.FLOAT,
+              help="How far above the baseline still counts as recovered.")
+@click.option('--precipitation', default=1.0, type=click.FLOAT,
+              help="Inches of rain that make a Weather day severe.")
+@click.option('--top', default=20, type=click.INT,
+              help="How many of the worst events to list.")
+@click.option('--no-cache', is_flag=True, help="Recompute even if cached.")
+def storm_impact(baseline_days, window, horizon, tolerance, precipitation,
+                 top, no_cache):
+    """Measure the excess 311 calls after storms and severe weather."""
+    import tabulate
+
+    from data_jam import impact
+
+    impacts = impact.analyze(
+        baseline_days=baseline_days,
+        window=window,
+        horizon=horizon,
+        tolerance=tolerance,
+        precipitation=precipitation,
+        cache_path=None if no_cache else impact.DEFAULT_CACHE_PATH,
+    )
+    worst = sorted(
+        (row for row in impacts if row.excess is not None),
+        key=lambda row: row.excess,
+        reverse=True,
+    )
+
+    print(tabulate.tabulate(
+        impact.by_borough(impacts),
+        headers=('Borough', 'Events', 'Mean excess calls', 'Mean days to recover'),
+        floatfmt='.1f',
+    ))
+    print()
+    print(tabulate.tabulate(
+        [
+            (row.day, row.kind, row.name, row.borough, row.baseline,
+             row.excess, row.days_to_recover)
+            for row in worst[:top]
+        ],
+        headers=('Day', 'Kind', 'Event', 'Borough', 'Baseline', 'Excess',
+                 'Days to recover'),
+        floatfmt='.1f',
+    ))
+
+
+@cli.command('detect-anomalies')
+@click.option('--since', required=True, type=click.DateTime(['%Y-%m-%d']),
+              help="List the anomalies on or after this day.")
+@click.option('--through', type=click.DateTime(['%Y-%m-%d']),
+              help="Don't learn days after this one, e.g. today's partial day.")
+@click.option('--threshold', default=4.0, type=click.FloatRange(min=0),
+              help="Standard deviations over the baseline that count as anomalous.")
+@click.option('--alpha', default=0.1, type=click.FloatRange(min=0, max=1),
+              help="Weight of a new day in the moving baselines.")
+@click.option('--min-excess', default=10, type=click.IntRange(min=0),
+              help="Calls over the baseline a day needs to be flagged.")
+@click.option('--state', type=click.Path(dir_okay=False),
+              help="Where to keep the baselines (.anomaly_state.npz by default).")
+@click.option('--rebuild', is_flag=True, help="Relearn the baselines from the first day.")
+def detect_anomalies(since, through, threshold, alpha, min_excess, state, rebuild):
+    """Flag days with a surge of calls for a borough and complaint type.
+
+    The baselines are updated with the days imported since the last run,
+    and the anomalies are listed next to the storms and weather of their day.
+
     """
-    models.ServiceRequest.import_from_csv(path)
-    print("Successfully imported the 311 data!")
+    import tabulate
+
+    from data_jam import anomalies
+
+    found = anomalies.detect(
+        since.date(),
+        through=through.date() if through else None,
+        path=state or anomalies.DEFAULT_STATE_PATH,
+        rebuild=rebuild,
+        alpha=alpha,
+        threshold=threshold,
+        min_excess=min_excess,
+    )
+
+    print(tabulate.tabulate(
+        [
+            (row.day, row.borough, row.type, row.calls, row.expected, row.score,
+             ', '.join(row.storms), ', '.join(row.weather), row.precipitation)
+            for row in found
+        ],
+        headers=('Day', 'Borough', 'Type', 'Calls', 'Expected', 'Score',
+                 'Storms', 'Weather', 'Rain (in)'),
+        floatfmt='.1f',
+    ))
+    print(f"Found {len(found)} anomalies!")
 
 
 @cli.command()
-@click.argument('path', type=click.File('r', encoding='utf-8'))
+@instrumented
+@click.argument('path', type=SOURCE)
 def import_storm_data(path):
     """Import the NOAA weather dataset.
 
@@ -51,28 +294,104 @@ def import_storm_data(path):
 
     """
     models.Storm.import_from_csv(path)
-    print("Successfully imported the Storm data!")
+    metrics.progress("Successfully imported the Storm data!")
 
 
 @cli.command()
-@click.argument('path', type=click.File('r', encoding='utf-8'))
+@instrumented
+@click.argument('path', type=SOURCE)
 def import_permitted_events_data(path):
     models.PermittedEvent.import_from_csv(path)
-    print("Successfully import the Permitted Events data!")
+    metrics.progress("Successfully import the Permitted Events data!")
 
 
 @cli.command()
+@instrumented
 @click.option('--page', default=1, type=click.INT)
-def import_nyc_events(page):
-    models.Event.import_from_site(page)
-    print("Successfully imported the Events data!")
+@click.option(
+    '--concurrency',
+    default=8,
+    type=click.IntRange(min=1),
+    help="How many pages to download at once.",
+)
+@click.option(
+    '--max-pages',
+    type=click.IntRange(min=1),
+    help="Stop after this many pages.",
+)
+@click.option(
+    '--url',
+    default=crawler.EVENTS_URL,
+    help="Calendar API endpoint, e.g. a local serve_recorded_events stub.",
+)
+@click.option(
+    '--record',
+    type=click.Path(file_okay=False, exists=True),
+    help="Save every fetched page as JSON into this directory.",
+)
+def import_nyc_events(page, concurrency, max_pages, url, record):
+    models.Event.import_from_site(
+        page,
+        concurrency=concurrency,
+        max_pages=max_pages,
+        url=url,
+        record_to=record,
+    )
+    metrics.progress("Successfully imported the Events data!")
 
 
 @cli.command()
-@click.argument('path', type=click.File('r', encoding='utf-8'))
-def import_weather(path):
-    models.Weather.import_from_csv(path)
-    print("Successfully imported Weather data!")
+@click.argument('directory', type=click.Path(file_okay=False, exists=True))
+@click.option('--port', default=8080, type=click.INT)
+def serve_recorded_events(directory, port):
+    """Serve pages saved with ``import_nyc_events --record`` locally.
+
+    Then import them offline with
+    ``import_nyc_events --url http://localhost:8080/calendar/api/json/search.htm``.
+
+    """
+    from aiohttp import web
+
+    web.run_app(crawler.recorded_pages_app(directory), port=port)
+
+
+@cli.command()
+@click.option('--format', 'output_format', default='parquet',
+              type=click.Choice(['parquet']))
+@click.option('--output', default='export', type=click.Path(file_okay=False),
+              help="Directory to write one dataset per table into.")
+@click.option('--table', 'tables', multiple=True,
+              type=click.Choice(parquet.TABLES),
+              help="Only export this table. Can be repeated.")
+def export(output_format, output, tables):
+    """Export the tables to files partitioned by year and month.
+
+    Read them back without a database with ``data_jam.parquet.ParquetStore``.
+
+    """
+    written = parquet.export(output, tables=tables or parquet.TABLES)
+
+    for table, rows in written.items():
+        print(f"Exported {rows} rows of {table}!")
+
+
+@cli.command()
+@instrumented
+@click.argument('paths', nargs=-1, required=True)
+@click.option(
+    '--workers',
+    default=4,
+    type=click.IntRange(min=1),
+    help="How many files to parse at once.",
+)
+def import_weather(paths, workers):
+    """Import weather CSV files, directories or globs like data/weather/*.csv.
+
+    The files can be compressed, like ``2017.csv.gz``.
+
+    """
+    models.Weather.import_from_csv(paths, workers=workers)
+    metrics.progress("Successfully imported Weather data!")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+"""Peewee migrations -- 006_AddServiceRequestRollups.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    migrator.sql("""
+CREATE TABLE service_request_daily_counts (
+    day date NOT NULL,
+    borough character varying(255) NOT NULL,
+    type character varying(255) NOT NULL,
+    calls integer NOT NULL,
+    PRIMARY KEY (day, borough, type)
+);
+CREATE TABLE service_request_hourly_counts (
+    hour timestamp without time zone NOT NULL,
+    borough character varying(255) NOT NULL,
+    type character varying(255) NOT NULL,
+    calls integer NOT NULL,
+    PRIMARY KEY (hour, borough, type)
+);
+CREATE TABLE service_request_rollup_state (
+    id integer PRIMARY KEY,
+    last_id bigint NOT NULL DEFAULT 0
+);
+INSERT INTO service_request_rollup_state (id, last_id) VALUES (1, 0);
+CREATE TABLE service_request_dirty_days (
+    day date PRIMARY KEY
+);
+    """)
+    # New rows are found through the id watermark in the state table. These
+    # triggers catch updates and deletes of rows that were already rolled up.
+    migrator.sql("""
+CREATE FUNCTION service_requests_mark_dirty() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO service_request_dirty_days (day)
+    SELECT DISTINCT created::date FROM old_rows
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE FUNCTION service_requests_mark_dirty_update() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO service_request_dirty_days (day)
+    SELECT created::date FROM old_rows
+    UNION
+    SELECT created::date FROM new_rows
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER service_requests_dirty_on_delete
+    AFTER DELETE ON service_requests
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty();
+CREATE TRIGGER service_requests_dirty_on_update
+    AFTER UPDATE ON service_requests
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty_update();
+    """)
+
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("DROP TRIGGER service_requests_dirty_on_update ON service_requests;")
+    migrator.sql("DROP TRIGGER service_requests_dirty_on_delete ON service_requests;")
+    migrator.sql("DROP FUNCTION service_requests_mark_dirty_update();")
+    migrator.sql("DROP FUNCTION service_requests_mark_dirty();")
+    migrator.sql("DROP TABLE service_request_dirty_days;")
+    migrator.sql("DROP TABLE service_request_rollup_state;")
+    migrator.sql("DROP TABLE service_request_hourly_counts;")
+    migrator.sql("DROP TABLE service_request_daily_counts;")
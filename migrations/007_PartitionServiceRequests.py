@@ -0,0 +1,186 @@
+"""Peewee migrations -- 007_PartitionServiceRequests.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    # Move the old heap out of the way, keeping the id sequence around.
+    migrator.sql("""
+DROP TRIGGER service_requests_dirty_on_update ON service_requests;
+DROP TRIGGER service_requests_dirty_on_delete ON service_requests;
+ALTER SEQUENCE service_requests_id_seq OWNED BY NONE;
+ALTER TABLE service_requests RENAME TO service_requests_heap;
+ALTER INDEX service_requests_pkey RENAME TO service_requests_heap_pkey;
+ALTER INDEX service_requests_borough RENAME TO service_requests_heap_borough;
+ALTER INDEX service_requests_created RENAME TO service_requests_heap_created;
+ALTER INDEX service_requests_unique_key RENAME TO service_requests_heap_unique_key;
+    """)
+    # Unique constraints on a partitioned table have to include the partition
+    # key, so the primary key and the 311 key both gain ``created``.
+    migrator.sql("""
+CREATE TABLE service_requests (
+    id integer NOT NULL DEFAULT nextval('service_requests_id_seq'::regclass),
+    agency character varying(255) NOT NULL,
+    type character varying(255) NOT NULL,
+    descriptor character varying(255),
+    borough character varying(255),
+    latitude numeric(10,8),
+    longitude numeric(11,8),
+    created timestamp without time zone NOT NULL,
+    closed timestamp without time zone,
+    unique_key bigint,
+    CONSTRAINT service_requests_pkey PRIMARY KEY (id, created)
+) PARTITION BY RANGE (created);
+ALTER TABLE service_requests OWNER TO postgres;
+ALTER SEQUENCE service_requests_id_seq OWNED BY service_requests.id;
+CREATE TABLE service_requests_default PARTITION OF service_requests DEFAULT;
+    """)
+    migrator.sql("""
+CREATE FUNCTION service_requests_ensure_partition(year integer) RETURNS void AS $$
+BEGIN
+    EXECUTE
+        'CREATE TABLE IF NOT EXISTS '
+        || quote_ident('service_requests_y' || year)
+        || ' PARTITION OF service_requests FOR VALUES FROM ('
+        || quote_literal(make_date(year, 1, 1))
+        || ') TO ('
+        || quote_literal(make_date(year + 1, 1, 1))
+        || ')';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rows for years without a partition land in the default partition. This
+-- moves them into freshly created yearly partitions.
+CREATE FUNCTION service_requests_drain_default() RETURNS integer AS $$
+DECLARE
+    year integer;
+    moved integer := 0;
+    batch integer;
+BEGIN
+    FOR year IN
+        SELECT DISTINCT date_part('year', created)::integer
+        FROM service_requests_default
+    LOOP
+        CREATE TEMP TABLE service_requests_moving
+            (LIKE service_requests_default);
+
+        WITH moving AS (
+            DELETE FROM service_requests_default
+            WHERE created >= make_date(year, 1, 1)
+              AND created < make_date(year + 1, 1, 1)
+            RETURNING *
+        )
+        INSERT INTO service_requests_moving SELECT * FROM moving;
+
+        PERFORM service_requests_ensure_partition(year);
+        INSERT INTO service_requests SELECT * FROM service_requests_moving;
+        GET DIAGNOSTICS batch = ROW_COUNT;
+        moved := moved + batch;
+        DROP TABLE service_requests_moving;
+    END LOOP;
+
+    RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+    """)
+    migrator.sql("""
+SELECT service_requests_ensure_partition(year)
+FROM (
+    SELECT DISTINCT date_part('year', created)::integer AS year
+    FROM service_requests_heap
+    UNION
+    SELECT generate_series(
+        2010,
+        date_part('year', now())::integer + 1
+    )
+) AS years;
+INSERT INTO service_requests (
+    id, agency, type, descriptor, borough, latitude, longitude, created,
+    closed, unique_key
+)
+SELECT
+    id, agency, type, descriptor, borough, latitude, longitude, created,
+    closed, unique_key
+FROM service_requests_heap;
+DROP TABLE service_requests_heap;
+CREATE INDEX service_requests_borough ON service_requests USING btree (borough);
+CREATE INDEX service_requests_created ON service_requests USING btree (created);
+CREATE UNIQUE INDEX service_requests_unique_key ON service_requests USING btree (unique_key, created);
+CREATE TRIGGER service_requests_dirty_on_delete
+    AFTER DELETE ON service_requests
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty();
+CREATE TRIGGER service_requests_dirty_on_update
+    AFTER UPDATE ON service_requests
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty_update();
+    """)
+
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("""
+ALTER SEQUENCE service_requests_id_seq OWNED BY NONE;
+ALTER TABLE service_requests RENAME TO service_requests_partitioned;
+ALTER INDEX service_requests_pkey RENAME TO service_requests_partitioned_pkey;
+ALTER INDEX service_requests_borough RENAME TO service_requests_partitioned_borough;
+ALTER INDEX service_requests_created RENAME TO service_requests_partitioned_created;
+ALTER INDEX service_requests_unique_key RENAME TO service_requests_partitioned_unique_key;
+CREATE TABLE service_requests (
+    id integer NOT NULL DEFAULT nextval('service_requests_id_seq'::regclass),
+    agency character varying(255) NOT NULL,
+    type character varying(255) NOT NULL,
+    descriptor character varying(255),
+    borough character varying(255),
+    latitude numeric(10,8),
+    longitude numeric(11,8),
+    created timestamp without time zone NOT NULL,
+    closed timestamp without time zone,
+    unique_key bigint,
+    CONSTRAINT service_requests_pkey PRIMARY KEY (id)
+);
+ALTER TABLE service_requests OWNER TO postgres;
+ALTER SEQUENCE service_requests_id_seq OWNED BY service_requests.id;
+INSERT INTO service_requests SELECT
+    id, agency, type, descriptor, borough, latitude, longitude, created,
+    closed, unique_key
+FROM service_requests_partitioned;
+DROP TABLE service_requests_partitioned;
+DROP FUNCTION service_requests_drain_default();
+DROP FUNCTION service_requests_ensure_partition(integer);
+CREATE INDEX service_requests_borough ON service_requests USING btree (borough);
+CREATE INDEX service_requests_created ON service_requests USING btree (created);
+CREATE UNIQUE INDEX service_requests_unique_key ON service_requests USING btree (unique_key);
+CREATE TRIGGER service_requests_dirty_on_delete
+    AFTER DELETE ON service_requests
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty();
+CREATE TRIGGER service_requests_dirty_on_update
+    AFTER UPDATE ON service_requests
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE service_requests_mark_dirty_update();
+    """)
@@ -0,0 +1,53 @@
+"""Peewee migrations -- 008_AddHeatTiles.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    migrator.sql("""
+CREATE TABLE service_request_heat_tiles (
+    grid character varying(255) NOT NULL,
+    day date NOT NULL,
+    cell_row integer NOT NULL,
+    cell_col integer NOT NULL,
+    weight integer NOT NULL,
+    PRIMARY KEY (grid, day, cell_row, cell_col)
+);
+CREATE INDEX service_request_heat_tiles_day ON service_request_heat_tiles USING btree (day);
+CREATE TABLE service_request_heat_tile_days (
+    grid character varying(255) NOT NULL,
+    day date NOT NULL,
+    PRIMARY KEY (grid, day)
+);
+CREATE INDEX service_request_heat_tile_days_day ON service_request_heat_tile_days USING btree (day);
+    """)
+
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("DROP TABLE service_request_heat_tile_days;")
+    migrator.sql("DROP TABLE service_request_heat_tiles;")
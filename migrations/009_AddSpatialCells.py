@@ -0,0 +1,131 @@
+"""Peewee migrations -- 009_AddSpatialCells.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+# Cells of ``spatial.CELL_GRID``: 0.005 degree squares, 72000 per row.
+CELL = (
+    "floor((latitude + 90) / 0.005)::bigint * 72000 "
+    "+ floor((longitude + 180) / 0.005)::bigint"
+)
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    migrator.sql(f"""
+ALTER TABLE service_requests
+    ADD COLUMN cell bigint GENERATED ALWAYS AS ({CELL}) STORED;
+ALTER TABLE permitted_events
+    ADD COLUMN cell bigint GENERATED ALWAYS AS ({CELL}) STORED;
+ALTER TABLE events
+    ADD COLUMN cell bigint GENERATED ALWAYS AS ({CELL}) STORED;
+CREATE INDEX service_requests_cell_created ON service_requests USING btree (cell, created);
+CREATE INDEX permitted_events_cell ON permitted_events USING btree (cell);
+CREATE INDEX events_cell ON events USING btree (cell);
+    """)
+    # Generated columns can't be copied with ``INSERT ... SELECT *``, so the
+    # drain only moves the regular columns now.
+    migrator.sql("""
+CREATE OR REPLACE FUNCTION service_requests_drain_default() RETURNS integer AS $$
+DECLARE
+    year integer;
+    moved integer := 0;
+    batch integer;
+    columns text;
+BEGIN
+    SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position)
+    INTO columns
+    FROM information_schema.columns
+    WHERE table_schema = current_schema()
+      AND table_name = 'service_requests'
+      AND is_generated = 'NEVER';
+
+    FOR year IN
+        SELECT DISTINCT date_part('year', created)::integer
+        FROM service_requests_default
+    LOOP
+        CREATE TEMP TABLE service_requests_moving
+            (LIKE service_requests_default);
+
+        WITH moving AS (
+            DELETE FROM service_requests_default
+            WHERE created >= make_date(year, 1, 1)
+              AND created < make_date(year + 1, 1, 1)
+            RETURNING *
+        )
+        INSERT INTO service_requests_moving SELECT * FROM moving;
+
+        PERFORM service_requests_ensure_partition(year);
+        EXECUTE
+            'INSERT INTO service_requests (' || columns || ') '
+            || 'SELECT ' || columns || ' FROM service_requests_moving';
+        GET DIAGNOSTICS batch = ROW_COUNT;
+        moved := moved + batch;
+        DROP TABLE service_requests_moving;
+    END LOOP;
+
+    RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+    """)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("""
+CREATE OR REPLACE FUNCTION service_requests_drain_default() RETURNS integer AS $$
+DECLARE
+    year integer;
+    moved integer := 0;
+    batch integer;
+BEGIN
+    FOR year IN
+        SELECT DISTINCT date_part('year', created)::integer
+        FROM service_requests_default
+    LOOP
+        CREATE TEMP TABLE service_requests_moving
+            (LIKE service_requests_default);
+
+        WITH moving AS (
+            DELETE FROM service_requests_default
+            WHERE created >= make_date(year, 1, 1)
+              AND created < make_date(year + 1, 1, 1)
+            RETURNING *
+        )
+        INSERT INTO service_requests_moving SELECT * FROM moving;
+
+        PERFORM service_requests_ensure_partition(year);
+        INSERT INTO service_requests SELECT * FROM service_requests_moving;
+        GET DIAGNOSTICS batch = ROW_COUNT;
+        moved := moved + batch;
+        DROP TABLE service_requests_moving;
+    END LOOP;
+
+    RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+    """)
+    migrator.sql("ALTER TABLE events DROP COLUMN cell;")
+    migrator.sql("ALTER TABLE permitted_events DROP COLUMN cell;")
+    migrator.sql("ALTER TABLE service_requests DROP COLUMN cell;")
@@ -0,0 +1,71 @@
+"""Peewee migrations -- 010_AddDurations.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+# ``sketches.key_sql('duration')`` with a relative accuracy of 1%.
+KEY = (
+    "CASE WHEN duration = 0 THEN -1 "
+    "ELSE ceil(ln(duration) / 0.020000666706669435)::integer END"
+)
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    migrator.sql("""
+ALTER TABLE service_requests
+    ADD COLUMN duration bigint
+    GENERATED ALWAYS AS (extract(epoch FROM closed - created)::bigint) STORED;
+CREATE INDEX service_requests_duration ON service_requests USING btree (duration);
+CREATE TABLE service_request_duration_sketches (
+    day date NOT NULL,
+    borough character varying(255) NOT NULL,
+    agency character varying(255) NOT NULL,
+    keys integer[] NOT NULL,
+    counts integer[] NOT NULL,
+    PRIMARY KEY (day, borough, agency)
+);
+    """)
+    migrator.sql(f"""
+INSERT INTO service_request_duration_sketches (day, borough, agency, keys, counts)
+SELECT day, borough, agency,
+       array_agg(key ORDER BY key), array_agg(calls ORDER BY key)
+FROM (
+    SELECT created::date AS day,
+           COALESCE(borough, 'Unspecified') AS borough,
+           agency,
+           {KEY} AS key,
+           COUNT(*) AS calls
+    FROM service_requests
+    WHERE duration >= 0
+    GROUP BY 1, 2, 3, 4
+) AS buckets
+GROUP BY 1, 2, 3;
+    """)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("DROP TABLE service_request_duration_sketches;")
+    migrator.sql("ALTER TABLE service_requests DROP COLUMN duration;")
@@ -0,0 +1,116 @@
+"""Peewee migrations -- 011_DictionaryEncodeServiceRequests.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+
+# (service_requests column, lookup table, name for blanks), see
+# ``data_jam.lookups``. Agency and type are NOT NULL, so their blanks need a
+# name in the lookup table; the others become NULL.
+LOOKUPS = (
+    ('agency', 'service_request_agencies', 'Unspecified'),
+    ('type', 'service_request_types', 'Unspecified'),
+    ('descriptor', 'service_request_descriptors', None),
+    ('borough', 'service_request_boroughs', None),
+)
+
+
+def _name(column, blank):
+    """SQL for the lookup name of ``column``."""
+    if blank is None:
+        return f"NULLIF({column}, '')"
+
+    return f"COALESCE(NULLIF({column}, ''), '{blank}')"
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    for column, table, blank in LOOKUPS:
+        name = _name(column, blank)
+        migrator.sql(f"""
+CREATE TABLE {table} (
+    id smallserial PRIMARY KEY,
+    name character varying(255) NOT NULL UNIQUE
+);
+INSERT INTO {table} (name)
+SELECT DISTINCT {name} FROM service_requests
+WHERE {name} IS NOT NULL
+ORDER BY 1;
+CREATE FUNCTION {table}_code(text) RETURNS smallint AS
+    'SELECT id FROM {table} WHERE name = $1'
+    LANGUAGE sql STABLE;
+        """)
+
+    # Subqueries aren't allowed in ALTER COLUMN ... USING, hence the helper
+    # functions. All four columns change in one statement, so the table (and
+    # the borough index) is only rewritten once.
+    migrator.sql(
+        "ALTER TABLE service_requests " + ", ".join(
+            f"ALTER COLUMN {column} TYPE smallint "
+            f"USING {table}_code({_name(column, blank)})"
+            for column, table, blank in LOOKUPS
+        ) + ";"
+    )
+
+    for column, table, _ in LOOKUPS:
+        migrator.sql(f"""
+DROP FUNCTION {table}_code(text);
+ALTER TABLE service_requests RENAME COLUMN {column} TO {column}_id;
+ALTER TABLE service_requests ADD CONSTRAINT service_requests_{column}_id_fkey
+    FOREIGN KEY ({column}_id) REFERENCES {table} (id);
+        """)
+
+    migrator.sql("""
+ALTER INDEX service_requests_borough RENAME TO service_requests_borough_id;
+ANALYZE service_requests;
+    """)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    for column, table, _ in LOOKUPS:
+        migrator.sql(f"""
+ALTER TABLE service_requests DROP CONSTRAINT service_requests_{column}_id_fkey;
+ALTER TABLE service_requests RENAME COLUMN {column}_id TO {column};
+CREATE FUNCTION {table}_name(smallint) RETURNS character varying AS
+    'SELECT name FROM {table} WHERE id = $1'
+    LANGUAGE sql STABLE;
+        """)
+
+    migrator.sql(
+        "ALTER TABLE service_requests " + ", ".join(
+            f"ALTER COLUMN {column} TYPE character varying(255) "
+            f"USING {table}_name({column})"
+            for column, table, _ in LOOKUPS
+        ) + ";"
+    )
+
+    for column, table, _ in LOOKUPS:
+        migrator.sql(f"""
+DROP FUNCTION {table}_name(smallint);
+DROP TABLE {table};
+        """)
+
+    migrator.sql(
+        "ALTER INDEX service_requests_borough_id RENAME TO service_requests_borough;"
+    )